@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+bench.py: Benchmarks for the bot's hot paths, run against a generated fixture database.
+
+    python bench.py                  run everything and compare against bench_baseline.json, if there is one
+    python bench.py --save           run everything and save the results as the new baseline
+    python bench.py --only parser    run only the benchmarks whose names start with 'parser'
+    python bench.py --storage memory run against the in-memory storage instead of SQLite
+
+Exits with 1 if any benchmark is more than --tolerance slower than the baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+from time import perf_counter, perf_counter_ns
+import tracemalloc
+
+from compiler import compileScript
+from db       import Database, Variables
+from storage  import storageTypes
+import irc
+from parser   import Parser
+from plugin   import Message, MessageType
+
+
+# Lines as Twitch sends them once twitch.tv/tags is requested
+chat_lines = [
+    b'@badge-info=subscriber/23;badges=moderator/1,subscriber/12;client-nonce=a1b2c3d4e5f60718293a4b5c6d7e8f90;'
+    b'color=#1E90FF;display-name=StyleRun09;emotes=;first-msg=0;flags=;id=b34ccfc7-4977-403a-8a94-33c6bac34fb8;'
+    b'mod=1;returning-chatter=0;room-id=1337;subscriber=1;tmi-sent-ts=1507246572675;turbo=0;user-id=1234;user-type=mod '
+    b':stylerun09!stylerun09@stylerun09.tmi.twitch.tv PRIVMSG #jazzyeagle :!so @joshtaerkmusic\r\n',
+    b'@badge-info=;badges=;color=;display-name=JoshTaerkMusic;emotes=25:0-4;first-msg=0;flags=;'
+    b'id=885196de-cb67-427a-baa8-82f9b0fcd05f;mod=0;room-id=1337;subscriber=0;tmi-sent-ts=1507246572676;turbo=0;'
+    b'user-id=5678;user-type= :joshtaerkmusic!joshtaerkmusic@joshtaerkmusic.tmi.twitch.tv PRIVMSG #jazzyeagle '
+    b':Kappa hello everyone, how is #everyone doing? \xf0\x9f\x98\x80\r\n',
+    b'PING :tmi.twitch.tv\r\n',
+    b':joshtaerkmusic!joshtaerkmusic@joshtaerkmusic.tmi.twitch.tv JOIN #jazzyeagle\r\n',
+    b'@emote-only=0;followers-only=-1;r9k=0;room-id=1337;slow=0;subs-only=0 :tmi.twitch.tv ROOMSTATE #jazzyeagle\r\n',
+]
+
+command_lines = [
+    b'@badge-info=;badges=;color=;display-name=StyleRun09;mod=0;room-id=1337;user-id=1234;user-type= '
+    b':stylerun09!stylerun09@stylerun09.tmi.twitch.tv PRIVMSG #jazzyeagle :!hello @joshtaerkmusic\r\n',
+    b'@badge-info=;badges=;color=;display-name=StyleRun09;mod=0;room-id=1337;user-id=1234;user-type= '
+    b':stylerun09!stylerun09@stylerun09.tmi.twitch.tv PRIVMSG #jazzyeagle :!discord\r\n',
+    b'@badge-info=;badges=;color=;display-name=StyleRun09;mod=0;room-id=1337;user-id=1234;user-type= '
+    b':stylerun09!stylerun09@stylerun09.tmi.twitch.tv PRIVMSG #jazzyeagle :!nosuchcommand\r\n',
+]
+
+# name: script.  nested<n> scripts look up a chain of n variables, e.g. {var {var d0}}
+scripts = {
+    'discord': 'Join the discord at https://discord.gg/example and say hi!',
+    'hello':   '{var greeting} {user}, {var howareyou}',
+    'long':    ' '.join(['Hello {user}, welcome to {channel}!'] * 25),
+    'so':      'Go check out {user} at {channel}!  {if {var exists shoutout} | {var shoutout} | Thanks!}',
+}
+for depth in range(1, 6):
+    scripts[f'nested{depth}'] = '{var ' * depth + 'd0' + '}' * depth
+
+variable_values = {
+    'greeting':  [f'Greeting number {number},' for number in range(500)],
+    'howareyou': [f'how are you doing ({number})?' for number in range(200)],
+    'shoutout':  [f'They stream great music ({number})' for number in range(300)],
+}
+for depth in range(5):
+    variable_values[f'd{depth}'] = [f'd{depth+1}']
+variable_values['d5'] = ['the end']
+
+
+# Writes the fixture as a snapshot in directory and loads it into a new database
+def create_fixture(directory, storage):
+    snapshot = os.path.join(directory, 'bench.json')
+    with open(snapshot, 'w') as snapshot_file:
+        json.dump({'Commands':  [{'name': name, 'script': script} for name, script in scripts.items()],
+                   'Variables': [{'name': name, 'value': value}
+                                 for name, values in variable_values.items() for value in values]},
+                  snapshot_file)
+    return Database(os.path.join(directory, 'bench.db'), storage=storage, snapshot=snapshot)
+
+
+# What TwitchIRCBot.create_message/process_PRIVMSG did before the irc module, kept for comparison
+def legacy_parse(unprocessed_message):
+    unprocessed_message = unprocessed_message.decode()
+    unprocessed_message = unprocessed_message[:len(unprocessed_message)-2]
+    if 'PRIVMSG' not in unprocessed_message:
+        return unprocessed_message
+    channel_end = 0
+    if '#' in unprocessed_message:
+        channel_start = unprocessed_message.find('#') + 1
+        channel_end   = unprocessed_message.find(' ', channel_start)
+        channel       = unprocessed_message[channel_start:channel_end].strip()
+    else:
+        channel       = ''
+    author_end = unprocessed_message.find('!', 1)
+    author     = unprocessed_message[1:author_end].strip()
+    text_start = unprocessed_message.find(':', channel_end) + 1
+    return channel, author, unprocessed_message[text_start:]
+
+
+# plugin.Message before it had __slots__, kept for comparison
+class LegacyMessage:
+    def __init__(self, message_type=MessageType.Channel, platform='', author='', channel='', timestamp=datetime.now(),
+                 command='', text='', to_user=None, response='', send_to_server=False):
+        self.message_type   = message_type
+        self.platform       = platform
+        self.author         = author
+        self.channel        = channel
+        self.timestamp      = timestamp
+        self.command        = command
+        self.text           = text
+        self.to_user        = to_user
+        self.response       = response
+        self.send_to_server = send_to_server
+
+
+# How a Message is built for a server line, before and after.  The cost of irc.parse is measured separately.
+def legacy_server_message(line):
+    return LegacyMessage(message_type=MessageType.Server, text=line.decode()[:-2])
+
+
+def server_message(line):
+    return Message(message_type=MessageType.Server, command='PING', raw=line)
+
+
+# Stands in for ChatBot so the Twitch plugin can be benchmarked without a connection
+class FixtureBot:
+    def __init__(self, db):
+        self.parser = Parser(db)
+        self.db     = self.parser.db
+
+
+class Results:
+    def __init__(self, only=None):
+        self.only    = only
+        self.results = {}
+
+
+    def wanted(self, name):
+        return self.only is None or name.startswith(self.only)
+
+
+    def record(self, name, latencies, elapsed):
+        latencies.sort()
+        count = len(latencies)
+        result = {
+            'ops':  count / elapsed,
+            'p50':  latencies[count // 2] / 1000,
+            'p95':  latencies[min(count - 1, count * 95 // 100)] / 1000,
+            'p99':  latencies[min(count - 1, count * 99 // 100)] / 1000,
+        }
+        self.results[name] = result
+        print(f'{name:<32} {result["ops"]:>12,.0f} ops/sec   '
+              f'p50 {result["p50"]:>8.1f}us   p95 {result["p95"]:>8.1f}us   p99 {result["p99"]:>8.1f}us')
+
+
+    # Calls function once per item, repeat times over, timing every call
+    def measure(self, name, function, items, repeat=2000):
+        if not self.wanted(name):
+            return
+        latencies = []
+        start = perf_counter()
+        for _ in range(repeat):
+            for item in items:
+                before = perf_counter_ns()
+                function(item)
+                latencies.append(perf_counter_ns() - before)
+        self.record(name, latencies, perf_counter() - start)
+
+
+    async def measure_async(self, name, function, items, repeat=2000):
+        if not self.wanted(name):
+            return
+        latencies = []
+        start = perf_counter()
+        for _ in range(repeat):
+            for item in items:
+                before = perf_counter_ns()
+                await function(item)
+                latencies.append(perf_counter_ns() - before)
+        self.record(name, latencies, perf_counter() - start)
+
+
+    # Builds count objects with factory and reports how much memory each one holds on to
+    def memory(self, name, factory, items, count=20000):
+        if not self.wanted(name):
+            return
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [factory(items[number % len(items)]) for number in range(count)]
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        self.results[name] = {'bytes': used / len(kept)}
+        print(f'{name:<32} {used / len(kept):>12,.0f} bytes each')
+
+
+    # Returns the names of benchmarks that are more than tolerance slower (or bigger) than baseline
+    def compare(self, baseline, tolerance):
+        regressions = []
+        for name, result in self.results.items():
+            if name not in baseline:
+                continue
+            if 'bytes' in result:
+                change = baseline[name]['bytes'] / result['bytes'] - 1
+            else:
+                change = result['ops'] / baseline[name]['ops'] - 1
+            flag = ''
+            if change < -tolerance:
+                regressions.append(name)
+                flag = '  <-- REGRESSION'
+            print(f'{name:<32} {change:>+8.1%} vs baseline{flag}')
+        return regressions
+
+
+async def run_benchmarks(results, db):
+    from plugins.twitch import TwitchIRCBot
+    twitch = TwitchIRCBot(FixtureBot(db), {})
+
+    # irc.parse as TwitchIRCBot.read uses it.  It decodes a PRIVMSG's channel, nick and text itself, the same as
+    #   legacy_parse, and drops the lines the plugin has no use for.
+    results.measure('irc: legacy find/decode', legacy_parse, chat_lines)
+    results.measure('irc: irc.parse', twitch.parse, chat_lines)
+
+    server_lines = [line for line in chat_lines if b'PRIVMSG' not in line]
+    results.measure('message: legacy server line', legacy_server_message, server_lines)
+    results.measure('message: server line', server_message, server_lines)
+    results.memory('message: legacy memory', legacy_server_message, server_lines)
+    results.memory('message: memory', server_message, server_lines)
+
+    results.measure('compiler: compileScript', compileScript, list(scripts.values()))
+
+    # renderTTL=0 turns the render cache off, so every run evaluates the script.  The same scripts are then
+    #   run again with the cache on; those that come out the same every time are answered from it.
+    evaluating = Parser(db, renderTTL=0)
+    caching    = Parser(db)
+    for name, script in scripts.items():
+        message = Message(author='stylerun09', channel='jazzyeagle', command=name, text=f'!{name} @joshtaerkmusic')
+        for label, parser in (('parser', evaluating), ('render cache', caching)):
+            async def process(script, message=message, parser=parser):
+                await parser.process(None, message, script)
+            await results.measure_async(f'{label}: {name}', process, [script], repeat=500)
+
+    results.measure('db: get greeting', lambda name: db.get(Variables, name), ['greeting'])
+    results.measure('db: getAllResults greeting', lambda name: db.getAllResults(Variables, name), ['greeting'],
+                    repeat=200)
+    results.measure('db: getScript', db.getScript, ['hello', 'nosuchcommand'])
+    # Writes are queued and made writeBatch at a time, so the cost of each transaction shows up in p99
+    results.measure('db: add variable', lambda value: db.add(Variables, 'counter', value), ['1', '2'], repeat=1000)
+    db.flush()
+
+    async def create_message(line):
+        await twitch.create_message(irc.parse(line))
+    await results.measure_async('twitch: create_message chat', create_message, chat_lines, repeat=500)
+    await results.measure_async('twitch: create_message commands', create_message, command_lines, repeat=500)
+    # could_run is given the text of each PRIVMSG, still as bytes
+    texts = [irc.parse(line).raw_params.partition(b' :')[2] for line in chat_lines + command_lines]
+    results.measure('twitch: filter chat', twitch.could_run, texts[:len(chat_lines)])
+    results.measure('twitch: filter commands', twitch.could_run, texts[len(chat_lines):])
+
+
+def main():
+    arguments = argparse.ArgumentParser(description='Benchmarks for the bot\'s hot paths')
+    arguments.add_argument('--baseline',  default='bench_baseline.json', help='baseline file to compare against')
+    arguments.add_argument('--save',      action='store_true', help='save these results as the baseline')
+    arguments.add_argument('--tolerance', type=float, default=0.25,
+                           help='fraction slower than the baseline that counts as a regression')
+    arguments.add_argument('--only',      help='run only the benchmarks whose names start with this')
+    arguments.add_argument('--storage',   choices=list(storageTypes), default='sqlite',
+                           help='storage to run the database benchmarks against')
+    arguments = arguments.parse_args()
+
+    results = Results(arguments.only)
+    with tempfile.TemporaryDirectory() as directory:
+        db = create_fixture(directory, arguments.storage)
+        asyncio.run(run_benchmarks(results, db))
+        db.close()
+
+    if arguments.save:
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(results.results, baseline_file, indent=4)
+        print(f'\nBaseline saved to {arguments.baseline}')
+        return 0
+
+    if not os.path.exists(arguments.baseline):
+        print(f'\nNo baseline at {arguments.baseline}; run with --save to create one')
+        return 0
+
+    print()
+    with open(arguments.baseline) as baseline_file:
+        regressions = results.compare(json.load(baseline_file), arguments.tolerance)
+    if regressions:
+        print(f'\n{len(regressions)} benchmark(s) regressed by more than {arguments.tolerance:.0%}: '
+              + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
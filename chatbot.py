@@ -4,53 +4,283 @@
 tooby.py: This is the main engine of the bot, which communicates with the various plugins.
 """
 
+import argparse
 import asyncio
 import importlib
 import logging
 import pkgutil
+import signal
+from time import monotonic, perf_counter
 
-from db     import Database
-from parser import Parser
+from db      import AsyncDatabase, Database
+from logs    import setup_logging
+from parser  import Parser
+from stats   import stats
+from storage import storageTypes
+
+# Seconds to wait before restarting a failed plugin.  Doubles after each failure, up to restart_delay_max,
+#   and goes back to restart_delay once the plugin has stayed up for restart_reset seconds.
+restart_delay     = 1
+restart_delay_max = 300
+restart_reset     = 600
+
+# Seconds between the reports a worker process sends its coordinator (see workers.py)
+report_interval   = 5
 
 
 """
 Main Bot Class
 """
 class ChatBot:
-    def __init__(self):
+    # worker, channels and reports are given when this bot is one of several worker processes (see workers.py):
+    #   its number, the channels it looks after in place of the configured ones, and the queue for its reports.
+    #   database holds any options for db.Database, e.g. {'storage': 'memory', 'snapshot': 'bot.json'}.
+    def __init__(self, worker=None, channels=None, reports=None, database=None):
         print('Initializing core modules...')
-        logging.basicConfig(filename='twitch.log', encoding='utf-8', level=logging.DEBUG)
-        self.db = Database()
-        self.parser = Parser(self.db)
+        self.started  = perf_counter()
+        self.startup  = {}
+        self.worker   = worker
+        self.channels = channels
+        self.reports  = reports
+        start = perf_counter()
+        self.log_listener, self.log_sampler = setup_logging('twitch.log' if worker is None else f'twitch-{worker}.log')
+        start = self.phase('logging', start)
+        # The command registry is loaded once the plugins are connecting (see load_caches)
+        # Worker processes share the database, so each has to look out for the others' changes
+        self.db = AsyncDatabase(Database(preload=False, shared=worker is not None, **(database or {})))
+        start = self.phase('database', start)
+        self.settings = self.db.sync.getConnectionSettings('chatbot')
+        start = self.phase('settings', start)
+        # Limits on each script (see parser.Budget and parser.maxConcurrent) and how long pure output is
+        #   cached for; any left out keep their defaults
+        options = {'maxSteps':      ('script-max-steps', int),
+                   'maxOutput':     ('script-max-output', int),
+                   'maxTime':       ('script-max-time', float),
+                   'maxConcurrent': ('script-max-concurrent', int),
+                   'renderTTL':     ('render-cache-ttl', float)}
+        self.parser = Parser(self.db, **{option: convert(self.settings[setting])
+                                         for option, (setting, convert) in options.items()
+                                         if setting in self.settings})
+        # log-level (e.g. INFO) and log-sample (keep 1 in every n debug lines) are optional
+        logging.getLogger().setLevel(self.settings.get('log-level', 'DEBUG').upper())
+        self.log_sampler.rate = int(self.settings.get('log-sample', 1))
 
-        print('Initializing plugin modules...')
+        # Plugins are only imported once the event loop is running; see load_plugin
         self.plugins = {}
-        modules = pkgutil.iter_modules(path=['plugins'])
-        for module in modules:
-            print(f'\tLoading Module {module.name}')
-            settings = self.db.getConnectionSettings(module.name)
-            self.plugins[module.name] = importlib.import_module('plugins.'+module.name).Plugin(self, settings)
-            print(f'\tModule {module.name} loaded')
+        self.modules = [module.name for module in pkgutil.iter_modules(path=['plugins'])]
+
 
-        print(f'\n# of plugins loaded: {len(self.plugins)}')
+    # Records how long a startup phase took.  Returns the time now, to start the next phase from.
+    def phase(self, name, start):
+        now = perf_counter()
+        self.startup[name] = now - start
+        return now
+
+
+    """
+    Imports a plugin and creates it.  The import runs on a thread so that several plugins can be loaded
+    side by side.  Returns None, after logging why, if the plugin can't be loaded.
+    """
+    async def load_plugin(self, name):
+        print(f'\tLoading Module {name}')
+        start = perf_counter()
+        try:
+            module = await asyncio.to_thread(importlib.import_module, 'plugins.' + name)
+            settings = self.db.sync.getConnectionSettings(name)
+            if self.channels is not None:
+                settings['channels'] = list(self.channels)
+            plugin = self.plugins[name] = module.Plugin(self, settings)
+        except Exception:
+            logging.exception('Plugin %s could not be loaded', name)
+            print(f'\tModule {name} could not be loaded')
+            return None
+        self.phase(f'plugin {name}', start)
+        print(f'\tModule {name} loaded')
+        return plugin
+
+
+    """
+    Loads what can wait until the plugins are connecting, then reports how long startup took.
+    A worker process then goes on watching for the other workers' changes to the database until cancelled.
+    """
+    async def load_caches(self):
+        start = perf_counter()
+        await self.db.run(self.db.commands.load)
+        self.phase('commands', start)
+        self.startup['total'] = perf_counter() - self.started
+        print('Started in ' + ', '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in self.startup.items()))
+        logging.info('startup %s', self.startup)
+        stats.register('startup', lambda: self.startup)
+        if self.db.sync.shared:
+            await self.db.watch()
 
     """
     Runs the bot
     """
     def run(self):
         print('Starting application...')
-        for plugin in self.plugins.values():
-            asyncio.run(plugin.run())
+        try:
+            asyncio.run(self.supervise())
+        except KeyboardInterrupt:
+            pass
+        self.db.close()
         print('Chatbot shutting down.')
+        self.log_listener.stop()
 
 
-    def join_channels(self, channels):
-        pass
+    """
+    Runs every plugin side by side in one event loop, restarting any that fail, until they all finish
+    or the bot is told to stop (Ctrl+C / SIGTERM).
+    """
+    async def supervise(self):
+        self.stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stopping.set)
+                signals.append(signum)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        if self.modules:
+            print('Initializing plugin modules...')
+            await asyncio.gather(*(self.load_plugin(name) for name in self.modules))
+            print(f'\n# of plugins loaded: {len(self.plugins)}')
+
+        tasks = [asyncio.create_task(self.keep_running(name, plugin), name=name)
+                 for name, plugin in self.plugins.items()]
+        stats_tasks = self.start_stats()
+        if self.modules:
+            stats_tasks.append(asyncio.create_task(self.load_caches(), name='load-caches'))
+        stopping = asyncio.create_task(self.stopping.wait(), name='stopping')
+        await asyncio.wait([stopping, *tasks], return_when=asyncio.FIRST_COMPLETED)
+        if self.stopping.is_set():
+            print('Stopping plugins...')
+        else:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        tasks += stats_tasks
+        stopping.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(stopping, *tasks, return_exceptions=True)
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+
+
+    """
+    Turns on latency stats if either stats-port (serve the report on localhost) or stats-interval (write the
+    report to the log every so many seconds) is set.  Returns the tasks doing so.
+    A worker process sends its figures to the coordinator instead, which serves or logs them for every worker.
+    """
+    def start_stats(self):
+        settings = self.settings
+        if self.reports is not None:
+            stats.enabled = bool(settings.get('stats-port') or settings.get('stats-interval'))
+            return [asyncio.create_task(self.report(), name='report')]
+
+        tasks = []
+        if settings.get('stats-port'):
+            tasks.append(asyncio.create_task(stats.serve(int(settings['stats-port'])), name='stats-serve'))
+        if settings.get('stats-interval'):
+            tasks.append(asyncio.create_task(stats.dump(float(settings['stats-interval'])), name='stats-dump'))
+        stats.enabled = bool(tasks)
+        return tasks
+
+
+    """
+    Sends the coordinator this worker's stats every report_interval seconds.  The coordinator also takes
+    each report as a sign that the worker is healthy.  Runs until cancelled.
+    """
+    async def report(self):
+        while True:
+            self.reports.put((self.worker, stats.snapshot()))
+            await asyncio.sleep(report_interval)
+
+
+    """
+    Runs a single plugin, restarting it with exponential backoff whenever it raises.
+    A plugin that returns normally is finished and is not restarted.
+    """
+    async def keep_running(self, name, plugin):
+        delay = restart_delay
+        while True:
+            started = monotonic()
+            try:
+                await plugin.run()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Plugin %s failed', name)
+
+            # A plugin that ran for a good while before failing starts over with a short delay
+            if monotonic() - started > restart_reset:
+                delay = restart_delay
+            print(f'Plugin {name} failed.  Restarting in {delay} seconds.')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, restart_delay_max)
+
+
+    """
+    Joins channels on the plugin for platform, or on every plugin if no platform is given.
+    Plugins that have no channels are skipped.
+    """
+    async def join_channels(self, channels, platform=None):
+        for plugin in self.plugins_for(platform):
+            try:
+                await plugin.join_channels(channels)
+            except NotImplementedError:
+                pass
+
+    async def part_channels(self, channels, platform=None):
+        for plugin in self.plugins_for(platform):
+            try:
+                await plugin.part_channels(channels)
+            except NotImplementedError:
+                pass
+
+    def plugins_for(self, platform):
+        if platform:
+            return [plugin for name, plugin in self.plugins.items() if name == platform.lower()]
+        return list(self.plugins.values())
+
+
+"""
+Runs the bot in this process, or as --processes worker processes (default: the processes setting) each
+looking after a share of the channels.
+"""
+def main():
+    arguments = argparse.ArgumentParser(description='Runs the chat bot')
+    arguments.add_argument('--processes', type=int, help='worker processes to split the channels between')
+    arguments.add_argument('--storage',   choices=list(storageTypes), default='sqlite',
+                           help='where to keep commands, variables and quotes (memory keeps nothing once stopped)')
+    arguments.add_argument('--snapshot',  help='snapshot file to load into the storage at startup')
+    arguments = arguments.parse_args()
+
+    # The snapshot is loaded here, once, before anything else opens the database.  Loading it again when a
+    #   bot or worker starts would replace everything written since.  Memory storage is only seen by the
+    #   process that made it, so there each one loads its own copy.
+    database = {'storage': arguments.storage}
+    db = Database(preload=False, snapshot=arguments.snapshot, **database)
+    if arguments.storage == 'memory':
+        database['snapshot'] = arguments.snapshot
+    settings = db.getConnectionSettings('chatbot')
+    channels = db.getConnectionSettings('twitch')['channels']
+    db.close()
+    processes = arguments.processes or int(settings.get('processes', 1))
+    if isinstance(channels, str):
+        channels = channels.split(',')
 
-    def part_channels(self, channels):
-        pass
+    if processes > 1:
+        from workers import Coordinator
+        if arguments.storage == 'memory':
+            print('Each worker process keeps its own memory storage; changes made in one are not seen by the others.')
+        Coordinator(processes, channels, settings, database).run()
+    else:
+        ChatBot(database=database).run()
 
 
 if __name__ == "__main__":
-    chatty = ChatBot()
-    chatty.run()
+    main()
@@ -0,0 +1,238 @@
+# compiler.py:  Turns a command script into a tree of Literal and Call nodes so the script is only
+#               scanned once.  The Parser walks the tree instead of re-scanning the text for { }.
+#               Compiled scripts are kept in a ScriptCache so busy commands are only compiled once, and the
+#               output of anything that comes out the same every time is kept in a RenderCache.
+
+from collections import OrderedDict
+import re
+from time import monotonic
+
+from result import Result, ResultType
+
+maxDepth = 10
+braces   = re.compile(r'[{}]')
+
+
+# Plain text between (or outside of) { }
+class Literal:
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+# A single { } block, e.g. {var greeting}
+#   name   = first word inside the brackets, i.e. the builtin to call.  None if there isn't one.
+#   source = raw text inside the brackets, including any nested { }
+#   args   = nodes after the name
+#   words  = source.split(), computed once so the builtins don't have to keep splitting
+#   concurrent = whether the block can run at the same time as the blocks beside it, filled in by the parser
+class Call:
+    __slots__ = ('name', 'source', 'args', 'words', 'dynamic', 'concurrent', '_branches', '_head')
+
+    def __init__(self, source, nodes):
+        self.source     = source
+        self.words      = source.split()
+        self.name       = None
+        self.args       = nodes
+        self.concurrent = None
+        self._branches  = None
+        self._head      = None
+
+        if nodes and type(nodes[0]) is Literal:
+            first = nodes[0].text.split(None, 1)
+            if first:
+                self.name = first[0]
+                rest = nodes[0].text.lstrip()[len(self.name):]
+                self.args = ([Literal(rest)] if rest else []) + nodes[1:]
+        # dynamic = at least one argument needs to be evaluated before it can be used
+        self.dynamic = any(type(node) is Call for node in self.args)
+
+    # Splits the arguments on | outside of any nested { }, e.g. for {if cond | true | false}
+    def branches(self):
+        if self._branches is None:
+            branches = [[]]
+            for node in self.args:
+                if type(node) is Literal and '|' in node.text:
+                    pieces = node.text.split('|')
+                    if pieces[0]:
+                        branches[-1].append(Literal(pieces[0]))
+                    for piece in pieces[1:]:
+                        branches.append([Literal(piece)] if piece else [])
+                else:
+                    branches[-1].append(node)
+            self._branches = branches
+        return self._branches
+
+    # Splits the arguments after their first two words, which hold the subcommand and the name it works on.
+    #   Returns the nodes of those words and the raw text after them, e.g. for {var set {user}_hi Hi {user}!}
+    #   the nodes of " set {user}_hi" and "Hi {user}!", so the value can be kept without evaluating it.
+    def head(self):
+        if self._head is None:
+            nodes  = []
+            words  = 0
+            inWord = False
+            # Where the arguments start in source, i.e. just after the name
+            end = len(self.source) - sum(span(node) for node in self.args)
+            for node in self.args:
+                if type(node) is Call:
+                    words += not inWord
+                    inWord = True
+                    nodes.append(node)
+                    end += span(node)
+                    continue
+                for position, character in enumerate(node.text):
+                    if not character.isspace():
+                        words += not inWord
+                        inWord = True
+                    elif inWord and words == 2:
+                        nodes.append(Literal(node.text[:position]))
+                        self._head = (nodes, self.source[end + position:].lstrip())
+                        return self._head
+                    else:
+                        inWord = False
+                nodes.append(node)
+                end += span(node)
+            self._head = (nodes, '')
+        return self._head
+
+
+# Length of the text node was compiled from, counting a block's { }
+def span(node):
+    return len(node.text) if type(node) is Literal else len(node.source) + 2
+
+
+# variables = the names of the variables the script reads, filled in by the parser the first time it runs
+class Script:
+    __slots__ = ('source', 'nodes', 'variables')
+
+    def __init__(self, source, nodes):
+        self.source    = source
+        self.nodes     = nodes
+        self.variables = None
+
+
+# Compiles script into a Script in a single pass.  Returns Error if the brackets don't match up
+#   or are nested too deeply.
+def compileScript(script):
+    if '{' not in script:
+        return Result(ResultType.Ok, Script(script, [Literal(script)] if script else []))
+
+    # stack holds (position of opening bracket, nodes found so far) for each open {
+    stack = [(-1, [])]
+    last  = 0
+    for match in braces.finditer(script):
+        position = match.start()
+        # A } with no open { is just text, the same as it always was
+        if match.group() == '}' and len(stack) == 1:
+            continue
+        if position > last:
+            stack[-1][1].append(Literal(script[last:position]))
+        last = position + 1
+
+        if match.group() == '{':
+            if len(stack) > maxDepth:
+                return Result(ResultType.Error, f'Subcommands nested more than {maxDepth} deep')
+            stack.append((position, []))
+        else:
+            start, nodes = stack.pop()
+            stack[-1][1].append(Call(script[start+1:position], nodes))
+
+    if len(stack) > 1:
+        return Result(ResultType.Error, '# opening brackets does not match # closing brackets')
+    if last < len(script):
+        stack[0][1].append(Literal(script[last:]))
+    return Result(ResultType.Ok, Script(script, stack[0][1]))
+
+
+# Compiled scripts keyed by command name and script hash.  The hash means an edited command just
+#   compiles into a new entry; the old one ages out of the cache.
+class ScriptCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.scripts = OrderedDict()
+
+    def __len__(self):
+        return len(self.scripts)
+
+    def get(self, name, script):
+        key = (name, hash(script))
+        compiled = self.scripts.get(key)
+        if compiled is not None and compiled.source == script:
+            self.scripts.move_to_end(key)
+            return Result(ResultType.Ok, compiled)
+
+        result = compileScript(script)
+        if result.isOk():
+            self.scripts[key] = result.getResult()
+            if len(self.scripts) > self.maxsize:
+                self.scripts.popitem(last=False)
+        return result
+
+    # Drops every compiled script for name, e.g. when the command is edited or deleted
+    def invalidate(self, name):
+        for key in [key for key in self.scripts if key[0] == name]:
+            del self.scripts[key]
+
+
+# Output of scripts and { } blocks that come out the same every time, e.g. a !discord command or {var socials}
+#   when socials has a single value.  Keyed by ('script', text) for a whole script and ('call', source) for a
+#   { } block, so a script that happens to read "var socials" is never mistaken for {var socials}.  inputs
+#   are what the output was made from, e.g. (Variables, 'socials'); an entry is dropped when any of them
+#   changes (see invalidate), or after ttl seconds in case it was changed outside of the bot.
+class RenderCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.entries = OrderedDict()
+        self.readers = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns (output, inputs), or None if source isn't cached
+    def get(self, source):
+        entry = self.entries.get(source)
+        if entry is None:
+            return None
+        if entry[2] <= monotonic():
+            self.drop(source)
+            return None
+        self.entries.move_to_end(source)
+        return entry
+
+    def put(self, source, output, inputs):
+        self.drop(source)
+        self.entries[source] = (output, inputs, monotonic() + self.ttl)
+        for key in inputs:
+            readers = self.readers.get(key)
+            if readers is None:
+                readers = self.readers[key] = set()
+            readers.add(source)
+        if len(self.entries) > self.maxsize:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, source):
+        entry = self.entries.pop(source, None)
+        if entry is None:
+            return
+        for key in entry[1]:
+            readers = self.readers.get(key)
+            if readers is not None:
+                readers.discard(source)
+                if not readers:
+                    del self.readers[key]
+
+    def clear(self):
+        self.entries.clear()
+        self.readers.clear()
+
+    # Drops everything that was made from key
+    def invalidate(self, key):
+        for source in list(self.readers.get(key, ())):
+            self.drop(source)
+
+    # Drops everything that was made from anything of varType, e.g. (Quotes, '3') and (Quotes, '4')
+    def invalidateType(self, varType):
+        for key in [key for key in self.readers if key[0] is varType]:
+            self.invalidate(key)
@@ -0,0 +1,89 @@
+# cooldowns.py:  Keeps a flood of the same command, e.g. hundreds of !hype in a second, from being evaluated
+#                and answered hundreds of times.  Cooldowns stop a command running again too soon, and
+#                identical lines are only handled one at a time.
+#
+#                Cooldowns are set in seconds with these settings; any left out (or 0) are off:
+#                cooldown-global   = any command, in any channel
+#                cooldown-channel  = any command, in the same channel
+#                cooldown-user     = the same user, any command, in the same channel
+#                cooldown-command  = the same command, in the same channel
+
+from collections import OrderedDict
+from time import monotonic
+
+from stats import stats
+
+
+# Keys that are forgotten ttl seconds after they were last added.  Every key lives for the same ttl, so
+#   the oldest key is always the first to expire, and expired keys are cleared from the front as new ones
+#   are added.  Holds at most maxsize keys; past that the oldest go early.
+class ExpiringSet:
+    __slots__ = ('ttl', 'maxsize', 'entries')
+
+    def __init__(self, ttl, maxsize=10000):
+        self.ttl     = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def contains(self, key, now):
+        expires = self.entries.get(key)
+        return expires is not None and expires > now
+
+    def add(self, key, now):
+        entries = self.entries
+        while entries:
+            oldest = next(iter(entries))
+            if entries[oldest] > now:
+                break
+            del entries[oldest]
+        entries.pop(key, None)
+        entries[key] = now + self.ttl
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+
+class Cooldowns:
+    def __init__(self, settings, maxsize=10000):
+        scopes = {
+            'global':   lambda channel, user, command: None,
+            'channel':  lambda channel, user, command: channel,
+            'user':     lambda channel, user, command: (channel, user),
+            'command':  lambda channel, user, command: (channel, command),
+        }
+        # (name, key function, recent keys) for each cooldown that is turned on
+        self.scopes   = [(scope, key, ExpiringSet(float(settings[f'cooldown-{scope}']), maxsize))
+                         for scope, key in scopes.items() if float(settings.get(f'cooldown-{scope}', 0)) > 0]
+        self.inFlight = set()
+
+
+    # True if command may run now, in which case its cooldowns start
+    def allow(self, channel, user, command, now=None):
+        if not self.scopes:
+            return True
+        now = monotonic() if now is None else now
+        keys = []
+        for scope, key, recent in self.scopes:
+            keys.append(key(channel, user, command))
+            if recent.contains(keys[-1], now):
+                stats.count('cooldown', scope)
+                return False
+        for (scope, key, recent), used in zip(self.scopes, keys):
+            recent.add(used, now)
+        return True
+
+
+    # For identical lines, e.g. the same text in the same channel:  True for the first, False for any more
+    #   that arrive before release() is called for it
+    def claim(self, key):
+        if key in self.inFlight:
+            stats.count('cooldown', 'duplicate')
+            return False
+        self.inFlight.add(key)
+        return True
+
+
+    def release(self, key):
+        self.inFlight.discard(key)
@@ -1,99 +1,350 @@
-from sqlalchemy import create_engine, select, text
-from sqlalchemy import Table, Column, DateTime, Integer, String
-from sqlalchemy.orm import Session, Query, declarative_base, relationship
-from sqlalchemy.pool import QueuePool
-
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import logging
-from random import randint
+from random import choice, sample
+from time import monotonic
 
-from result import Result, ResultType
+from result  import Result, ResultType
+from stats   import stats
+from storage import Commands, ConnectionSettings, Quotes, Variables, storageTypes
 
-BaseClass = declarative_base()
+# Writes are held for up to writeDelay seconds, or until there are writeBatch of them, and then made in a
+#   single transaction
+writeDelay = 0.25
+writeBatch = 500
 
+# When the database is shared with other processes, how often (in seconds) to check whether any of them has
+#   changed it.  See AsyncDatabase.watch.
+checkInterval = 1
 
-class Commands(BaseClass):
-    __tablename__ = 'Commands'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False, unique=True)
-    script = Column(String, nullable=False)
-    frequency = Column(Integer, nullable=False, default=0)
-    user_level = Column(String)
 
+dbTableTypes = {
+    'commands':  Commands,
+    'settings':  ConnectionSettings,
+    'variables': Variables,
+    'quotes':    Quotes
+}
 
-class ConnectionSettings(BaseClass):
-    __tablename__ = 'ConnectionSettings'
-    id = Column(Integer, primary_key=True)
-    platform = Column(String, nullable=False)
-    field = Column(String, nullable=False)
-    value = Column(String)
 
+# In-memory copy of the Commands table so that looking up a !command does not touch the database.
+#   Names that are not commands are remembered for a while too, so floods of unknown !words are also
+#   answered from memory.  Parser invalidates entries whenever a command is added, edited or deleted.
+class CommandRegistry:
+    def __init__(self, db, missingSize=4096, missingTTL=300):
+        self.db          = db
+        self.scripts     = {}
+        self.names       = set()
+        self.missing     = OrderedDict()
+        self.missingSize = missingSize
+        self.missingTTL  = missingTTL
 
-class Variables(BaseClass):
-    __tablename__ = 'Variables'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    value = Column(String, nullable=False)
-    on_date = Column(DateTime, default=datetime.now())
-    added_by = Column(String)
 
+    def __len__(self):
+        return len(self.scripts)
 
-class Quotes(BaseClass):
-    __tablename__ = 'Quotes'
-    id = Column(Integer, primary_key=True)
-    quote = Column(String, nullable=False)
-    on_date = Column(DateTime, nullable=False, default=datetime.now())
-    said_by = Column(String, nullable=False)
-    recorded_by = Column(String, nullable=False)
 
+    # Loads every command at once.  Called at startup.
+    def load(self):
+        logging.debug('db.CommandRegistry.load')
+        self.scripts = self.db.read().commands()
+        self.names = {name.encode() for name in self.scripts}
+        self.missing.clear()
 
-dbTableTypes = {
-    'commands':  Commands,
-    'settings':  ConnectionSettings,
-    'variables': Variables,
-    'quotes':    Quotes
-}
 
+    def get(self, name):
+        script = self.scripts.get(name)
+        if script is not None:
+            return Result(ResultType.Ok, script)
 
-class Database:
-    def __init__(self, path_to_db='chatbot.db'):
-        logging.debug("db.init sqlite+pysqlite:///" + path_to_db)
-        self.engine = create_engine("sqlite+pysqlite:///" + path_to_db, future=True, poolclass=QueuePool)
+        expires = self.missing.get(name)
+        if expires is not None and expires > monotonic():
+            return Result(ResultType.Error, f'Command {name} does not exist')
+
+        # Not seen recently.  The command may have been added outside of the bot, so check once.
+        result = self.db.loadScript(name)
+        if result.isOk():
+            self.update(name, result.getResult())
+        else:
+            self.missing[name] = monotonic() + self.missingTTL
+            self.missing.move_to_end(name)
+            if len(self.missing) > self.missingSize:
+                self.missing.popitem(last=False)
+        return result
+
+
+    # Answers from memory only.  Returns None if the database would have to be asked.
+    def peek(self, name):
+        script = self.scripts.get(name)
+        if script is not None:
+            return Result(ResultType.Ok, script)
+        expires = self.missing.get(name)
+        if expires is not None and expires > monotonic():
+            return Result(ResultType.Error, f'Command {name} does not exist')
+        return None
+
+
+    # Whether !name, with name still as bytes off the socket, could run a command:  it is a known command, or
+    #   it has not been looked up lately and so might have been added outside of the bot.  Only names that
+    #   are not known commands are decoded.
+    def mightExist(self, name):
+        if name in self.names:
+            return True
+        expires = self.missing.get(name.decode('utf-8', 'replace'))
+        return expires is None or expires <= monotonic()
+
+
+    def update(self, name, script):
+        self.scripts[name] = script
+        self.names.add(name.encode())
+        self.missing.pop(name, None)
+
+
+    # Forgets name, so the next lookup goes back to the database
+    def invalidate(self, name):
+        self.scripts.pop(name, None)
+        self.names.discard(name.encode())
+        self.missing.pop(name, None)
+
+
+# All of the values for one variable name.  Picking one is O(1) instead of a query for every row.
+class ValuePool:
+    __slots__ = ('values', 'bag')
+
+    def __init__(self, values):
+        self.values = values
+        self.bag    = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def pick(self):
+        return choice(self.values)
+
+    # Shuffle bag:  hands out every value once, in random order, before starting over
+    def shuffle(self):
+        if not self.bag:
+            self.bag = sample(range(len(self.values)), len(self.values))
+        return self.values[self.bag.pop()]
+
+
+# Variable values grouped by name.  A name's values are read from the database the first time it is
+#   used and kept until the variable changes (see invalidate) or falls out of the most recently used maxsize.
+class VariableStore:
+    def __init__(self, db, maxsize=1024):
+        self.db      = db
+        self.maxsize = maxsize
+        self.pools   = OrderedDict()
+
+
+    # Returns the ValuePool for name.  An empty pool means the variable does not exist.
+    def pool(self, name):
+        pool = self.pools.get(name)
+        if pool is not None:
+            self.pools.move_to_end(name)
+            return pool
+
+        logging.debug('db.VariableStore.pool - loading')
+        pool = self.pools[name] = ValuePool(self.db.read().values([name]).get(name, []))
+        if len(self.pools) > self.maxsize:
+            self.pools.popitem(last=False)
+        return pool
+
+
+    # Loads the values of every one of names in a single query.  Names with no values get an empty pool, so
+    #   that asking about them again doesn't go back to the database either.
+    def load(self, names):
+        logging.debug('db.VariableStore.load - %d names', len(names))
+        values = self.db.read().values(names)
+        for name in names:
+            self.replace(name, values.get(name, []))
+
+
+    # Returns the ValuePool for name if it is already loaded, otherwise None.  Never touches the database.
+    def peek(self, name):
+        return self.pools.get(name)
+
+
+    def invalidate(self, name):
+        self.pools.pop(name, None)
+
+
+    def clear(self):
+        self.pools.clear()
+
+
+    # After a write:  name's values are now values.  Only names already loaded are updated; any other
+    #   name is read from the database (which is flushed first) when it is next used.
+    def replace(self, name, values):
+        self.pools[name] = ValuePool(values)
+        self.pools.move_to_end(name)
+        if len(self.pools) > self.maxsize:
+            self.pools.popitem(last=False)
+
+
+    def append(self, name, value):
+        pool = self.pools.get(name)
+        if pool is not None:
+            pool.values.append(value)
+
+
+# Writes that have been made in memory but not yet in the database.  Each write is (operation, arguments)
+#   for the storage (see storage.Storage).  flush() makes them all in one transaction; Database.read()
+#   flushes before any read, so reads never see the database without an earlier write.  Only ever used from one thread at a time:
+#   the AsyncDatabase thread, or the caller when Database is used on its own.
+class WriteQueue:
+    def __init__(self, db, maxsize=writeBatch):
+        self.db      = db
+        self.maxsize = maxsize
+        self.pending = []
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def put(self, operation, *arguments):
+        self.pending.append((operation, arguments))
+        if len(self.pending) >= self.maxsize:
+            self.flush()
 
-        BaseClass.metadata.create_all(self.engine)
 
+    def flush(self):
+        if not self.pending:
+            return
+        writes, self.pending = self.pending, []
+        start = stats.start()
+        try:
+            self.db.storage.write(writes)
+        except Exception:
+            # One bad write shouldn't lose the rest of the batch, so go through them again one at a time
+            logging.exception('db.WriteQueue.flush - batch of %d failed; retrying one by one', len(writes))
+            for write in writes:
+                try:
+                    self.db.storage.write([write])
+                except Exception:
+                    logging.exception('db.WriteQueue.flush - write failed')
+        stats.stop('db flush', start)
 
-    # Returns the connection settings for a particular plugin
+
+class Database:
+    # preload = False leaves loading the command registry to the caller, e.g. once the bot is connected.
+    #   Until then, commands are looked up one at a time.
+    # storage = which of storage.storageTypes to keep the tables in.  path_to_db is the SQLite file; the
+    #   memory storage doesn't use it.
+    # snapshot = a snapshot file (see storage.py) to load into the storage before anything else
+    # shared = True when other processes, e.g. the other workers, write to the same database (see refresh)
+    def __init__(self, path_to_db='chatbot.db', preload=True, storage='sqlite', snapshot=None, shared=False):
+        logging.debug('db.init %s %s', storage, path_to_db)
+        if storage not in storageTypes:
+            raise ValueError(f'Storage {storage} is not one of {", ".join(storageTypes)}')
+        self.storage = storageTypes[storage](path_to_db)
+        if snapshot is not None:
+            self.storage.load(snapshot)
+
+        self.writes = WriteQueue(self)
+        self.settings = None
+        self.shared = shared
+        self.version = self.storage.version() if shared else None
+        # Goes up each time the caches are reloaded (see refresh), so that the parser knows to clear its own
+        self.generation = 0
+        self.commands = CommandRegistry(self)
+        if preload:
+            self.commands.load()
+        self.variables = VariableStore(self)
+
+
+    # Every read goes through here, so that it sees any writes still waiting in the queue
+    def read(self):
+        self.writes.flush()
+        return self.storage
+
+
+    def flush(self):
+        logging.debug('db.flush')
+        self.writes.flush()
+
+
+    # Whether anything but this process has committed a change since the last call.  The storage's version
+    #   doesn't count this process's own flushes, so those never make it True.  Asks the storage, so in the
+    #   bot it is only called on the database thread (see AsyncDatabase.watch).
+    def changed(self):
+        version = self.storage.version()
+        if version == self.version:
+            return False
+        self.version = version
+        return True
+
+
+    # The registry and pools are only kept up to date with this process's own writes.  When something else
+    #   has changed the database, the pools are dropped, to be read again as they are used, and the registry
+    #   is reloaded in one query so that it goes on answering from memory.
+    def refresh(self):
+        if not self.changed():
+            return False
+        logging.debug('db.refresh - database changed; reloading caches')
+        self.generation += 1
+        self.variables.clear()
+        self.commands.load()
+        return True
+
+
+    # Makes any writes still queued and lets go of the storage
+    def close(self):
+        self.flush()
+        self.storage.close()
+
+
+    # Saves every table to a snapshot file, which Database(snapshot=path) can load again
+    def save(self, path):
+        self.read().save(path)
+
+
+    # Returns the connection settings for a particular plugin:  the rows for its platform, on top of the
+    #   bot's own ('chatbot') rows, which every plugin shares.  Each 'channel' row adds to settings['channels'].
+    #   Every row is read in one query the first time; after that this is answered from memory.
     def getConnectionSettings(self, plugin):
         logging.debug('db.getConnectionSettings')
-        settings = {}
-        settings['channels'] = []
-        with Session(self.engine) as session:
-            results = session.query(ConnectionSettings.field,
-                                     ConnectionSettings.value).all()
-            for result in results:
-                if result.field == 'channel':
-                    settings['channels'].append(result.value)
+        if self.settings is None:
+            self.loadSettings()
+        settings = {'channels': []}
+        for platform in dict.fromkeys(('chatbot', plugin.lower())):
+            for field, value in self.settings.get(platform, ()):
+                if field == 'channel':
+                    settings['channels'].append(value)
                 else:
-                    settings[result.field] = result.value
-            return settings
-        
+                    settings[field] = value
+        return settings
+
+
+    # Every ConnectionSettings row, grouped by platform, in the order they were added
+    def loadSettings(self):
+        logging.debug('db.loadSettings')
+        self.settings = {}
+        for platform, field, value in self.read().settings():
+            self.settings.setdefault(platform.lower(), []).append((field, value))
 
-    # Returns the list of commands and the corresponding scripts
+
+    # Returns {name: script} for every command
     def getCommands(self):
         logging.debug('db.getCommands')
-        with Session(self.engine) as session:
-            return session.execute(select(Commands.name, Commands.script))
+        return self.read().commands()
 
 
     def getScript(self, varName):
         logging.debug('db.getScript')
-        with Session(self.engine) as session:
-            results = session.execute(select(Commands.script).where(Commands.name == varName)).first()
-            logging.debug(f'# Results: {len(results)}')
-            if len(results) == 0:
-                return Result(ResultType.Error, f'Command {varName} does not exist')
-            return Result(ResultType.Ok, results[0])
+        return self.commands.get(varName)
+
+
+    # Goes to the database for a single command's script.  Use getScript, which checks the registry first.
+    def loadScript(self, varName):
+        logging.debug('db.loadScript')
+        script = self.read().script(varName)
+        if script is None:
+            return Result(ResultType.Error, f'Command {varName} does not exist')
+        return Result(ResultType.Ok, script)
 
 
     def getType(self, t):
@@ -105,46 +356,258 @@ class Database:
 
     def exists(self, varType, varName):
         logging.debug('db.exists')
-        with Session(self.engine) as session:
-            q = session.query(varType.id).filter(varType.name == varName.lower())
-            #session.query(q.exists())
-            (isFound, ), = session.query(q.exists().where(varType.name == varName.lower()))
-            return Result(ResultType.Ok, f'{isFound}')
-
-
-    # This function is used within get, but it is also called directly via tests
+        if varType is Variables:
+            return Result(ResultType.Ok, f'{bool(self.variables.pool(varName.lower()))}')
+        if varType is Commands:
+            return Result(ResultType.Ok, f'{self.commands.get(varName).isOk()}')
+        if varType is Quotes:
+            if not varName.isdigit():
+                return Result(ResultType.Error, f'Quote {varName} is not a quote number')
+            return Result(ResultType.Ok, f'{self.read().quote(int(varName)) is not None}')
+        return Result(ResultType.Error, f'{varType.__name__} cannot be checked')
+
+
+    # Every value of varName, straight from the database.  Called directly via tests.
     def getAllResults(self, varType, varName):
         logging.debug('db.getAllResults')
-        with Session(self.engine) as session:
-            results = session.execute(select(Variables.value).where(Variables.name == varName)).all()
-            if len(results) == 0:
-                return Result(ResultType.Error, f'{varType.__name__} error:  {varName} not found in db.')
-            return Result(ResultType.Ok, results)
+        results = self.read().values([varName]).get(varName)
+        if not results:
+            return Result(ResultType.Error, f'{varType.__name__} error:  {varName} not found in db.')
+        return Result(ResultType.Ok, results)
 
 
-    def get(self, varType, varName):
+    # Returns a random value for varName.  With shuffle=True, every value comes up once before any repeat.
+    def get(self, varType, varName, shuffle=False):
         logging.debug('db.get')
-        results = self.getAllResults(varType, varName)
-        if results.isError():
-            return results
-        results = results.getResult()
-        if len(results) == 1:
-            randomResult = 0
+        if varType is Variables:
+            pool = self.variables.pool(varName)
+            if not pool:
+                return Result(ResultType.Error, f'{varType.__name__} error:  {varName} not found in db.')
+            return Result(ResultType.Ok, pool.shuffle() if shuffle else pool.pick())
+        if varType is Commands:
+            return self.commands.get(varName)
+        if varType is Quotes:
+            return self.getQuote(varName)
+        return Result(ResultType.Error, f'{varType.__name__} cannot be read')
+
+
+    def getQuote(self, number):
+        logging.debug('db.getQuote')
+        if not number.isdigit():
+            return Result(ResultType.Error, f'Quote {number} is not a quote number')
+        quote = self.read().quote(int(number))
+        if quote is None:
+            return Result(ResultType.Error, f'Quote {number} not found in db.')
+        return Result(ResultType.Ok, quote)
+
+
+    # A quote picked at random, without reading every quote (see the storage's randomQuote)
+    def randomQuote(self):
+        logging.debug('db.randomQuote')
+        quote = self.read().randomQuote()
+        if quote is None:
+            return Result(ResultType.Error, 'There are no quotes yet.')
+        return Result(ResultType.Ok, quote)
+
+
+    # A random quote out of those containing every one of words.  With column='said_by', out of those said
+    #   by words instead.
+    def searchQuotes(self, words, column=None):
+        logging.debug('db.searchQuotes')
+        if not words.split():
+            return Result(ResultType.Error, 'Missing search words.')
+        numbers = self.read().findQuotes(words, column)
+        if not numbers:
+            return Result(ResultType.Error, f'No quotes found for {words}.')
+        return Result(ResultType.Ok, self.read().quote(choice(numbers)))
+
+
+    # The writes below update the in-memory registry and pools straight away and queue the database write
+    #   (see WriteQueue), so they return before anything is written.
+
+    # Sets a command's script, replaces all of a variable's values with value, or changes the text of the
+    #   quote numbered varName
+    def set(self, varType, varName, value, author=None):
+        logging.debug('db.set')
+        if varType is Commands:
+            self.commands.update(varName, value)
+            self.writes.put('upsertCommand', varName, value)
+        elif varType is Variables:
+            self.variables.replace(varName, [value])
+            self.writes.put('replaceVariable', varName, value, author, datetime.now())
+        elif varType is Quotes:
+            if not varName.isdigit():
+                return Result(ResultType.Error, f'Quote {varName} is not a quote number')
+            if self.read().quote(int(varName)) is None:
+                return Result(ResultType.Error, f'Quote {varName} not found in db.')
+            self.writes.put('editQuote', int(varName), value)
+        else:
+            return Result(ResultType.Error, f'{varType.__name__} cannot be set')
+        return Result(ResultType.Ok, value)
+
+
+    # Adds another value to a variable, or a new quote said by varName.  Commands only have the one script,
+    #   so adding one is the same as setting it.
+    def add(self, varType, varName, value, author=None):
+        logging.debug('db.add')
+        if varType is Variables:
+            self.variables.append(varName, value)
+            self.writes.put('addVariable', varName, value, author, datetime.now())
+        elif varType is Quotes:
+            self.writes.put('addQuote', value, varName, author or '', datetime.now())
         else:
-            randomResult = randint(0, len(results)-1)
+            return self.set(varType, varName, value, author)
+        return Result(ResultType.Ok, value)
 
-        result = results[randomResult][0]
-        return Result(ResultType.Ok, result)
 
+    def delete(self, varType, varName):
+        logging.debug('db.delete')
+        if varType is Commands:
+            if self.commands.get(varName).isError():
+                return Result(ResultType.Error, f'Command {varName} does not exist')
+            self.commands.invalidate(varName)
+            self.writes.put('deleteCommand', varName)
+        elif varType is Variables:
+            if not self.variables.pool(varName):
+                return Result(ResultType.Error, f'Variables error:  {varName} not found in db.')
+            self.variables.replace(varName, [])
+            self.writes.put('deleteVariable', varName)
+        elif varType is Quotes:
+            if not varName.isdigit():
+                return Result(ResultType.Error, f'Quote {varName} is not a quote number')
+            if self.read().quote(int(varName)) is None:
+                return Result(ResultType.Error, f'Quote {varName} not found in db.')
+            self.writes.put('deleteQuote', int(varName))
+        else:
+            return Result(ResultType.Error, f'{varType.__name__} cannot be deleted')
+        return Result(ResultType.Ok, varName)
 
-    def set(self, varType, varName, value):
-        logging.debug('db.set - pass')
-        pass
 
+# Awaitable front end for Database, used by the parser and plugins.  Anything that can be answered from
+#   the in-memory registry/pools is answered straight away; everything else runs on one dedicated thread
+#   so the event loop keeps reading and answering PINGs while SQLite works.  At most maxInFlight calls
+#   are queued for that thread at once; the rest wait their turn without blocking the loop.
+#   The sync Database stays available as .sync, e.g. for startup and tests.
+class AsyncDatabase:
+    def __init__(self, db, maxInFlight=32):
+        self.sync      = db
+        self.commands  = db.commands
+        self.variables = db.variables
+        self.executor  = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        self.inFlight  = asyncio.Semaphore(maxInFlight)
+        self.flushing  = None
 
-    def delete(self, varType, varName):
-        logging.debug('db.delete - pass')
-        pass
+
+    async def run(self, function, *args):
+        start = stats.start()
+        async with self.inFlight:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+        if start:
+            stats.stop('db ' + function.__name__, start)
+        return result
+
+
+    # Makes any writes still queued and closes the database before the thread is stopped
+    def close(self):
+        self.executor.submit(self.sync.close)
+        self.executor.shutdown(wait=True)
+
+
+    # Starts the countdown to the next flush, unless one is already running
+    def flushSoon(self):
+        if self.flushing is None:
+            self.flushing = asyncio.create_task(self.flushLater(), name='db-flush')
+
+
+    async def flushLater(self):
+        try:
+            await asyncio.sleep(writeDelay)
+        finally:
+            self.flushing = None
+        await self.run(self.sync.flush)
+
+
+    async def flush(self):
+        await self.run(self.sync.flush)
+
+
+    def getType(self, t):
+        return self.sync.getType(t)
+
+
+    @property
+    def generation(self):
+        return self.sync.generation
+
+
+    # Checks every checkInterval seconds whether another process has changed the database, and if so reloads
+    #   the caches the same way Database.refresh does.  The check and the reload run on the database thread;
+    #   only dropping the pools, which the event loop reads from, is done here.  Runs until cancelled.
+    async def watch(self):
+        while True:
+            await asyncio.sleep(checkInterval)
+            if not await self.run(self.sync.changed):
+                continue
+            logging.debug('db.watch - database changed; reloading caches')
+            self.variables.clear()
+            await self.run(self.commands.load)
+            self.sync.generation += 1
+
+
+    async def getScript(self, varName):
+        result = self.commands.peek(varName)
+        if result is None:
+            result = await self.run(self.sync.getScript, varName)
+        return result
+
+
+    async def exists(self, varType, varName):
+        if varType is Variables and self.variables.peek(varName.lower()) is not None:
+            return self.sync.exists(varType, varName)
+        return await self.run(self.sync.exists, varType, varName)
+
+
+    # Loads every one of names that isn't loaded already, in one query
+    async def loadVariables(self, names):
+        names = [name for name in names if self.variables.peek(name) is None]
+        if names:
+            await self.run(self.variables.load, names)
+
+
+    async def getAllResults(self, varType, varName):
+        return await self.run(self.sync.getAllResults, varType, varName)
+
+
+    async def get(self, varType, varName, shuffle=False):
+        if varType is Variables and self.variables.peek(varName) is not None:
+            return self.sync.get(varType, varName, shuffle)
+        return await self.run(self.sync.get, varType, varName, shuffle)
+
+
+    async def randomQuote(self):
+        return await self.run(self.sync.randomQuote)
+
+
+    async def searchQuotes(self, words, column=None):
+        return await self.run(self.sync.searchQuotes, words, column)
+
+
+    async def set(self, varType, varName, value, author=None):
+        result = await self.run(self.sync.set, varType, varName, value, author)
+        self.flushSoon()
+        return result
+
+
+    async def add(self, varType, varName, value, author=None):
+        result = await self.run(self.sync.add, varType, varName, value, author)
+        self.flushSoon()
+        return result
+
+
+    async def delete(self, varType, varName):
+        result = await self.run(self.sync.delete, varType, varName)
+        self.flushSoon()
+        return result
 
 
 if __name__ == '__main__':
@@ -0,0 +1,186 @@
+# irc.py:  Single pass parser for IRCv3 lines, straight from the socket.  parse() only splits the raw
+#          bytes into tags, prefix, command and parameters; each part is decoded when it is asked for, so
+#          lines that turn out to be uninteresting cost almost nothing, and lines nobody wants are dropped
+#          before they are split any further.  Only a PRIVMSG's channel, nick and text are decoded up front.
+#
+#          @tags :prefix COMMAND middle middle :trailing parameter\r\n
+
+from operator import itemgetter
+
+tag_escapes = {'\\:': ';', '\\s': ' ', '\\\\': '\\', '\\r': '\r', '\\n': '\n'}
+
+
+# A tuple, as that is quickest to build, so nothing is kept from one property to the next; each part is
+#   decoded every time it is asked for.  raw_tags and raw_prefix keep their leading @ and :, or are b'' if
+#   the line has none.
+class IRCMessage(tuple):
+    __slots__ = ()
+
+    raw        = property(itemgetter(0))
+    raw_tags   = property(itemgetter(1))
+    raw_prefix = property(itemgetter(2))
+    command    = property(itemgetter(3))
+    raw_params = property(itemgetter(4))
+
+
+    # The whole line, without \r\n
+    @property
+    def line(self):
+        return self.raw.rstrip(b'\r\n').decode('utf-8', 'replace')
+
+
+    @property
+    def tags(self):
+        tags = {}
+        if self.raw_tags:
+            for tag in self.raw_tags[1:].decode('utf-8', 'replace').split(';'):
+                key, _, value = tag.partition('=')
+                if '\\' in value:
+                    value = unescape(value)
+                tags[key] = value
+        return tags
+
+
+    @property
+    def prefix(self):
+        return self.raw_prefix[1:].decode('utf-8', 'replace')
+
+
+    # nick!user@host -> nick
+    @property
+    def nick(self):
+        return self.raw_prefix[1:].partition(b'!')[0].decode('utf-8', 'replace')
+
+
+    # Parameters before the trailing one, e.g. ['#channel'] for a PRIVMSG
+    @property
+    def middle(self):
+        return self.split_params()[0]
+
+
+    # The parameter after ' :', e.g. the chat text of a PRIVMSG.  None if there isn't one.
+    @property
+    def trailing(self):
+        trailing = self.split_params()[1]
+        return None if trailing is None else trailing.decode('utf-8', 'replace')
+
+
+    @property
+    def params(self):
+        middle, trailing = self.split_params()
+        if trailing is None:
+            return middle
+        return middle + [trailing.decode('utf-8', 'replace')]
+
+
+    # First parameter of a channel message without the '#', or '' if it wasn't sent to a channel
+    @property
+    def channel(self):
+        middle = self.split_params()[0]
+        if middle and middle[0][:1] == '#':
+            return middle[0][1:]
+        return ''
+
+
+    # The middle parameters, decoded, and the trailing one, still as bytes (or None if there isn't one)
+    def split_params(self):
+        params = self.raw_params
+        if params[-2:] == b'\r\n':
+            params = params[:-2]
+        if params[:1] == b':':
+            return [], params[1:]
+        middle, found, trailing = params.partition(b' :')
+        return middle.decode('utf-8', 'replace').split(), trailing if found else None
+
+
+def unescape(value):
+    output = []
+    position = 0
+    while position < len(value):
+        if value[position] == '\\':
+            pair = value[position:position+2]
+            output.append(tag_escapes.get(pair, pair[1:]))
+            position += 2
+        else:
+            output.append(value[position])
+            position += 1
+    return ''.join(output)
+
+
+# A PRIVMSG, with the channel, nick and text taken out of it as it is parsed, since they are always used
+class Privmsg(IRCMessage):
+    __slots__ = ()
+
+    channel  = property(itemgetter(5))
+    nick     = property(itemgetter(6))
+    trailing = property(itemgetter(7))
+
+
+# Returns parse(raw), which splits a raw line into its parts.  parse() returns None for lines with no command,
+#   and for lines the caller has no use for, before anything in them is decoded:
+#   commands = command names (as bytes) to keep, e.g. {b'PRIVMSG', b'PING'}.  None keeps every command.
+#   chat     = called with the text of each PRIVMSG, still as bytes with its \r\n; chat it returns False for
+#              is dropped.
+#   Command names, channels and nicks come up over and over, so each is only decoded the first time it is seen.
+def parser(commands=None, chat=None, max_nicks=4096):
+    names    = {}
+    channels = {}
+    nicks    = {}
+
+    def parse(raw):
+        # Lines nearly always come in one of these three shapes, each of which comes apart in a single split
+        try:
+            if raw[0] == 64:                # @tags :prefix COMMAND params
+                tags, prefix, command, params = raw.split(b' ', 3)
+                if prefix[0] != 58:
+                    tags, prefix, command, params = split(raw)
+            elif raw[0] == 58:              # :prefix COMMAND params
+                tags = b''
+                prefix, command, params = raw.split(b' ', 2)
+            else:                           # COMMAND params
+                tags = prefix = b''
+                command, params = raw.split(b' ', 1)
+        except (IndexError, ValueError):
+            tags, prefix, command, params = split(raw)
+            if not command:
+                return None
+
+        if command == b'PRIVMSG':
+            channel, found, text = params.partition(b' :')
+            if chat is not None and not (found and chat(text)):
+                return None
+            name = channels.get(channel) if found else None
+            if name is None and found and channel[:1] == b'#':
+                name = channels[channel] = channel[1:].decode('utf-8', 'replace')
+            if name is not None:
+                nick = nicks.get(prefix)
+                if nick is None:
+                    if len(nicks) >= max_nicks:
+                        nicks.clear()
+                    nick = nicks[prefix] = prefix[1:].partition(b'!')[0].decode('utf-8', 'replace')
+                return tuple.__new__(Privmsg, (raw, tags, prefix, 'PRIVMSG', params, name, nick,
+                                               text.rstrip(b'\r\n').decode('utf-8', 'replace')))
+        elif commands is not None and command not in commands:
+            return None
+        name = names.get(command)
+        if name is None:
+            name = names[command] = command.decode('ascii', 'replace')
+        return tuple.__new__(IRCMessage, (raw, tags, prefix, name, params))
+
+    return parse
+
+
+# Splits any other line, e.g. one with no parameters, into its tags, prefix, command and parameters
+def split(raw):
+    line = raw
+    tags = prefix = b''
+    if raw[:1] == b'@':
+        tags, _, line = raw.partition(b' ')
+    if line[:1] == b':':
+        prefix, _, line = line.partition(b' ')
+    command, _, params = line.partition(b' ')
+    return tags, prefix, command.rstrip(b'\r\n'), params
+
+
+# Keeps every line
+parse = parser()
@@ -0,0 +1,49 @@
+# logs.py:  Logging that stays off the event loop.  Log calls only put the record on a queue; a background
+#           thread formats it and writes it to a log file that rotates by size.  Debug records can be
+#           sampled, so full debug logging is cheap enough to leave on.
+
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+
+
+# Hands records to the background thread as they are.  The stock QueueHandler formats each message before
+#   queueing it, which would put the formatting back on the calling thread.
+class BackgroundHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Lets through 1 in every rate DEBUG records; anything above DEBUG always gets through
+class SampleFilter(logging.Filter):
+    def __init__(self, rate=1):
+        super().__init__()
+        self.rate  = rate
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 1:
+            return True
+        self.count += 1
+        return self.count % self.rate == 0
+
+
+# Sends all logging through a background thread to filename.  Returns the QueueListener, which needs
+#   stop() calling on shutdown so the last records are written, and the SampleFilter.
+def setup_logging(filename='twitch.log', level=logging.DEBUG, sample=1, max_bytes=10_000_000, backups=5):
+    file_handler = RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    queue = SimpleQueue()
+    listener = QueueListener(queue, file_handler)
+
+    sampler = SampleFilter(sample)
+    handler = BackgroundHandler(queue)
+    handler.addFilter(sampler)
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener.start()
+    return listener, sampler
@@ -0,0 +1,166 @@
+# outbox.py:  Rate limited queue for everything a plugin writes to its server.  Lines are sent in
+#             priority order (server replies such as PONG first, then moderator actions, then chat),
+#             chat is held back by token buckets for the connection and for each channel, and every
+#             write waits for the StreamWriter to drain so nothing piles up in its buffer.
+
+import asyncio
+from collections import deque
+from enum import Enum
+import logging
+from time import monotonic
+
+from stats import stats
+
+
+class Priority(Enum):
+    Server    = 0
+    Moderator = 1
+    Chat      = 2
+
+
+# Allows capacity sends every period seconds, refilling continuously
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate     = capacity / period
+        self.tokens   = capacity
+        self.updated  = monotonic()
+
+    # Seconds until a token is available; 0 if one is available now
+    def wait(self, now):
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, count=1):
+        self.tokens -= count
+
+
+class Outgoing:
+    __slots__ = ('line', 'channel', 'delayed')
+
+    def __init__(self, line, channel):
+        self.line    = line
+        self.channel = channel
+        self.delayed = False
+
+
+class Outbox:
+    # limit/period   = messages allowed per period seconds on the whole connection
+    # channelPeriod  = seconds between chat messages in one channel, or None for no per-channel limit
+    # maxsize        = most lines waiting per lane; Moderator and Chat lines past that are dropped
+    def __init__(self, writer, limit=20, period=30, channelPeriod=1, maxsize=100):
+        self.writer        = writer
+        self.connection    = TokenBucket(limit, period)
+        self.channelPeriod = channelPeriod
+        self.channels      = {}
+        self.lanes         = {priority: deque() for priority in Priority}
+        self.maxsize       = maxsize
+        self.wakeup        = asyncio.Event()
+        self.sent          = 0
+        self.dropped       = 0
+        self.delayed       = 0
+
+
+    # Queues line to be sent.  Returns False if it was dropped because its lane is full.
+    def put(self, line, priority=Priority.Chat, channel=None):
+        lane = self.lanes[priority]
+        if priority is not Priority.Server and len(lane) >= self.maxsize:
+            logging.debug('Outbox.put - %s lane full, dropping line', priority.name)
+            self.dropped += 1
+            return False
+        lane.append(Outgoing(line, channel))
+        self.wakeup.set()
+        return True
+
+
+    # Carries on with a new connection.  Lines still waiting are kept and sent on it, apart from server
+    #   lines (PONG, JOIN...), which only made sense on the old one.
+    def reconnect(self, writer):
+        self.writer = writer
+        self.lanes[Priority.Server].clear()
+        self.wakeup.set()
+
+
+    # Sends lines as the rate limits allow.  Runs until cancelled.
+    async def run(self):
+        logging.debug('Outbox.run')
+        while True:
+            outgoing, wait = self.next(monotonic())
+            if outgoing is not None:
+                await self.send(outgoing)
+                continue
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def send(self, outgoing):
+        self.sent += 1
+        if outgoing.delayed:
+            self.delayed += 1
+        start = stats.start()
+        self.writer.write(outgoing.line)
+        await self.writer.drain()
+        stats.stop('write', start)
+
+
+    # Returns the next line that may be sent now, or (None, seconds to wait before trying again)
+    def next(self, now):
+        if self.lanes[Priority.Server]:
+            return self.lanes[Priority.Server].popleft(), None
+
+        wait = None
+        for priority in (Priority.Moderator, Priority.Chat):
+            lane = self.lanes[priority]
+            if not lane:
+                continue
+            connection_wait = self.connection.wait(now)
+            if connection_wait:
+                for outgoing in lane:
+                    outgoing.delayed = True
+                return None, connection_wait
+
+            # Moderator actions are not held to the per-channel limit
+            if priority is Priority.Moderator or self.channelPeriod is None:
+                self.connection.take()
+                return lane.popleft(), None
+
+            # Skip past channels that are waiting, but never reorder lines within a channel
+            blocked = set()
+            for index, outgoing in enumerate(lane):
+                if outgoing.channel in blocked:
+                    continue
+                bucket = self.channel_bucket(outgoing.channel)
+                channel_wait = bucket.wait(now)
+                if channel_wait == 0:
+                    del lane[index]
+                    bucket.take()
+                    self.connection.take()
+                    return outgoing, None
+                outgoing.delayed = True
+                blocked.add(outgoing.channel)
+                wait = channel_wait if wait is None else min(wait, channel_wait)
+        return None, wait
+
+
+    def channel_bucket(self, channel):
+        bucket = self.channels.get(channel)
+        if bucket is None:
+            bucket = self.channels[channel] = TokenBucket(1, self.channelPeriod)
+        return bucket
+
+
+    def stats(self):
+        return {
+            'queued':  {priority.name: len(lane) for priority, lane in self.lanes.items()},
+            'sent':    self.sent,
+            'dropped': self.dropped,
+            'delayed': self.delayed
+        }
@@ -1,8 +1,96 @@
-from result import Result, ResultType
+import asyncio
+from contextvars import ContextVar
+import logging
+from time import monotonic
+
+from compiler import Literal, RenderCache, ScriptCache, maxDepth
+from db       import AsyncDatabase
+from result   import Result, ResultType
+from stats    import stats
+
+
+# Limits on a single Parser.process call, so that a script that loops or keeps growing (a variable can
+#   hold { } that expand again) can't hold up every other channel:
+#   maxSteps  = { } blocks evaluated
+#   maxOutput = characters in the output of any one { } block, or of the whole script
+#   maxTime   = seconds from the start of the script
+#   maxDepth  = values expanding values, e.g. a greeting containing {user} is 1 deep (see compiler.py)
+# Every yieldEvery steps, the script lets the rest of the event loop run.
+maxSteps   = 1000
+maxOutput  = 4000
+maxTime    = 1.0
+yieldEvery = 50
+
+# Side by side { } blocks that only read, e.g. {var greeting} {quote}, are evaluated at the same time, up to
+#   maxConcurrent of them at once.  Their output still comes out in the order they were written.
+maxConcurrent = 8
+
+
+class Budget:
+    __slots__ = ('steps', 'deadline')
+
+    def __init__(self, seconds):
+        self.steps    = 0
+        self.deadline = monotonic() + seconds
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+# What the parser is working on right now.  Each asyncio task gets its own copy, so several messages
+#   can be processed at the same time without seeing each other's bot or message.
+class Context:
+    __slots__ = ('bot', 'message', 'budget')
+
+    def __init__(self, bot, message, budget):
+        self.bot     = bot
+        self.message = message
+        self.budget  = budget
+
+
+context = ContextVar('context')
+
+
+# What the { } block being evaluated has depended on so far.  A block is pure if its output can only
+#   change when one of its inputs, e.g. (Variables, 'socials'), does:  it doesn't read the message, pick
+#   at random or change anything.  Pure output is kept in the parser's RenderCache.
+class Trace:
+    __slots__ = ('pure', 'inputs')
+
+    def __init__(self):
+        self.pure   = True
+        self.inputs = set()
+
+
+tracing = ContextVar('tracing', default=None)
+
 
 class Parser:
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, db, maxSteps=maxSteps, maxOutput=maxOutput, maxTime=maxTime, maxDepth=maxDepth, renderTTL=60,
+                 maxConcurrent=maxConcurrent):
+        # Tests hand in a plain Database; the parser itself always awaits the database
+        self.db = db if isinstance(db, AsyncDatabase) else AsyncDatabase(db)
+        self.maxSteps      = maxSteps
+        self.maxOutput     = maxOutput
+        self.maxTime       = maxTime
+        self.maxDepth      = maxDepth
+        self.maxConcurrent = maxConcurrent
+        self.scripts    = ScriptCache()
+        # Values with { } in them, compiled as they are expanded.  Kept apart from scripts, so that a variable
+        #   with many different values can't push busy commands out of the cache.
+        self.values     = ScriptCache()
+        self.rendered   = RenderCache(ttl=renderTTL)
+        self.generation = self.db.generation
+        # Builtins that can be pure.  Any other builtin makes the block it is in impure.  Of these, var,
+        #   command and quote are only pure for a get or an exists (see pureSubCommands and getCommand).
+        self.pureBuiltins    = {'command', 'if', 'quote', 'var'}
+        self.pureSubCommands = {'get', 'exists'}
+        # Builtins that never wait on anything, so there is nothing to gain from running them alongside
+        #   others.  if is run in order too; its own condition and branch are evaluated concurrently inside.
+        self.inlineBuiltins   = {'1', 'channel', 'if', 'sender', 'user'}
+        self.writeBuiltins    = {'join', 'part'}
+        self.writeSubCommands = {'set', 'add', 'edit', 'delete', 'unset', 'remove'}
         self.builtinCommands = {
             '1'              : self.getUserVarCommand1,
             'channel'        : self.getChannelCommand,
@@ -24,99 +112,268 @@ class Parser:
             'delete':  self.deleteCommand,
             'unset':   self.deleteCommand,
             'remove':  self.deleteCommand,
-            'exists':  self.existsCommand
+            'exists':  self.existsCommand,
+            'shuffle': self.shuffleCommand
             }
 
+    @property
+    def bot(self):
+        return context.get().bot
+
+
+    @property
+    def message(self):
+        return context.get().message
+
+
     async def process(self, bot, message, script=None):
-        self.bot = bot
-        self.message = message
-        
         if script is None:
-            return self.message
+            return message
+        context.set(Context(bot, message, Budget(self.maxTime)))
         
-        processed_script = script
-        subcommand = self.findSubcommand(processed_script)
-        while (not subcommand.isError()) and (subcommand.getResult() is not None):
-            # Ssend to the script to the appropriate command function to resolve
-            #   Remove the surrounding brackets first
-            start, end = subcommand.getResult()
-            result = await self.processCommand(processed_script[start+1:end])
-            if result.isError():
-                return f'Error: {result.getError()}'
-            if start == 0:
-                processed_script = result.getResult() + processed_script[end+1:]
-            else:
-                processed_script = processed_script[:start] + result.getResult() + processed_script[end+1:]
-            subcommand = self.findSubcommand(processed_script)
+        start = stats.start()
+        # Output kept from before another process changed the database may be out of date (see db.refresh)
+        if self.db.generation != self.generation:
+            self.generation = self.db.generation
+            self.rendered.clear()
+        rendered = self.rendered.get(('script', script))
+        if rendered is not None:
+            stats.count('render cache', 'hit')
+            result = Result(ResultType.Ok, rendered[0])
+        else:
+            result = await self.render(message, script)
+        stats.stop('evaluate', start)
 
-        if subcommand.isOk():
-            message.response = processed_script
+        if result.isOk():
+            message.response = result.getResult()
             message.send_to_server = True
         else:
-            message.response = f'Error: {subcommand.getError()}'
+            message.response = f'Error: {result.getError()}'
         return message
 
 
-    # Finds first subcommand in script and returns start and end.  This does not process the subcommand at all.
-    #   If there are no subcommands, return None
-    def findSubcommand(self, script):
-        # If there are no subcommands, return Okay, but none.
-        if script.find('{') == -1:
-            return Result(ResultType.Ok, None)
-
-        start = script.find('{')
-        nextstart = start
-        nextend = script.find('}', nextstart + 1)
-        end = nextend
-        depth = 0
-
-        #Cycle through until we have found the full depth.  Return breaks the loop.
-        while True:
-            # nextend should never = -1 until depth = 1 again, which point we return, so it should never = 1
-            #    at the point this if statement is evaluated
-            if nextend == -1:
-                return Result(ResultType.Error, "# opening brackets does not match # closing brackets")
-            # if nextstart > nextend, we have completed a subcommnand.  Decrease depth by 1
-            elif nextstart > nextend or nextstart == -1:
-                end = nextend
-                nextstart = script.find('{', nextend)
-                nextend   = script.find('}', nextend+1)
-                depth    -= 1
-                # If we're back to depth == 1, we have found a full subcommand.
-                if depth == 0:
-                    return Result(ResultType.Ok, (start, end))
-            # if nextstart < nextend, we have a subcommand within a subcommand.  Increase depth by 1
-            elif nextstart < nextend:
-                nextend   = script.find('}', nextstart)
-                nextstart = script.find('{', nextstart+1)
-                depth    += 1
-
-            if depth > 10:
-                return Result(ResultType.Error, "depth is wrong")
+    # Compiles and evaluates a whole script, keeping the output if the script turns out to be pure
+    async def render(self, message, script):
+        compiled = self.scripts.get(message.command, script)
+        if compiled.isError():
+            return compiled
+        await self.prefetch(compiled.getResult())
+        trace = Trace()
+        token = tracing.set(trace)
+        try:
+            result = await self.evaluate(compiled.getResult().nodes)
+        except BudgetExceeded as limit:
+            logging.warning('Parser.process - %s stopped: %s', message.command, limit)
+            stats.count('script stopped', message.command)
+            return Result(ResultType.Error, f'Script stopped: {limit}')
+        finally:
+            tracing.reset(token)
+        if result.isOk() and trace.pure:
+            self.rendered.put(('script', script), result.getResult(), frozenset(trace.inputs))
+        return result
+
 
-    
-    async def processSubcommand(self, script):
-        command = script
-        while True:
-            subcommand = self.findSubcommand(command)
-            if subcommand.isError():
-                return subcommand
-            if subcommand.getResult() is None:
-                return Result(ResultType.Ok, command)
-            start, end = subcommand.getResult()
-            result = await self.processCommand(command[start+1:end])
+    # Walks a list of compiled nodes and joins their output together.  Runs of blocks that only read are
+    #   evaluated concurrently (see evaluateTogether); everything else, in order.  Raises BudgetExceeded
+    #   when the script goes over one of its limits, which process() turns into an error for the whole script.
+    async def evaluate(self, nodes, depth=0):
+        output = []
+        size   = 0
+        index  = 0
+        while index < len(nodes):
+            node = nodes[index]
+            end  = self.independent(nodes, index)
+            if end > index:
+                result = await self.evaluateTogether(nodes[index:end], depth)
+                if result.isError():
+                    return result
+                texts = result.getResult()
+                index = end
+            elif type(node) is Literal:
+                texts = (node.text,)
+                index += 1
+            else:
+                result = await self.evaluateCall(node, depth)
+                if result.isError():
+                    return result
+                texts = (result.getResult(),)
+                index += 1
+            for text in texts:
+                size += len(text)
+                if size > self.maxOutput:
+                    raise BudgetExceeded(f'output longer than {self.maxOutput} characters')
+                output.append(text)
+        return Result(ResultType.Ok, ''.join(output))
+
+
+    # Where the run of nodes starting at index that can be evaluated concurrently ends:  blocks that only read,
+    #   and the text between them.  Returns index if there are fewer than two such blocks there.
+    def independent(self, nodes, index):
+        calls = 0
+        end   = index
+        for position in range(index, len(nodes)):
+            node = nodes[position]
+            if type(node) is Literal:
+                continue
+            if node.concurrent is None:
+                node.concurrent = node.name not in self.inlineBuiltins and not self.writes(node)
+            if not node.concurrent:
+                break
+            calls += 1
+            end    = position + 1
+        return end if calls > 1 else index
+
+
+    # Whether call, or any block inside it, could change something, e.g. {var set ...} or {join}.  Those
+    #   have to stay in order with the blocks around them.  A subcommand made by a block, e.g. {var {1} x},
+    #   can't be known until it runs, so it counts as a change.
+    def writes(self, call):
+        stack = [call]
+        while stack:
+            node = stack.pop()
+            if type(node) is Literal:
+                continue
+            if node.name is None or node.name not in self.builtinCommands or node.name in self.writeBuiltins:
+                return True
+            if node.name in ('command', 'quote', 'var') and len(node.words) > 1:
+                if node.words[1] in self.writeSubCommands or node.words[1][:1] == '{':
+                    return True
+            stack.extend(node.args)
+        return False
+
+
+    # Evaluates the blocks in nodes at the same time, maxConcurrent at a time, and returns their output and
+    #   the text between them in the order they were written.  If any fail, the first to fail in that order
+    #   is returned.  Each block runs in its own task, with a copy of the context that still points at the
+    #   same budget and at the Trace of the block around them, so what they depend on is merged as usual.
+    async def evaluateTogether(self, nodes, depth):
+        calls   = [node for node in nodes if type(node) is not Literal]
+        results = []
+        for start in range(0, len(calls), self.maxConcurrent):
+            tasks = [asyncio.ensure_future(self.evaluateCall(call, depth))
+                     for call in calls[start:start + self.maxConcurrent]]
+            try:
+                results += await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+            if any(result.isError() for result in results):
+                break
+
+        texts   = []
+        results = iter(results)
+        for node in nodes:
+            if type(node) is Literal:
+                texts.append(node.text)
+                continue
+            result = next(results)
             if result.isError():
                 return result
-            command = command[:start] + result.getResult() + command[end+1:]
-            command = command.strip()
-            return Result(ResultType.Ok, command)
+            texts.append(result.getResult())
+        return Result(ResultType.Ok, texts)
+
+
+    # Evaluates a single { } block, or takes its output from the RenderCache if it is pure and was evaluated
+    #   before.  Either way, what it depended on is passed up to the block around it.
+    async def evaluateCall(self, call, depth):
+        outer    = tracing.get()
+        rendered = self.rendered.get(('call', call.source))
+        if rendered is not None:
+            if outer is not None:
+                outer.inputs |= rendered[1]
+            return Result(ResultType.Ok, rendered[0])
+
+        await self.spend()
+        trace = Trace()
+        token = tracing.set(trace)
+        try:
+            result = await self.processCommand(call, depth)
+        finally:
+            tracing.reset(token)
+        if result.isOk() and trace.pure:
+            self.rendered.put(('call', call.source), result.getResult(), frozenset(trace.inputs))
+        if outer is not None:
+            outer.pure = outer.pure and trace.pure
+            outer.inputs |= trace.inputs
+        return result
 
 
-    async def processCommand(self, script):
-        command = script.split()[0]
-        if command not in self.builtinCommands.keys():
-            return Result(ResultType.Error, f'{command} is not a valid command.')
-        result = await self.builtinCommands[command](script)
+    # Loads every variable the script reads, e.g. greeting and howareyou in {var greeting} {var howareyou},
+    #   in one query before it runs, so that each {var} is then answered from memory
+    async def prefetch(self, script):
+        if script.variables is None:
+            script.variables = self.readsVariables(script.nodes)
+        if script.variables:
+            await self.db.loadVariables(script.variables)
+
+
+    # Names of the variables read by {var name}, {var get name}, {var shuffle name} or {var exists name}
+    #   anywhere in nodes, including inside other blocks.  Names made by a block, e.g. {var {1}}, are only
+    #   known once the script runs, so those are left to be loaded when they are used.
+    def readsVariables(self, nodes):
+        names = set()
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if type(node) is Literal:
+                continue
+            stack.extend(node.args)
+            if node.name != 'var' or node.dynamic or len(node.words) < 2:
+                continue
+            if node.words[1] not in self.subCommands:
+                names.add(node.words[1].lower())
+            elif node.words[1] in ('get', 'shuffle', 'exists') and len(node.words) > 2:
+                names.add(node.words[2].lower())
+        return frozenset(names)
+
+
+    # Marks the { } block being evaluated as impure, e.g. because it read the message or picked at random
+    def impure(self):
+        trace = tracing.get()
+        if trace is not None:
+            trace.pure = False
+
+
+    def dependsOn(self, varType, varName):
+        trace = tracing.get()
+        if trace is not None:
+            trace.inputs.add((varType, varName))
+
+
+    # Counts one step against the script's budget
+    async def spend(self):
+        budget = context.get().budget
+        budget.steps += 1
+        if budget.steps > self.maxSteps:
+            raise BudgetExceeded(f'more than {self.maxSteps} steps')
+        if monotonic() > budget.deadline:
+            raise BudgetExceeded(f'took longer than {self.maxTime} seconds')
+        if budget.steps % yieldEvery == 0:
+            await asyncio.sleep(0)
+
+
+    async def processCommand(self, call, depth=0):
+        if call.name not in self.builtinCommands.keys():
+            return Result(ResultType.Error, f'{call.name} is not a valid command.')
+        if call.name not in self.pureBuiltins:
+            self.impure()
+        start = stats.start()
+        result = await self.builtinCommands[call.name](call, depth)
+        if start:
+            stats.stop('builtin ' + call.name, start)
+        if result.isError():
+            return result
+
+        # Values can contain { } of their own, e.g. a greeting that includes {user}.  Expand those too.
+        if '{' in result.getResult():
+            if depth >= self.maxDepth:
+                raise BudgetExceeded(f'values nested more than {self.maxDepth} deep')
+            compiled = self.values.get(None, result.getResult())
+            if compiled.isError():
+                return compiled
+            await self.prefetch(compiled.getResult())
+            result = await self.evaluate(compiled.getResult().nodes, depth + 1)
         return result
     
 
@@ -127,88 +384,117 @@ class Parser:
     # up to first pipe = condition to process
     # between first & second pipe = command if condition is true
     # after second pipe = command if condition is false
-    async def ifCommand(self, script):
-        result = script
-        variables = []
+    async def ifCommand(self, call, depth):
+        branches = call.branches()
+        if len(branches) < 3:
+            return Result(ResultType.Error, 'if requires a condition, a true command and a false command')
 
-        variables = script.split('|')
-        # Remove if statement from condition
-        variables[0] = variables[0][3:]
-        
-        # clean up any leading/trailing whitespaces
-        for variable in variables:
-            variable = variable.strip()
-
-        condition = await self.processSubcommand(variables[0])
+        condition = await self.evaluate(branches[0], depth)
         if condition.isError():
             return condition
 
-        if condition.getResult() == 'True':
-            command = variables[1]
-        elif condition.getResult() == 'False':
-            command = variables[2]
+        # Only the branch that is chosen gets evaluated
+        if condition.getResult().strip() == 'True':
+            command = branches[1]
+        elif condition.getResult().strip() == 'False':
+            command = branches[2]
         else:
-            return Result(ResultType.Error, f'condition {condition.getResult()} is neither True nor False')
+            return Result(ResultType.Error, f'condition {condition.getResult().strip()} is neither True nor False')
 
-        result = await self.processSubcommand(command)
-        return result
+        result = await self.evaluate(command, depth)
+        if result.isError():
+            return result
+        return Result(ResultType.Ok, result.getResult().strip())
 
 
-    async def getUserVarCommand1(self, message):
-        variables = message.originaltext.split()
-        return variables[1]
+    async def getUserVarCommand1(self, call, depth):
+        variables = self.message.text.split()
+        if len(variables) < 2:
+            return Result(ResultType.Error, 'Missing first parameter.')
+        return Result(ResultType.Ok, variables[1])
 
 
     # This function is when a person uses the 'var' command
-    async def varCommand(self, script):
+    async def varCommand(self, call, depth):
         dbType = self.db.getType('variables')
         if dbType.isError():
             return dbType
+        if len(call.words) < 2:
+            return Result(ResultType.Error, f'Missing variable name.')
         # Check to see if second word is a db subCommand, e.g. add, remove, exists, etc.
         #    If so, call the appropriate function
-        if script.split()[1] in self.subCommands.keys():
-            subcommand = script.split()[1]
-            result = await self.subCommands.get(subcommand)(dbType.getResult(), script)
+        if call.words[1] in self.subCommands.keys():
+            subcommand = call.words[1]
+            if subcommand not in self.pureSubCommands:
+                self.impure()
+            result = await self.subCommands.get(subcommand)(dbType.getResult(), call, depth)
 
         # Otherwise, assume the second word is the varName that the user is attempting to get.
         else:
-            result = await self.getCommand(dbType.getResult(), script)
+            result = await self.getCommand(dbType.getResult(), call, depth)
         return result
 
 
     # This function is when a person uses the 'command' command
-    async def builtInCommand(self, script):
-        #return await self.getsetCommand(self.db.getType('commands'), script)
+    async def builtInCommand(self, call, depth):
         dbType = self.db.getType('commands')
-        if dbType.isError:
+        if dbType.isError():
             return dbType
-        return await self.getsetCommand(dbType.getResult(), script)
+        return await self.getsetCommand(dbType.getResult(), call, depth)
 
 
     # This function is when a person uses the 'quote' command
-    async def quoteCommand(self, script):
-        #return await self.getsetCommand(self.db.getType('quotes'), script)
+    #   {quote add text} records a quote said in this channel; {quote 12} (or {quote #12}), {quote edit 12 text}
+    #   and {quote delete 12} work on quote number 12.  {quote} on its own picks one at random,
+    #   {quote search words} one containing all of words and {quote by name} one said by name.
+    async def quoteCommand(self, call, depth):
         dbType = self.db.getType('quotes')
-        if dbType.isError:
+        if dbType.isError():
             return dbType
-        return await self.getsetCommand(dbType.getResult(), script)
-
-
-
-    async def getVarName(self, script):
+        if len(call.words) < 2:
+            self.impure()
+            return await self.db.randomQuote()
+        if call.words[1] == 'add':
+            self.impure()
+            parts = call.source.split(None, 2)
+            if len(parts) < 3:
+                return Result(ResultType.Error, 'Missing quote text.')
+            result = await self.db.add(dbType.getResult(), self.message.channel, parts[2], self.message.author)
+            if result.isError():
+                return result
+            # The new quote's number is only given out once the write is made, so anything made from any
+            #   quote, e.g. {quote exists 5}, is thrown away
+            self.rendered.invalidateType(dbType.getResult())
+            return Result(ResultType.Ok, 'Quote added.')
+        if call.words[1] in ('search', 'by'):
+            self.impure()
+            if call.dynamic:
+                words = await self.evaluate(call.args, depth)
+                if words.isError():
+                    return words
+                words = words.getResult().split(None, 1)[1:]
+            else:
+                words = call.source.split(None, 2)[2:]
+            if not words:
+                return Result(ResultType.Error, 'Missing search words.')
+            if call.words[1] == 'by':
+                return await self.db.searchQuotes(words[0].lstrip('@'), 'said_by')
+            return await self.db.searchQuotes(words[0])
+        return await self.getsetCommand(dbType.getResult(), call, depth)
+
+
+    # The name is never more than two words in, so only those are evaluated.  Anything after them, e.g. the
+    #   value in {var set name value}, is left for the subcommand.
+    async def getVarName(self, call, depth):
         # Check to see if there are any subcommands.  if so, process them.
-        command = script
-        subcommands = self.findSubcommand(command)
-        if subcommands.isError():
-            return subcommands
-        if subcommands.getResult() is not None:
-            start, end = subcommands.getResult()
-            result = await self.processSubcommand(command)
+        if call.dynamic:
+            result = await self.evaluate(call.head()[0], depth)
             if result.isError():
                 return result
-            command = result.getResult()
-        
-        command_parts = command.split()
+            command_parts = [call.name] + result.getResult().split()
+        else:
+            command_parts = call.words
+
         if len(command_parts) < 2:
             return Result(ResultType.Error, f'Missing variable name.')
 
@@ -219,90 +505,110 @@ class Parser:
         return Result(ResultType.Ok, command)
 
 
-    async def getCommand(self, varType, script):
-        varNameResult = await self.getVarName(script)
+    async def getCommand(self, varType, call, depth, shuffle=False):
+        varNameResult = await self.getVarName(call, depth)
         if varNameResult.isError():
-            return varName
-
-        varName = varNameResult.getResult().lower()
-        if self.db.exists(varType, varName):
-            return self.db.get(varType, varName)
-        return Result(ResultType.Error, f'{varType} {varName} not found!')
+            return varNameResult
+
+        varName = self.normalName(varType, varNameResult.getResult())
+        result = await self.db.get(varType, varName, shuffle)
+        self.dependsOn(varType, varName)
+        # A variable with more than one value is picked from at random
+        if varType is self.db.getType('variables').getResult():
+            pool = self.db.variables.peek(varName)
+            if pool is None or len(pool) != 1:
+                self.impure()
+        if result.isOk():
+            return result
+        return Result(ResultType.Error, f'{varType.__name__} {varName} not found!')
         
 
-    async def setCommand(self, varType, script):
-        varName = await self.getVarName(script)
+    # Same as get, but cycles through every value before repeating one, e.g. {var shuffle greeting}
+    async def shuffleCommand(self, varType, call, depth):
+        return await self.getCommand(varType, call, depth, shuffle=True)
+
+
+    # {var set name value} replaces all of name's values with value; {var add name value} adds another one.
+    #   The value is stored as written, { } and all, so that it is expanded each time it is used.
+    async def setCommand(self, varType, call, depth):
+        varName = await self.getVarName(call, depth)
         if varName.isError():
             return varName
-        self.db.set(varType, varName, ' '.join(parts[3:]))
-        check = self.db.get(varType, varName)
-        if check.isOk():
-            if check.getValue() == ' '.join(parts[3:]):
-                return Result(ResultType.Ok, varType + ' ' + varName + ' succesfully set.')
-        return Result(ResultType.Error, f'{varType} {varName} was not successfully set.')
+        varName = self.normalName(varType, varName.getResult())
+        value   = call.head()[1]
+        if not value:
+            return Result(ResultType.Error, f'Missing value for {varType.__name__} {varName}.')
 
+        if call.words[1] == 'add':
+            result = await self.db.add(varType, varName, value, self.message.author)
+        else:
+            result = await self.db.set(varType, varName, value, self.message.author)
+        if result.isError():
+            return result
+        self.invalidate(varType, varName)
+        return Result(ResultType.Ok, f'{varType.__name__} {varName} successfully set.')
 
-    async def deleteCommand(self, varType, script):
-        pass
+
+    async def deleteCommand(self, varType, call, depth):
+        varName = await self.getVarName(call, depth)
+        if varName.isError():
+            return varName
+        varName = self.normalName(varType, varName.getResult())
+        result = await self.db.delete(varType, varName)
+        if result.isError():
+            return result
+        self.invalidate(varType, varName)
+        return Result(ResultType.Ok, f'{varType.__name__} {varName} successfully deleted.')
 
 
-    async def existsCommand(self, varType, script):
-        varName = await self.getVarName(script)
+    async def existsCommand(self, varType, call, depth):
+        varName = await self.getVarName(call, depth)
         if varName.isError():
             return varName
-        return self.db.exists(varType, varName.getResult())
+        varName = self.normalName(varType, varName.getResult())
+        self.dependsOn(varType, varName)
+        return await self.db.exists(varType, varName)
 
 
-    async def getsetCommand(self, varType, script):
-        parts = script.split()
+    async def getsetCommand(self, varType, call, depth):
+        parts = call.words
 
         # For the variable name, we need to process any { }
         if varType is None:
             return Result(ResultType.Error, f'Variable Type {varType} is not recognized.') 
-        
-        # Subcommand = get, set, add, edit, delete, etc.
-        # Set varName to parts[2], since most of the following use parts[2].  If not there, then
-        #     try parts[1] as varName
-        if len(parts) == 2:
-            subcommand = None
-            varName = parts[1]
-        else:
-            subcommand = parts[1]
-            varName = parts[2]
-
-        # Check to see if user made a command w/o a subcommand, e.g. {var greeting}.
-        #    If so, assume the user is attempting to get the variable/command/etc.
-        if subcommand is None:
-            if self.db.exists(varType, varName):
-                result = self.db.get(varType, varName)
-                return result
-            return Result(ResultType.Error, f'Cannot retrieve {varName} from database')
-
-        if subcommand == 'get':
-            if self.db.exists(varType, varName):
-                return self.db.get(varType, varName)
-            return Result(ResultType.Error, f'{varType} {varName} not found!')
-
-        # For setting a variable, we don't want to process any { }.  We want to store those
-        if subcommand == 'set' or parts[1] == 'add' or parts[1] == 'edit':
-            self.db.set(varType, varName, ' '.join(parts[3:]))
-            check = self.db.get(varType, varName)
-            if check.isOk():
-                if check.getValue() == ' '.join(parts[3:]):
-                    return Result(ResultType.Ok, varType + ' ' + varName + ' succesfully set.')
-            return Result(ResultType.Error, f'{varType} {varName} was not successfully set.')
-
-        if subcommand == 'delete' or parts[1] == 'unset' or parts[1] == 'remove':
-            self.db.delete(varType, varName)
-
-        if subcommand == 'exists':
-            return self.db.exists(varType, varName)
-
-
-
-    # script sent only to match the same parameters as the others in the dictionary (see __init__)
-    #   It is not actually used.
-    async def userCommand(self, script):
+        if len(parts) < 2:
+            return Result(ResultType.Error, f'Missing {varType.__name__} name.')
+
+        # Subcommand = get, set, add, edit, delete, etc.  Without one, e.g. {command hello}, assume the user
+        #    is attempting to get the command/quote/etc.
+        if len(parts) > 2 and parts[1] in self.subCommands:
+            if parts[1] not in self.pureSubCommands:
+                self.impure()
+            return await self.subCommands[parts[1]](varType, call, depth)
+        return await self.getCommand(varType, call, depth)
+
+
+    # Variable names are not case sensitive; command names are.  Quote numbers can be written as #12.
+    def normalName(self, varType, varName):
+        if varType is self.db.getType('variables').getResult():
+            return varName.lower()
+        if varType is self.db.getType('quotes').getResult():
+            return varName.lstrip('#')
+        return varName
+
+
+    # The database keeps its own registry and pools up to date as it writes.  The compiled copy of a
+    #   command's script and any output made from what changed are the parser's own, so those are
+    #   thrown away here.
+    def invalidate(self, varType, varName):
+        if varType is self.db.getType('commands').getResult():
+            self.scripts.invalidate(varName)
+        self.rendered.invalidate((varType, varName))
+
+
+    # call and depth sent only to match the same parameters as the others in the dictionary (see __init__)
+    #   They are not actually used.
+    async def userCommand(self, call, depth):
         words = self.message.text.split()
         if len(words) > 1:
             user = words[1]
@@ -316,31 +622,31 @@ class Parser:
         return Result(ResultType.Ok, response)
 
 
-    async def senderCommand(self, message):
-        return message.author
+    async def senderCommand(self, call, depth):
+        return Result(ResultType.Ok, self.message.author)
         
 
 
-    async def getChannelCommand(self, script):
-        user = await self.userCommand(script)
+    async def getChannelCommand(self, call, depth):
+        user = await self.userCommand(call, depth)
         if user.isError():
             return user
         return Result(ResultType.Ok, 'https://twitch.tv/' + user.getResult())
 
 
-    async def joinCommand(self, message):
-        parts = message.text.split()
+    async def joinCommand(self, call, depth):
+        parts = self.message.text.split()
         if(len(parts) > 1):
-            await self.bot.join_channels(parts[1:])
+            await self.bot.join_channels(parts[1:], self.message.platform)
             channels = ' '.join(parts[1:])
             return Result(ResultType.Ok, f'Successfully joined channels {channels}')
         return Result(ResultType.Error, 'Please include channel name(s) in !join command')
 
 
-    async def partCommand(self, message):
-        parts = message.text.split()
+    async def partCommand(self, call, depth):
+        parts = self.message.text.split()
         if(len(parts) > 1):
-            await self.bot.part_channels(parts[1:])
+            await self.bot.part_channels(parts[1:], self.message.platform)
             channels = ' '.join(parts[1:])
             return Result(ResultType.Ok, f'Successfully parted channels {channels}')
         return Result(ResultType.Error, 'Please include channel name(s) in !part command')
@@ -1,5 +1,6 @@
 from datetime import datetime
 from enum import Enum
+from time import monotonic, time
 
 
 class MessageType(Enum):
@@ -8,30 +9,65 @@ class MessageType(Enum):
     Private = 'Private'
 
 
+# Wall clock time at monotonic() == 0, for turning Message.received back into a datetime
+monotonic_epoch = time() - monotonic()
+
+
+# One message from (or to) a platform.  Built for every line the server sends, so it is kept small:
+#   received  = monotonic() when the message was built; timestamp is worked out from it when asked for
+#   raw       = the line exactly as it arrived, as bytes.  If no text is given, text is decoded from raw
+#               the first time it is used, so lines nobody reads are never decoded.  Keeping raw adds no
+#               copy; it is the same bytes object the platform read.
 class Message:
+    __slots__ = ('message_type', 'platform', 'author', 'channel', 'received', '_timestamp', 'command',
+                 '_text', 'raw', 'to_user', 'response', 'send_to_server')
+
     def __init__(self,
                  message_type   = MessageType.Channel,
                  platform       = '',
                  author         = '',
                  channel        = '',
-                 timestamp      = datetime.now(),
+                 timestamp      = None,
                  command        = '',
-                 text           = '',
+                 text           = None,
                  to_user        = None,
                  response       = '',
-                 send_to_server = False
+                 send_to_server = False,
+                 raw            = None
                 ):
         self.message_type       = message_type
         self.platform           = platform
         self.author             = author
         self.channel            = channel
-        self.timestamp          = timestamp
+        self.received           = monotonic()
+        self._timestamp         = timestamp
         self.command            = command
-        self.text               = text
+        self._text              = text
+        self.raw                = raw
         self.to_user            = to_user
         self.response           = response
         self.send_to_server     = send_to_server
 
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            self._timestamp = datetime.fromtimestamp(monotonic_epoch + self.received)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.raw.rstrip(b'\r\n').decode('utf-8', 'replace') if self.raw is not None else ''
+        return self._text
+
+    @text.setter
+    def text(self, text):
+        self._text = text
+
 
 class Inbox:
     def __init__(self, bot):
@@ -54,5 +90,14 @@ class Plugin:
     def run(self):
         raise NotImplementedError
 
+    def stop(self):
+        raise NotImplementedError
+
     def say(self, response):
         raise NotImplementedError
+
+    async def join_channels(self, channels):
+        raise NotImplementedError
+
+    async def part_channels(self, channels):
+        raise NotImplementedError
@@ -1,135 +1,497 @@
 import asyncio
+from collections import Counter, deque
 import logging
-import socket
+from random import uniform
+import re
+from time import monotonic, perf_counter
 
+import irc
 import plugin
-from plugin import Message, MessageType
+from cooldowns import Cooldowns
+from outbox    import Outbox, Priority, TokenBucket
+from plugin    import Message, MessageType
+from scheduler import Scheduler
+from stats     import stats
 
 twitch_irc_url  = 'irc.chat.twitch.tv'
 twitch_irc_port = '6697'
+twitch_irc_ssl  = True
 
 twitch_ws_url   = 'wss://irc-ws.chat.twitch.tv'
 twitch_ws_port  = '443'
 
+# Chat messages allowed per 30 seconds on one connection, and the gap between messages in one channel.
+#   Moderators are allowed more, and are not held to the per-channel gap.
+twitch_rate_period    = 30
+twitch_rate_limit     = 20
+twitch_rate_limit_mod = 100
+twitch_channel_period = 1
+
+# The command name in a line of chat such as !so @someone
+command_word = re.compile(rb'!([^ \r\n]+)')
+
+# The IRC commands read() has a use for.  Unless filter-chat = false, every other line is dropped as it is read.
+twitch_handled_commands = {b'PRIVMSG', b'PING', b'RECONNECT', b'001', b'NOTICE'}
+
+# JOINs allowed per 10 seconds for the whole account, and how many channels to put on one connection
+twitch_join_period              = 10
+twitch_join_limit               = 20
+twitch_channels_per_connection  = 50
+
+# A connection that fails sooner than this after starting is treated as a failure of the whole plugin,
+#   so the supervisor's backoff applies instead of the channels being moved straight to a new connection
+twitch_min_uptime = 30
+
+# Seconds to wait before reconnecting a dropped connection.  Doubles (give or take half, so that every
+#   connection doesn't come back at the same moment) after each failed attempt, up to
+#   twitch_reconnect_delay_max, and starts over once a connection has stayed up for twitch_reconnect_reset.
+twitch_reconnect_delay     = 1
+twitch_reconnect_delay_max = 120
+twitch_reconnect_reset     = 60
+
+# Longest line Twitch accepts, without the \r\n
+twitch_max_line = 500
+
+
+class LoginFailed(Exception):
+    pass
+
+
+# JOIN lines for channels, as many channels to a line as fit, e.g. ['JOIN #a,#b,#c']
+def join_lines(channels):
+    lines = []
+    line  = ''
+    for channel in channels:
+        if line and len(line) + len(channel) + 2 > twitch_max_line:
+            lines.append(line)
+            line = ''
+        line = f'{line},#{channel}' if line else f'JOIN #{channel}'
+    if line:
+        lines.append(line)
+    return lines
+
 
 class Plugin(plugin.Plugin):
     def __init__(self, bot, settings):
         logging.debug('twitch.Plugin.__init__')
         self.inbox = asyncio.Queue()
-        self.irc = TwitchIRCBot(bot, settings)
+        self.irc = TwitchConnections(bot, settings)
         
     async def run(self):
         logging.debug('twitch.Plugin.run')
         await self.irc.run()
+
+    async def stop(self):
+        logging.debug('twitch.Plugin.stop')
+        await self.irc.stop()
+
+    async def join_channels(self, channels):
+        await self.irc.join_channels(channels)
+
+    async def part_channels(self, channels):
+        await self.irc.part_channels(channels)
+
+
+# Spreads the channels over as many TwitchIRCBot connections as it takes to keep each one under
+#   channels-per-connection, paces JOINs to Twitch's limit, and moves channels to another connection
+#   when theirs drops.
+class TwitchConnections:
+    def __init__(self, bot, settings):
+        logging.debug('TwitchConnections.__init__')
+        self.bot            = bot
+        self.settings       = settings
+        # Shared by every connection, so that cooldown-global covers all of them
+        self.cooldowns      = Cooldowns(settings)
+        self.per_connection = int(settings.get('channels-per-connection', twitch_channels_per_connection))
+        channels            = settings.get('channels', [])
+        if isinstance(channels, str):
+            channels = channels.split(',')
+        self.channels       = [channel.strip().lstrip('#').lower() for channel in channels if channel.strip()]
+        self.connections    = {}
+        self.assignments    = {}
+        self.joins          = deque()
+        self.join_wakeup    = None
+        self.join_bucket    = TokenBucket(twitch_join_limit, twitch_join_period)
+        self.failure        = None
+        self.count          = 0
+
+
+    async def run(self):
+        logging.debug('TwitchConnections.run')
+        self.join_wakeup = asyncio.Event()
+        self.failure     = asyncio.get_running_loop().create_future()
+        stats.register('twitch connections', self.stats)
+        await self.join_channels(self.channels)
+        pacer = asyncio.create_task(self.pace_joins(), name='twitch-joins')
+        try:
+            # Runs until cancelled, or until a connection fails too quickly (see twitch_min_uptime)
+            await self.failure
+        finally:
+            pacer.cancel()
+            await self.stop()
+
+
+    async def stop(self):
+        logging.debug('TwitchConnections.stop')
+        tasks = list(self.connections.values())
+        self.connections = {}
+        self.assignments = {}
+        self.joins.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    async def join_channels(self, channels):
+        for channel in channels:
+            channel = channel.lstrip('#').lower()
+            if channel in self.assignments:
+                continue
+            if channel not in self.channels:
+                self.channels.append(channel)
+            self.assignments[channel] = self.connection_for()
+            self.joins.append(channel)
+        if self.join_wakeup is not None:
+            self.join_wakeup.set()
+
+
+    async def part_channels(self, channels):
+        for channel in channels:
+            channel = channel.lstrip('#').lower()
+            if channel in self.channels:
+                self.channels.remove(channel)
+            connection = self.assignments.pop(channel, None)
+            if connection is not None and channel in connection.channels:
+                await connection.part(channel)
+
+
+    # The least busy connection with room for another channel, or a new one if they are all full
+    def connection_for(self):
+        load = Counter(self.assignments.values())
+        candidates = [connection for connection in self.connections if load[connection] < self.per_connection]
+        if candidates:
+            return min(candidates, key=lambda connection: load[connection])
+
+        self.count += 1
+        connection = TwitchIRCBot(self.bot, self.settings, f'twitch-{self.count}',
+                                  cooldowns=self.cooldowns, join_bucket=self.join_bucket)
+        task = asyncio.create_task(connection.run(), name=connection.name)
+        task.add_done_callback(lambda task: self.connection_lost(connection, task))
+        self.connections[connection] = task
+        return connection
+
+
+    # Sends the queued JOINs no faster than Twitch allows for the account, as many to a line as the
+    #   limit allows at the time.  Runs until cancelled.
+    async def pace_joins(self):
+        while True:
+            if not self.joins:
+                self.join_wakeup.clear()
+                await self.join_wakeup.wait()
+                continue
+            wait = self.join_bucket.wait(monotonic())
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            batches = {}
+            count   = int(self.join_bucket.tokens)
+            while self.joins and count:
+                channel    = self.joins.popleft()
+                connection = self.assignments.get(channel)
+                # Parted, or moved to another connection, while it was waiting
+                if connection is None or connection not in self.connections:
+                    continue
+                batches.setdefault(connection, []).append(channel)
+                count -= 1
+            for connection, channels in batches.items():
+                await connection.ready.wait()
+                self.join_bucket.take(len(channels))
+                await connection.join(channels)
+
+
+    def connection_lost(self, connection, task):
+        started = connection.started
+        if self.connections.pop(connection, None) is None:
+            return
+        channels = [channel for channel, owner in self.assignments.items() if owner is connection]
+        for channel in channels:
+            del self.assignments[channel]
+
+        error = None if task.cancelled() else task.exception()
+        if error is not None and (started is None or monotonic() - started < twitch_min_uptime):
+            if not self.failure.done():
+                self.failure.set_exception(error)
+            return
+        logging.warning('TwitchConnections - %s closed; moving %d channels', connection.name, len(channels))
+        asyncio.create_task(self.join_channels(channels))
+
+
+    def stats(self):
+        load = Counter(self.assignments.values())
+        return {connection.name: load[connection] for connection in self.connections} | {'joins queued': len(self.joins)}
     
     
 class TwitchIRCBot:
-    def __init__(self, bot, settings):
+    def __init__(self, bot, settings, name='twitch', cooldowns=None, join_bucket=None):
         logging.debug('TwitchIRCBot.__init__')
-        self.inbox        = None
-        self.outbox       = None
-        self.bot          = bot
-        self.settings     = settings
-        self.socket       = socket.socket()
-        self.workers      = []
-        self.keep_looping = True
+        self.name          = name
+        self.cooldowns     = cooldowns or Cooldowns(settings)
+        # Shared with the other connections by TwitchConnections, as Twitch's join limit is for the account
+        self.join_bucket   = join_bucket or TokenBucket(twitch_join_limit, twitch_join_period)
+        self.inbox         = None
+        self.input         = None
+        self.output        = None
+        self.outbox_task   = None
+        self.rejoin_task   = None
+        self.bot           = bot
+        self.settings      = settings
+        self.workers       = []
+        self.keep_looping  = True
+        self.reconnect_now = False
+        # Drop chat that can't run a command, and lines read() has no use for, as soon as they are read.
+        #   filter-chat = false keeps every line, so that chat is echoed to the console.
+        self.filter_chat   = settings.get('filter-chat', '').lower() != 'false'
+        self.parse         = irc.parser(twitch_handled_commands, self.could_run) if self.filter_chat else irc.parse
+        self.channels      = set()
+        self.ready         = asyncio.Event()
+        self.started       = None
+        # When the current connection attempt began, until Twitch welcomes us; see connected()
+        self.connecting    = None
+        self.time_to_ready = None
+        self.reconnects    = 0
+        # The outbox outlives each connection, so that lines sent while reconnecting go out once it's back
+        if settings.get('moderator', '').lower() == 'true':
+            self.outbox = Outbox(None, twitch_rate_limit_mod, twitch_rate_period, None)
+        else:
+            self.outbox = Outbox(None, twitch_rate_limit, twitch_rate_period, twitch_channel_period)
         
         
+    # Stays connected until cancelled, reconnecting with jittered exponential backoff whenever the
+    #   connection drops, or straight away if Twitch asks with RECONNECT.  Only a failed login ends it.
     async def run(self):
         logging.debug('TwitchIRCBot.run')
-        await self.start()
-        await self.loop()
-        await self.stop()
+        # Messages for the same channel are processed in order; different channels run side by side
+        self.inbox = Scheduler(self.process, workers=int(self.settings.get('workers', 4)))
+        self.inbox.start()
+        stats.register(f'{self.name} inbox', self.inbox.stats)
+        stats.register(f'{self.name} outbox', self.outbox.stats)
+        stats.register(f'{self.name} connection', self.connection_stats)
+        delay = twitch_reconnect_delay
+        try:
+            while self.keep_looping:
+                connected = monotonic()
+                try:
+                    await self.start()
+                    await self.read()
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as error:
+                    logging.warning('TwitchIRCBot.run - %s connection lost: %r', self.name, error)
+                finally:
+                    await self.stop()
+
+                if self.reconnect_now or monotonic() - connected > twitch_reconnect_reset:
+                    delay = twitch_reconnect_delay
+                wait = 0 if self.reconnect_now else delay * uniform(0.5, 1.5)
+                self.reconnect_now = False
+                print(f'{self.name}: reconnecting in {wait:.1f} seconds')
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, twitch_reconnect_delay_max)
+                self.reconnects += 1
+        finally:
+            # process() releases the duplicate claims of what it handles, but not of what it never got to
+            for message in await self.inbox.stop():
+                self.release_duplicate(message)
         
         
+    # Connects and logs in.  CAP, PASS, NICK and as many JOINs for the channels this connection had before
+    #   as the join limit allows all go out in a single write, without waiting for replies in between.
     async def start(self):
         logging.debug('TwitchIRCBot.start')
         print('Connecting to Twitch...')
-        
+        self.connecting = perf_counter()
         self.input, self.output = await asyncio.open_connection(twitch_irc_url,
                                                                 twitch_irc_port,
-                                                                ssl=True)
+                                                                ssl=twitch_irc_ssl)
         username    = self.settings['botnick']
         oauth_token = self.settings['oauth-token']
-        channels    = self.settings['channels'].split(',')
-        await self.send_server(f'PASS {oauth_token}')
-        await self.send_server(f'NICK {username}')
+        lines       = ['CAP REQ :twitch.tv/tags twitch.tv/commands', f'PASS {oauth_token}', f'NICK {username}']
+        rejoin      = sorted(self.channels)
+        count       = self.joinable(len(rejoin))
+        lines      += join_lines(rejoin[:count])
+        self.output.write(''.join(f'{line}\r\n' for line in lines).encode())
+        await self.output.drain()
         print('Connected.')
 
+        self.outbox.reconnect(self.output)
+        self.outbox_task = asyncio.create_task(self.outbox.run(), name=f'{self.name}-outbox')
+        if count < len(rejoin):
+            self.rejoin_task = asyncio.create_task(self.rejoin(rejoin[count:]), name=f'{self.name}-rejoin')
+        self.started = monotonic()
+        self.ready.set()
+
+
+    # Twitch has welcomed us (001), so the connection is ready for use
+    def connected(self):
+        self.time_to_ready = perf_counter() - self.connecting
+        logging.info('TwitchIRCBot - %s ready in %.3f seconds', self.name, self.time_to_ready)
+        print(f'{self.name}: ready in {self.time_to_ready:.3f} seconds')
+
+
+    # How many of count channels can be joined right now.  Those tokens are taken from the join limit.
+    def joinable(self, count):
+        if not count or self.join_bucket.wait(monotonic()):
+            return 0
+        count = min(count, int(self.join_bucket.tokens))
+        self.join_bucket.take(count)
+        return count
+
+
+    # Joins the rest of the channels after a reconnect, as fast as the join limit allows
+    async def rejoin(self, channels):
+        while channels:
+            count = self.joinable(len(channels))
+            if not count:
+                await asyncio.sleep(self.join_bucket.wait(monotonic()))
+                continue
+            await self.join(channels[:count], greet=False)
+            channels = channels[count:]
+
+
+    # Sends the JOINs straight away; the caller keeps them within Twitch's join limit.  This is
+    #   TwitchConnections when first joining, or rejoin() after a reconnect.
+    async def join(self, channels, greet=True):
         for channel in channels:
             print(f'  Joining #{channel}')
-            await self.send_server(f'JOIN #{channel}')
-            await self.send_to_channel(Message( channel        = channel,
-                                                response       = 'The eagle has landed.',
-                                                send_to_server = True
-                                              )
-                                      )
+        self.channels.update(channels)
+        for line in join_lines(channels):
+            await self.send_server(line)
+        if greet:
+            for channel in channels:
+                await self.send_to_channel(Message( channel        = channel,
+                                                    response       = 'The eagle has landed.',
+                                                    send_to_server = True
+                                                  )
+                                          )
+
+
+    async def part(self, channel):
+        print(f'  Parting #{channel}')
+        self.channels.discard(channel)
+        await self.send_server(f'PART #{channel}')
         
         
+    # Closes the connection.  The outbox keeps anything still waiting for the next one.
     async def stop(self):
-        logging.debug('TwitchIRCBot.start')
-        self.socket.close()
-        
+        logging.debug('TwitchIRCBot.stop')
+        self.ready.clear()
+        tasks = [task for task in (self.outbox_task, self.rejoin_task) if task is not None]
+        self.outbox_task = self.rejoin_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
 
-    async def loop(self):
-        logging.debug('TwitchIRCBot.loop')
-        self.inbox   = asyncio.Queue(maxsize=1)
-        self.outbox  = asyncio.Queue(maxsize=1)
-        read_task    = asyncio.create_task(self.read(),    name='read')
-        process_task = asyncio.create_task(self.process(), name='process')
-        #write_task   = asyncio.create_task(self.write(),   name='write')
-        await asyncio.gather(read_task, process_task, write_task)
+    def connection_stats(self):
+        return {
+            'connected':      self.ready.is_set(),
+            'channels':       len(self.channels),
+            'reconnects':     self.reconnects,
+            'time to ready':  self.time_to_ready
+        }
 
 
-    # This looks for anything that comes in from the server and puts it into the inbox
+    # This looks for anything that comes in from the server and puts it into the inbox.  Returns when
+    #   Twitch closes the connection or asks for a reconnect.
     async def read(self):
         logging.debug('TwitchIRCBot.read started')
         while self.keep_looping:
+            logging.debug('TwitchIRCBot.read - waiting for message')
             try:
-                logging.debug('TwitchIRCBot.read - waiting for message')
                 message = await self.input.readuntil(b'\r\n')
-                if message:
-                    logging.debug('TwitchIRCBot.read - Message received from Twitch.  Adding to Inbox')
-                    await self.inbox.put(message)
-                    #new_message = asyncio.create_task(self.process(), name='process')
-                else:
-                    self.keep_looking = False
-            except asyncio.exceptions.CancelledError:
-                pass
-            message = None
+            except asyncio.IncompleteReadError:
+                logging.info('TwitchIRCBot.read - %s closed by Twitch', self.name)
+                break
+            logging.debug('TwitchIRCBot.read - Message received from Twitch.  Adding to Inbox')
+            start = stats.start()
+            message = self.parse(message)
+            if message is None:
+                stats.stop('dropped', start)
+                continue
+            stats.stop('parse', start)
+            # Lines about the connection itself are dealt with here rather than in the inbox
+            if message.command == 'RECONNECT':
+                logging.info('TwitchIRCBot.read - %s asked to reconnect', self.name)
+                self.reconnect_now = True
+                break
+            if message.command == '001':
+                self.connected()
+            elif message.command == 'NOTICE' and b'authentication failed' in message.raw_params:
+                raise LoginFailed(message.line)
+            # The same command in the same channel is only handled once at a time; repeats are dropped
+            duplicate = self.duplicate_key(message)
+            if duplicate is not None and not self.cooldowns.claim(duplicate):
+                stats.stop('dropped', start)
+                continue
+            # Keeps each channel's messages in order.  Server messages (PING, etc.) share ''.
+            try:
+                await self.inbox.submit(message.channel, message)
+            except BaseException:
+                self.release_duplicate(message)
+                raise
+            stats.stop('read', start)
         logging.debug('TwitchIRCBot.read shutting down')
 
 
-    # This looks for messages in the inbox (from any source) and processes them
-    #    then calls for them to be written.
-    async def process(self):
-        logging.debug('TwitchIRCBot.process started.')
-        while self.keep_looping:
-            try:
-                unprocessed_message = await self.inbox.get()
-                logging.debug('TwitchIRCBot.process - Message received from Inbox')
-                if unprocessed_message:
-                    processed_message = await self.create_message(unprocessed_message)
-                    logging.debug('TwitchIRCBot.process - Message processed; time to write!')
-                    await self.write(processed_message)
-                    #await self.outbox.put(processed_message)
-                self.inbox.task_done()
-            except asyncio.exceptions.CancelledError:
-                pass
-            unprocessed_message = None
-        logging.debug('TwitchIRCBot.process shutting down')
-
-
-    # This looks for messages in the outbox and prints/sends them as appropriate.
+    # False for the text of a line of chat that can't run a command, which most chat can't.  text is still
+    #   the raw bytes, e.g. b'!so @someone\r\n'.
+    def could_run(self, text):
+        word = command_word.match(text)
+        return word is not None and self.bot.db.commands.mightExist(word[1])
+
+
+    # Processes a single message from the inbox, then calls for it to be written.
+    #    Called by the inbox's workers, so several of these can be running at once.
+    async def process(self, unprocessed_message):
+        logging.debug('TwitchIRCBot.process - Message received from Inbox')
+        try:
+            processed_message = await self.create_message(unprocessed_message)
+            logging.debug('TwitchIRCBot.process - Message processed; time to write!')
+            await self.write(processed_message)
+        finally:
+            self.release_duplicate(unprocessed_message)
+
+
+    # For a command, the channel and text as they arrived (e.g. b'#jazzyeagle :!hype\r\n'), which is the
+    #   same for every copy of it.  None for anything else.
+    def duplicate_key(self, message):
+        if message is None or message.command != 'PRIVMSG' or b' :!' not in message.raw_params:
+            return None
+        return message.raw_params
+
+
+    # Lets the next copy of message be handled, once this one has been or never will be
+    def release_duplicate(self, message):
+        duplicate = self.duplicate_key(message)
+        if duplicate is not None:
+            self.cooldowns.release(duplicate)
+
+
+    # This prints processed messages and passes anything to be sent on to the outbox.
     async def write(self, message):
         if message is not None:
-            logging.debug(f'TwitchIRCBot.write "{message.text}"')
-            if 'PASS' in message.text:
+            # Server lines (PING, JOIN, ROOMSTATE...) are only logged, so they are only decoded if the log is written
+            if message.message_type == MessageType.Server:
+                logging.debug('TwitchIRCBot.write %r', message.raw)
+            elif 'PASS' in message.text:
                 print('< PASS ********')
             else:
+                logging.debug('TwitchIRCBot.write "%s"', message.text)
                 print(f'> {message.text}')
 
-            if message.text == 'PING :tmi.twitch.tv':
+            if message.message_type == MessageType.Server and message.command == 'PING':
                 print('< PONG :tmi.twitch.tv')
                 await self.send_server('PONG :tmi.twitch.tv')
             else:
@@ -144,72 +506,78 @@ class TwitchIRCBot:
                         await self.send_to_user(message)
                     else:
                         print(f'Invalid MessageType: {message.message_type}')
-        #self.outbox.task_done()
             
 
-    async def send_server(self, message):
+    # Lines are queued on the outbox, which sends them as Twitch's rate limits allow
+    async def send_server(self, message, priority=Priority.Server, channel=None):
         logging.debug('TwitchIRCBot.send_server')
-        self.output.write(f'{message}\r\n'.encode())
+        self.outbox.put(f'{message}\r\n'.encode(), priority, channel)
         
     
     async def send_to_user(self, message):
         logging.debug('TwitchIRCBot.send_to_user')
-        await self.send_server(f'PRIVMSG {message.author} :{message.response}')
+        await self.send_server(f'PRIVMSG {message.author} :{message.response}', Priority.Chat)
         
     
     async def send_to_channel(self, message):
         logging.debug('TwitchIRCBot.send_to_channel')
-        await self.send_server(f'PRIVMSG #{message.channel} :{message.response}')
+        # Responses such as /timeout or /ban are moderator actions and go ahead of ordinary chat
+        if message.response[:1] in ('/', '.'):
+            priority = Priority.Moderator
+        else:
+            priority = Priority.Chat
+        await self.send_server(f'PRIVMSG #{message.channel} :{message.response}', priority, message.channel)
         
 
+    # unprocessed_message is an irc.IRCMessage, which has only been split into its parts, not decoded
     async def create_message(self, unprocessed_message):
         logging.debug('TwitchIRCBot.create_message')
-        # decode from bytestring to string
-        unprocessed_message = unprocessed_message.decode()
-        # remove '\r\n'
-        unprocessed_message = unprocessed_message[:len(unprocessed_message)-2]
-        
-
         # For now, only process messages sent to a channel or via whisper by looking for PRIVMSG
-        if 'PRIVMSG' in unprocessed_message:
+        if unprocessed_message.command == 'PRIVMSG':
             processed_message = await self.process_PRIVMSG(unprocessed_message)
         else:
             processed_message = Message(
                                          message_type = MessageType.Server,
-                                         text         = unprocessed_message,
+                                         command      = unprocessed_message.command,
+                                         raw          = unprocessed_message.raw,
                                        )
         return processed_message
     
         
     async def process_PRIVMSG(self, unprocessed_message):
         logging.debug('TwitchIRCBot.process_PRIVMSG')
-        if '#' in unprocessed_message:
-            message_type  = MessageType.Channel
-            channel_start = unprocessed_message.find('#') + 1
-            channel_end   = unprocessed_message.find(' ', channel_start)
-            channel       = unprocessed_message[channel_start:channel_end].strip()
+        channel = unprocessed_message.channel
+        if channel:
+            message_type = MessageType.Channel
         else:
             message_type = MessageType.Private
-            channel      = ''
-        author_start     = 1
-        author_end       = unprocessed_message.find('!', author_start)
-        author           = unprocessed_message[author_start:author_end].strip()
-        
-        text_start       = unprocessed_message.find(':', channel_end) + 1
-        text             = unprocessed_message[text_start:]
+        author           = unprocessed_message.nick
+        text             = unprocessed_message.trailing or ''
+        stats.count('channel', channel)
         
-        if text[0] == '!':
+        if text[:1] == '!':
             command_end  = text.find(' ')
             command = text[1:].strip() if command_end == -1 else text[1:command_end].strip()
-            script       = self.bot.db.getScript(command).getResultOrError()
+            # Unknown !words are not answered; the registry remembers them so floods stay cheap
+            start        = stats.start()
+            script       = (await self.bot.db.getScript(command)).getResult()
+            stats.stop('command lookup', start)
+            if script is not None:
+                stats.count('command', command)
+                # A command still cooling down is treated like any other chat
+                if not self.cooldowns.allow(channel, author, command):
+                    script = None
         else:
+            command      = ''
             script       = None
         message = Message (
                             message_type = message_type,
                             platform     = 'Twitch',
                             author       = author,
                             channel      = channel,
+                            command      = command,
                             text         = text,
+                            raw          = unprocessed_message.raw,
                           )
         processed_message = await self.bot.parser.process(self.bot, message, script)
         return processed_message
@@ -0,0 +1,96 @@
+# scheduler.py:  Runs incoming work on a pool of worker tasks.  Work is submitted with a key, e.g. the
+#                channel a message came from.  Work with the same key is handled one at a time, in the
+#                order it arrived, while work with different keys is handled in parallel.  A slow command
+#                in one channel therefore only holds up that channel.
+
+import asyncio
+from collections import deque
+import logging
+from time import monotonic
+
+from stats import stats
+
+
+class Scheduler:
+    # handler = coroutine function called with each submitted item
+    # maxsize = most items waiting at once; submit() waits for room after that
+    def __init__(self, handler, workers=4, maxsize=1000):
+        self.handler   = handler
+        self.workers   = workers
+        self.queues    = {}
+        self.ready     = asyncio.Queue()
+        self.room      = asyncio.Semaphore(maxsize)
+        self.pending   = 0
+        self.tasks     = []
+        self.started   = None
+        self.busy      = [0.0] * workers
+        self.processed = [0] * workers
+
+
+    def start(self):
+        logging.debug('Scheduler.start')
+        self.started = monotonic()
+        self.tasks = [asyncio.create_task(self.work(number), name=f'worker-{number}')
+                      for number in range(self.workers)]
+
+
+    # Cancels the workers.  Returns the items that were still waiting, which are never handled.
+    async def stop(self):
+        logging.debug('Scheduler.stop')
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        dropped = [item for queue in self.queues.values() for item, queued in queue]
+        for item in dropped:
+            self.pending -= 1
+            self.room.release()
+        self.queues.clear()
+        self.ready = asyncio.Queue()
+        return dropped
+
+
+    async def submit(self, key, item):
+        await self.room.acquire()
+        self.pending += 1
+        # A key is in self.queues while it is waiting for, or being handled by, a worker
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.ready.put_nowait(key)
+        queue.append((item, stats.start()))
+
+
+    async def work(self, number):
+        while True:
+            key   = await self.ready.get()
+            queue = self.queues[key]
+            item, queued = queue.popleft()
+            stats.stop('inbox wait', queued)
+            start = monotonic()
+            try:
+                await self.handler(item)
+            except Exception:
+                logging.exception('Scheduler worker-%d failed handling %r', number, key)
+            finally:
+                self.busy[number]      += monotonic() - start
+                self.processed[number] += 1
+                self.pending           -= 1
+                self.room.release()
+                # Go to the back of the line so that every key gets a turn
+                if queue:
+                    self.ready.put_nowait(key)
+                else:
+                    del self.queues[key]
+
+
+    # Queue depth and how busy each worker has been since start()
+    def stats(self):
+        elapsed = max(monotonic() - self.started, 1e-9) if self.started else 0
+        return {
+            'pending':  self.pending,
+            'keys':     len(self.queues),
+            'workers':  [{'processed':   self.processed[number],
+                          'utilization': self.busy[number] / elapsed if elapsed else 0.0}
+                         for number in range(self.workers)]
+        }
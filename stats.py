@@ -0,0 +1,154 @@
+# stats.py:  Latency histograms and counters for the message pipeline.  Turned off by default; while off,
+#            start() returns 0 and stop() returns straight away, so the timing calls left in the hot
+#            path cost next to nothing.
+#
+#            start = stats.start()
+#            ...
+#            stats.stop('parse', start)
+
+import asyncio
+from collections import Counter
+import logging
+from time import perf_counter_ns
+
+
+# Counts of durations in power-of-two buckets of microseconds:  bucket n holds durations under 2**n us
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 40
+        self.count   = 0
+        self.total   = 0
+        self.max     = 0
+
+    def add(self, nanoseconds):
+        microseconds = nanoseconds // 1000
+        self.buckets[min(microseconds.bit_length(), 39)] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+
+    def merge(self, other):
+        for bucket, count in enumerate(other.buckets):
+            self.buckets[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max    = max(self.max, other.max)
+
+    # Upper bound, in microseconds, of the bucket holding the given fraction of durations
+    def percentile(self, fraction):
+        target = self.count * fraction
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and seen:
+                return 2 ** bucket
+        return 0
+
+
+class Stats:
+    def __init__(self):
+        self.enabled    = False
+        self.histograms = {}
+        self.counters   = {}
+        self.sources    = {}
+
+
+    def start(self):
+        if self.enabled:
+            return perf_counter_ns()
+        return 0
+
+
+    def stop(self, stage, start):
+        if not start:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.add(perf_counter_ns() - start)
+
+
+    # e.g. count('command', 'hello') or count('channel', 'jazzyeagle')
+    def count(self, kind, key):
+        if not self.enabled:
+            return
+        counter = self.counters.get(kind)
+        if counter is None:
+            counter = self.counters[kind] = Counter()
+        counter[key] += 1
+
+
+    # source is called for its current figures each time a report is made, e.g. Scheduler.stats
+    def register(self, name, source):
+        self.sources[name] = source
+
+
+    def reset(self):
+        self.histograms = {}
+        self.counters   = {}
+
+
+    # Everything recorded so far, in a form that can be sent to another process and merged into its Stats
+    def snapshot(self):
+        return {
+            'histograms':  self.histograms,
+            'counters':    self.counters,
+            'sources':     {name: source() for name, source in self.sources.items()}
+        }
+
+
+    # Adds a snapshot() from elsewhere to these figures.  Its sources are reported under prefix + name.
+    def merge(self, snapshot, prefix=''):
+        for stage, histogram in snapshot['histograms'].items():
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].merge(histogram)
+        for kind, counter in snapshot['counters'].items():
+            if kind not in self.counters:
+                self.counters[kind] = Counter()
+            self.counters[kind].update(counter)
+        for name, figures in snapshot['sources'].items():
+            self.sources[prefix + name] = lambda figures=figures: figures
+
+
+    def report(self, top=10):
+        lines = [f'{"stage":<28} {"count":>9} {"mean us":>9} {"p50 us":>9} {"p95 us":>9} {"p99 us":>9} {"max us":>9}']
+        for stage in sorted(self.histograms):
+            histogram = self.histograms[stage]
+            lines.append(f'{stage:<28} {histogram.count:>9} {histogram.total // max(histogram.count, 1) // 1000:>9} '
+                         f'{histogram.percentile(0.5):>9} {histogram.percentile(0.95):>9} '
+                         f'{histogram.percentile(0.99):>9} {histogram.max // 1000:>9}')
+        for kind in sorted(self.counters):
+            lines.append('')
+            lines.append(f'{kind}:')
+            for key, count in self.counters[kind].most_common(top):
+                lines.append(f'  {key:<26} {count:>9}')
+        for name, source in sorted(self.sources.items()):
+            lines.append('')
+            lines.append(f'{name}: {source()}')
+        return '\n'.join(lines) + '\n'
+
+
+    # Writes the report to the log every interval seconds.  Runs until cancelled.
+    async def dump(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logging.info('stats\n%s', self.report())
+
+
+    # Serves the report to anything that connects to host:port, e.g. nc localhost 8125
+    async def serve(self, port, host='127.0.0.1'):
+        async def send_report(reader, writer):
+            writer.write(self.report().encode())
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(send_report, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+stats = Stats()
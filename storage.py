@@ -0,0 +1,534 @@
+# storage.py:  The tables, and the backends Database keeps them in.  Database only ever talks to one of these:
+#              sqlite  = SQLStorage, SQLite through SQLAlchemy.  The bot's normal database file.
+#              memory  = MemoryStorage, dicts and lists in this process, with the same behaviour.  For tests,
+#                        benchmarks, bots that don't need to keep anything, and channels too busy to wait on
+#                        SQLite.  Nothing is kept once the bot stops, unless it is saved to a snapshot.
+#
+#              Either can be filled from a snapshot file and saved to one (see Storage.load and Storage.save).
+#              A snapshot is JSON with a list of rows for each table, e.g.
+#              {"Commands": [{"name": "hello", "script": "Hi {user}!"}], "Variables": [...]}
+
+from sqlalchemy import create_engine, delete, event, func, select, text, update
+from sqlalchemy import Column, DateTime, Integer, String
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy.pool import QueuePool
+
+from datetime import datetime
+import json
+import logging
+from random import choice, randint
+import re
+
+BaseClass = declarative_base()
+
+# Seconds a connection waits for another connection (or another worker process) to finish writing
+busyTimeout = 30
+
+# Kept in SQLite's user_version.  Bump it whenever the tables change, so that existing databases get
+#   create_all run on them once; otherwise startup skips it.
+schemaVersion = 2
+
+# Random quote numbers tried before settling for the quote after one (see SQLStorage.randomQuote)
+randomQuoteTries = 5
+
+# Full-text index over the quote text and who said it, for {quote search ...} and {quote by ...}.  It is an
+#   external content table, so the text is not stored twice; the triggers keep it in step with Quotes on every
+#   insert, update and delete, however the row was written.
+quoteSearchSchema = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS QuotesSearch USING fts5(quote, said_by, content='Quotes', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS QuotesSearchInsert AFTER INSERT ON Quotes BEGIN
+           INSERT INTO QuotesSearch(rowid, quote, said_by) VALUES (new.id, new.quote, new.said_by);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS QuotesSearchDelete AFTER DELETE ON Quotes BEGIN
+           INSERT INTO QuotesSearch(QuotesSearch, rowid, quote, said_by) VALUES ('delete', old.id, old.quote, old.said_by);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS QuotesSearchUpdate AFTER UPDATE ON Quotes BEGIN
+           INSERT INTO QuotesSearch(QuotesSearch, rowid, quote, said_by) VALUES ('delete', old.id, old.quote, old.said_by);
+           INSERT INTO QuotesSearch(rowid, quote, said_by) VALUES (new.id, new.quote, new.said_by);
+       END''',
+    # Indexes any quotes that were added before the index existed
+    "INSERT INTO QuotesSearch(QuotesSearch) VALUES ('rebuild')",
+]
+
+# Words as FTS5's default tokenizer sees them:  runs of letters and digits
+words = re.compile(r'[^\W_]+')
+
+
+class Commands(BaseClass):
+    __tablename__ = 'Commands'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    script = Column(String, nullable=False)
+    frequency = Column(Integer, nullable=False, default=0)
+    user_level = Column(String)
+
+
+class ConnectionSettings(BaseClass):
+    __tablename__ = 'ConnectionSettings'
+    id = Column(Integer, primary_key=True)
+    platform = Column(String, nullable=False)
+    field = Column(String, nullable=False)
+    value = Column(String)
+
+
+class Variables(BaseClass):
+    __tablename__ = 'Variables'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    value = Column(String, nullable=False)
+    on_date = Column(DateTime, default=datetime.now())
+    added_by = Column(String)
+
+
+class Quotes(BaseClass):
+    __tablename__ = 'Quotes'
+    id = Column(Integer, primary_key=True)
+    quote = Column(String, nullable=False)
+    on_date = Column(DateTime, nullable=False, default=datetime.now())
+    said_by = Column(String, nullable=False)
+    recorded_by = Column(String, nullable=False)
+
+
+# The tables a snapshot can hold, by name
+snapshotTables = {table.__tablename__: table for table in (Commands, ConnectionSettings, Variables, Quotes)}
+
+
+# What every backend provides.  Reads are answered straight away.  Writes come in batches from
+#   db.WriteQueue as (operation, arguments), where operation is the name of one of the write methods below,
+#   e.g. ('addQuote', (quote, said_by, recorded_by, on_date)).
+class Storage:
+    def close(self):
+        pass
+
+    # A number that changes whenever anything other than write(), e.g. another process, commits a change.
+    #   None if nothing else can change the storage.
+    def version(self):
+        return None
+
+    # Makes every write in batch, in order.  Raises if the batch could not be made.
+    def write(self, batch):
+        raise NotImplementedError
+
+    # {name: script} for every command
+    def commands(self):
+        raise NotImplementedError
+
+    # One command's script, or None
+    def script(self, name):
+        raise NotImplementedError
+
+    # [(platform, field, value)] for every connection setting, in the order they were added
+    def settings(self):
+        raise NotImplementedError
+
+    # {name: [value, ...]} for each of names that has any values
+    def values(self, names):
+        raise NotImplementedError
+
+    # The text of quote number, or None
+    def quote(self, number):
+        raise NotImplementedError
+
+    # The text of a quote picked at random, or None if there are no quotes
+    def randomQuote(self):
+        raise NotImplementedError
+
+    # Numbers of the quotes containing every word in search; with column='said_by', said by them instead
+    def findQuotes(self, search, column=None):
+        raise NotImplementedError
+
+    # Every row of table, as {column: value}
+    def rows(self, table):
+        raise NotImplementedError
+
+    # Replaces everything in table with rows
+    def replaceRows(self, table, rows):
+        raise NotImplementedError
+
+
+    # Replaces the tables in the snapshot file at path with the rows it holds.  Tables the snapshot
+    #   leaves out are left as they are.
+    def load(self, path):
+        logging.info('storage.load %s', path)
+        with open(path) as snapshotFile:
+            snapshot = json.load(snapshotFile)
+        for name, rows in snapshot.items():
+            if name not in snapshotTables:
+                raise ValueError(f'{path}: {name} is not a table')
+            table = snapshotTables[name]
+            self.replaceRows(table, [readRow(table, row) for row in rows])
+
+
+    def save(self, path):
+        logging.info('storage.save %s', path)
+        snapshot = {name: [{column: value.isoformat() if isinstance(value, datetime) else value
+                            for column, value in row.items()} for row in self.rows(table)]
+                    for name, table in snapshotTables.items()}
+        with open(path, 'w') as snapshotFile:
+            json.dump(snapshot, snapshotFile, indent=1)
+
+
+# A row from a snapshot, with every column filled in:  dates are turned back into datetimes, and columns
+#   left out get their default
+def readRow(table, row):
+    values = {}
+    for column in table.__table__.columns:
+        value = row.get(column.name)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        if isinstance(value, str) and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        values[column.name] = value
+    return values
+
+
+# WAL lets worker processes keep reading while one of them writes, instead of every reader waiting on the lock
+def setPragmas(connection, record):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # In WAL mode this is still safe against corruption; a power cut can only lose the last few commits
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+class SQLStorage(Storage):
+    def __init__(self, path_to_db='chatbot.db'):
+        logging.debug('storage.SQLStorage sqlite+pysqlite:///%s', path_to_db)
+        self.engine = create_engine("sqlite+pysqlite:///" + path_to_db, future=True, poolclass=QueuePool,
+                                    connect_args={'timeout': busyTimeout})
+        event.listen(self.engine, 'connect', setPragmas)
+        self.writer = None
+        self.createSchema()
+
+
+    def createSchema(self):
+        with self.engine.connect() as connection:
+            if connection.execute(text('PRAGMA user_version')).scalar() == schemaVersion:
+                return
+        logging.info('storage.createSchema - updating to version %d', schemaVersion)
+        BaseClass.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            for statement in quoteSearchSchema:
+                connection.execute(text(statement))
+            connection.execute(text(f'PRAGMA user_version = {schemaVersion}'))
+
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.engine.dispose()
+
+
+    # The connection every write() is made on, opened the first time it is needed
+    def connection(self):
+        if self.writer is None:
+            self.writer = self.engine.connect()
+        return self.writer
+
+
+    # PRAGMA data_version is read on the connection write() uses.  A connection's own commits don't change
+    #   it, so only commits made anywhere else do.
+    def version(self):
+        connection = self.connection()
+        with connection.begin():
+            return connection.exec_driver_sql('PRAGMA data_version').scalar()
+
+
+    # The whole batch is one transaction
+    def write(self, batch):
+        with Session(self.connection()) as session, session.begin():
+            for operation, arguments in batch:
+                getattr(self, operation)(session, *arguments)
+
+
+    def commands(self):
+        with Session(self.engine) as session:
+            return dict(session.execute(select(Commands.name, Commands.script)).all())
+
+
+    def script(self, name):
+        with Session(self.engine) as session:
+            return session.execute(select(Commands.script).where(Commands.name == name)).scalar()
+
+
+    def settings(self):
+        with Session(self.engine) as session:
+            return [tuple(row) for row in session.execute(select(ConnectionSettings.platform, ConnectionSettings.field,
+                                                                 ConnectionSettings.value)
+                                                          .order_by(ConnectionSettings.id))]
+
+
+    def values(self, names):
+        values = {}
+        with Session(self.engine) as session:
+            for name, value in session.execute(select(Variables.name, Variables.value)
+                                               .where(Variables.name.in_(names))):
+                values.setdefault(name, []).append(value)
+        return values
+
+
+    def quote(self, number):
+        with Session(self.engine) as session:
+            quote = session.get(Quotes, number)
+            return None if quote is None else quote.quote
+
+
+    # Quote numbers run from 1 up to the highest, with gaps where quotes were deleted.  Numbers are picked
+    #   at random until one is a quote, which is a uniform pick.  If every try lands in a gap, the first quote
+    #   after the last number is taken, which favours quotes that follow a gap.  Every lookup goes straight
+    #   to the primary key, so the table is never scanned.
+    def randomQuote(self):
+        with Session(self.engine) as session:
+            highest = session.execute(select(func.max(Quotes.id))).scalar()
+            if highest is None:
+                return None
+            for attempt in range(randomQuoteTries):
+                number = randint(1, highest)
+                quote  = session.get(Quotes, number)
+                if quote is not None:
+                    return quote.quote
+            return session.execute(select(Quotes.quote).where(Quotes.id >= number)
+                                   .order_by(Quotes.id).limit(1)).scalar()
+
+
+    # Each word is matched as written, so chat can't use FTS5's own query syntax
+    def findQuotes(self, search, column=None):
+        terms = ' '.join('"' + word.replace('"', '""') + '"' for word in search.split())
+        if column is not None:
+            terms = f'{column} : ({terms})'
+        with Session(self.engine) as session:
+            return session.execute(text('SELECT rowid FROM QuotesSearch WHERE QuotesSearch MATCH :terms'),
+                                   {'terms': terms}).scalars().all()
+
+
+    def rows(self, table):
+        columns = [column.name for column in table.__table__.columns]
+        with Session(self.engine) as session:
+            return [{column: getattr(row, column) for column in columns}
+                    for row in session.scalars(select(table).order_by(table.id))]
+
+
+    def replaceRows(self, table, rows):
+        with Session(self.engine) as session, session.begin():
+            session.execute(delete(table))
+            if rows:
+                session.execute(insert(table), rows)
+
+
+    def upsertCommand(self, session, name, script):
+        session.execute(insert(Commands).values(name=name, script=script)
+                        .on_conflict_do_update(index_elements=[Commands.name], set_={'script': script}))
+
+
+    def deleteCommand(self, session, name):
+        session.execute(delete(Commands).where(Commands.name == name))
+
+
+    def addVariable(self, session, name, value, author, on_date):
+        session.add(Variables(name=name, value=value, added_by=author, on_date=on_date))
+
+
+    def replaceVariable(self, session, name, value, author, on_date):
+        session.execute(delete(Variables).where(Variables.name == name))
+        session.add(Variables(name=name, value=value, added_by=author, on_date=on_date))
+
+
+    def deleteVariable(self, session, name):
+        session.execute(delete(Variables).where(Variables.name == name))
+
+
+    def addQuote(self, session, quote, said_by, recorded_by, on_date):
+        session.add(Quotes(quote=quote, said_by=said_by, recorded_by=recorded_by, on_date=on_date))
+
+
+    def editQuote(self, session, number, quote):
+        session.execute(update(Quotes).where(Quotes.id == number).values(quote=quote))
+
+
+    def deleteQuote(self, session, number):
+        session.execute(delete(Quotes).where(Quotes.id == number))
+
+
+# Every table as plain dicts and lists.  Rows are kept as {column: value}, the same as in a snapshot.
+#   Quotes also keep a list of their numbers, so one can be picked at random in O(1), and a word index
+#   standing in for SQLite's full-text one.
+class MemoryStorage(Storage):
+    def __init__(self, path_to_db=None):
+        self.commandRows  = {}                          # name: row
+        self.settingRows  = []                          # rows, in the order they were added
+        self.variableRows = {}                          # name: [row, ...]
+        self.quoteRows    = {}                          # number: row
+        self.numbers      = []                          # every quote number, in no particular order
+        self.positions    = {}                          # number: where it is in numbers
+        self.highest      = 0
+        self.index        = {'quote': {}, 'said_by': {}}  # column: {word: {number, ...}}
+
+
+    # Nothing can half fail here, so each write is made on its own; one that fails is logged and skipped
+    def write(self, batch):
+        for operation, arguments in batch:
+            try:
+                getattr(self, operation)(*arguments)
+            except Exception:
+                logging.exception('storage.MemoryStorage.write - %s failed', operation)
+
+
+    def commands(self):
+        return {name: row['script'] for name, row in self.commandRows.items()}
+
+
+    def script(self, name):
+        row = self.commandRows.get(name)
+        return None if row is None else row['script']
+
+
+    def settings(self):
+        return [(row['platform'], row['field'], row['value']) for row in self.settingRows]
+
+
+    def values(self, names):
+        return {name: [row['value'] for row in self.variableRows[name]]
+                for name in names if self.variableRows.get(name)}
+
+
+    def quote(self, number):
+        row = self.quoteRows.get(number)
+        return None if row is None else row['quote']
+
+
+    def randomQuote(self):
+        if not self.numbers:
+            return None
+        return self.quoteRows[choice(self.numbers)]['quote']
+
+
+    # Without a column, a word can be in either one, the same as an FTS5 query
+    def findQuotes(self, search, column=None):
+        columns = [column] if column is not None else list(self.index)
+        found = None
+        for word in words.findall(search.lower()):
+            numbers = set()
+            for name in columns:
+                numbers |= self.index[name].get(word, set())
+            found = numbers if found is None else found & numbers
+            if not found:
+                return []
+        return sorted(found or ())
+
+
+    def rows(self, table):
+        if table is Commands:
+            rows = list(self.commandRows.values())
+        elif table is ConnectionSettings:
+            rows = self.settingRows
+        elif table is Variables:
+            rows = [row for rows in self.variableRows.values() for row in rows]
+        else:
+            return [dict(self.quoteRows[number]) for number in sorted(self.quoteRows)]
+        # Only quote numbers mean anything, so every other table is just numbered in order
+        return [dict(row, id=number) for number, row in enumerate(rows, 1)]
+
+
+    def replaceRows(self, table, rows):
+        if table is Commands:
+            self.commandRows = {row['name']: row for row in rows}
+        elif table is ConnectionSettings:
+            self.settingRows = list(rows)
+        elif table is Variables:
+            self.variableRows = {}
+            for row in rows:
+                self.variableRows.setdefault(row['name'], []).append(row)
+        else:
+            self.quoteRows = {}
+            self.numbers   = []
+            self.positions = {}
+            self.highest   = 0
+            self.index     = {column: {} for column in self.index}
+            for row in rows:
+                self.insertQuote(row)
+
+
+    def upsertCommand(self, name, script):
+        row = self.commandRows.get(name)
+        if row is None:
+            self.commandRows[name] = {'name': name, 'script': script, 'frequency': 0, 'user_level': None}
+        else:
+            row['script'] = script
+
+
+    def deleteCommand(self, name):
+        self.commandRows.pop(name, None)
+
+
+    def addVariable(self, name, value, author, on_date):
+        self.variableRows.setdefault(name, []).append({'name': name, 'value': value, 'on_date': on_date,
+                                                       'added_by': author})
+
+
+    def replaceVariable(self, name, value, author, on_date):
+        self.variableRows[name] = []
+        self.addVariable(name, value, author, on_date)
+
+
+    def deleteVariable(self, name):
+        self.variableRows.pop(name, None)
+
+
+    # Like SQLite, a new quote gets the number after the highest one there is now
+    def addQuote(self, quote, said_by, recorded_by, on_date):
+        self.insertQuote({'id': self.highest + 1, 'quote': quote, 'on_date': on_date, 'said_by': said_by,
+                          'recorded_by': recorded_by})
+
+
+    def editQuote(self, number, quote):
+        row = self.quoteRows.get(number)
+        if row is not None:
+            self.indexQuote(row, False)
+            row['quote'] = quote
+            self.indexQuote(row, True)
+
+
+    def deleteQuote(self, number):
+        row = self.quoteRows.pop(number, None)
+        if row is None:
+            return
+        self.indexQuote(row, False)
+        # Swap the last number into the deleted one's place, so numbers stays without gaps
+        position = self.positions.pop(number)
+        last = self.numbers.pop()
+        if last != number:
+            self.numbers[position] = last
+            self.positions[last]   = position
+        if number == self.highest:
+            self.highest = max(self.quoteRows, default=0)
+
+
+    def insertQuote(self, row):
+        number = row['id'] if row['id'] is not None else self.highest + 1
+        row = dict(row, id=number)
+        if number in self.quoteRows:
+            raise ValueError(f'Quote {number} already exists')
+        self.quoteRows[number]  = row
+        self.positions[number] = len(self.numbers)
+        self.numbers.append(number)
+        self.highest = max(self.highest, number)
+        self.indexQuote(row, True)
+
+
+    def indexQuote(self, row, add):
+        for column, index in self.index.items():
+            for word in set(words.findall(row[column].lower())):
+                numbers = index.setdefault(word, set())
+                if add:
+                    numbers.add(row['id'])
+                else:
+                    numbers.discard(row['id'])
+                    if not numbers:
+                        del index[word]
+
+
+storageTypes = {
+    'sqlite': SQLStorage,
+    'memory': MemoryStorage
+}
@@ -1,27 +1,73 @@
 #!/usr/bin/env python
 
+import asyncio
 from datetime import datetime
+import json
+import os
+import pickle
+import sys
+import tempfile
+from types import SimpleNamespace
 import unittest
 
+from compiler import Call, Literal, ScriptCache, compileScript
+from cooldowns import Cooldowns, ExpiringSet
+import irc
 from parser import Parser
-from plugin import Message
-from db import Database, Variables
+import logging
+from logs import BackgroundHandler, SampleFilter
+from outbox import Outbox, Priority
+from plugin import Message, MessageType
+from result import Result, ResultType
+from scheduler import Scheduler
+from stats import Histogram, Stats
+import storage
+import workers
+import db
+from db import AsyncDatabase, Commands, Database, ValuePool, Variables
+from sqlalchemy import text
+from plugins import twitch
+import chatbot
 from chatbot import ChatBot
 
+# A few commands and variables, loaded into an in-memory Database by the tests that need them
+fixture = {
+    'Commands':  [{'name': 'hello', 'script': '{var greeting} {user}, {var howareyou}'},
+                  {'name': 'so',    'script': '{var {user}}  Go check them out at {channel}!'}],
+    'Variables': [{'name': 'greeting',       'value': 'Hi'},
+                  {'name': 'greeting',       'value': 'Hello there'},
+                  {'name': 'howareyou',      'value': 'how are you?'},
+                  {'name': 'howareyou',      'value': 'how are you doing, {sender}?'},
+                  {'name': 'joshtaerkmusic', 'value': 'Josh makes great music!'}],
+}
+
+
+def write_snapshot(directory, snapshot):
+    path = os.path.join(directory, 'snapshot.json')
+    with open(path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    return path
+
+
+def memory_database(snapshot=fixture):
+    with tempfile.TemporaryDirectory() as directory:
+        return Database(storage='memory', snapshot=write_snapshot(directory, snapshot))
+
+
 class TestChatBot(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
-        self.db = Database()
+        self.db = memory_database()
         self.parser = Parser(self.db)
 
 
     def containsRandomString(self, random_strings, result_string):
         for random_string in random_strings:
             # This cannot process subcommands, so compare up to the first subcommand, assuming there is one.
-            subcommand = random_string.value.find('{')
+            subcommand = random_string.find('{')
             if subcommand > -1:
-                test_string = random_string.value[:subcommand]
+                test_string = random_string[:subcommand]
             else:
-                test_string = random_string.value
+                test_string = random_string
             print(f'test_string: {test_string}')
             if test_string in result_string:
                 return True
@@ -43,19 +89,15 @@ class TestChatBot(unittest.IsolatedAsyncioTestCase):
         get_howareyou = self.db.getAllResults(Variables, 'howareyou')
         if get_howareyou.isError():
             return
-        commands = self.db.getCommands()
-        for command in commands:
-            if command.name == 'hello':
-                hello_script = command.script
-                break
+        hello_script = self.db.getCommands()['hello']
         message = Message(platform='test',
                           author='jazzyeagle',
                           channel='#jazzyeagle',
                           timestamp=datetime.now(),
                           command='hello',
-                          text=hello_script,
+                          text='!hello' if user is None else f'!hello {user}',
                           to_user=user)
-        result = await self.parser.process(self, message, hello_script)
+        result = (await self.parser.process(self, message, hello_script)).response
         # Assert that any of the greetings strings are in the result
         self.assertTrue(self.containsRandomString(get_greetings.getResult(), result))
         # Assert that username is in the result but not the @ symbol
@@ -74,22 +116,852 @@ class TestChatBot(unittest.IsolatedAsyncioTestCase):
         get_shoutouts = self.db.getAllResults(Variables, 'joshtaerkmusic')
         if get_shoutouts.isError():
             return
-        commands = self.db.getCommands()
-        for command in commands:
-            if command.name == 'so':
-                so_script = command.script
-                break
+        so_script = self.db.getCommands()['so']
         message = Message(platform='test',
                           author='jazzyeagle',
                           channel='#jazzyeagle',
                           timestamp=datetime.now(),
-                          command='so joshtaerkmusic',
-                          text=so_script,
+                          command='so',
+                          text='!so @joshtaerkmusic',
                           to_user='joshtaerkmusic')
 
         result = await self.parser.process(self, message, so_script)
         # Assert that any of the shoutout strings are in the result
-        self.assertTrue(self.containsRandomString(get_shoutouts.getResult(), result))
+        self.assertTrue(self.containsRandomString(get_shoutouts.getResult(), result.response))
+        self.assertIn('https://twitch.tv/joshtaerkmusic', result.response)
+
+
+    async def test_if_user(self):
+        message = Message(platform='test',
+                          author='jazzyeagle',
+                          channel='#jazzyeagle',
+                          text='!hi @stylerun09')
+        script = '{if {var exists nosuchvariable} | Nope | Hello {user}, from {sender}!}'
+        result = await self.parser.process(self, message, script)
+        self.assertEqual(result.response, 'Hello stylerun09, from jazzyeagle!')
+
+
+    async def test_concurrent_messages(self):
+        messages = [Message(author=f'user{number}', text='!hi') for number in range(3)]
+        results = await asyncio.gather(*[self.parser.process(self, message, 'Hi {sender}')
+                                         for message in messages])
+        self.assertEqual([result.response for result in results], ['Hi user0', 'Hi user1', 'Hi user2'])
+
+
+class TestCommandRegistry(unittest.TestCase):
+    def setUp(self):
+        self.db = memory_database()
+
+
+    def test_unknown_command_is_remembered(self):
+        registry = self.db.commands
+        self.assertTrue(registry.get('nosuchcommand').isError())
+        self.assertIn('nosuchcommand', registry.missing)
+
+
+    def test_update_and_invalidate(self):
+        registry = self.db.commands
+        registry.get('testcommand')
+        registry.update('testcommand', 'Hello {user}')
+        self.assertNotIn('testcommand', registry.missing)
+        self.assertEqual(self.db.getScript('testcommand').getResult(), 'Hello {user}')
+        registry.invalidate('testcommand')
+        self.assertNotIn('testcommand', registry.scripts)
+
+
+    def test_chat_filter(self):
+        self.db.commands.update('testcommand', 'Hello {user}')
+        self.db.commands.get('nosuchcommand')
+        connection = twitch.TwitchIRCBot(SimpleNamespace(db=self.db), {})
+        prefix = b'@mod=0;user-type= :nick!nick@nick.tmi.twitch.tv PRIVMSG #jazzyeagle :'
+        self.assertIsNotNone(connection.parse(prefix + b'!testcommand @someone\r\n'))
+        self.assertIsNotNone(connection.parse(prefix + b'!notlookedupyet\r\n'))
+        self.assertIsNone(connection.parse(prefix + b'!nosuchcommand\r\n'))
+        self.assertIsNone(connection.parse(prefix + b'hello !testcommand\r\n'))
+        self.assertIsNotNone(connection.parse(b'PING :tmi.twitch.tv\r\n'))
+        self.assertIsNotNone(connection.parse(b':tmi.twitch.tv NOTICE * :hello PRIVMSG #x :hi\r\n'))
+        # Lines the plugin has no use for are dropped as well, unless filter-chat = false
+        join = b':nick!nick@nick.tmi.twitch.tv JOIN #jazzyeagle\r\n'
+        self.assertIsNone(connection.parse(join))
+        connection = twitch.TwitchIRCBot(SimpleNamespace(db=self.db), {'filter-chat': 'false'})
+        self.assertEqual(connection.parse(join).command, 'JOIN')
+        self.assertEqual(connection.parse(prefix + b'hello\r\n').trailing, 'hello')
+        self.db.commands.invalidate('testcommand')
+
+
+class TestVariableStore(unittest.TestCase):
+    def test_shuffle_uses_every_value(self):
+        pool = ValuePool(['a', 'b', 'c', 'd'])
+        self.assertEqual(sorted(pool.shuffle() for _ in range(4)), ['a', 'b', 'c', 'd'])
+        self.assertIn(pool.pick(), pool.values)
+
+
+    def test_missing_variable(self):
+        db = memory_database()
+        self.assertEqual(db.exists(Variables, 'nosuchvariable').getResult(), 'False')
+        self.assertTrue(db.get(Variables, 'nosuchvariable').isError())
+        self.assertIn('nosuchvariable', db.variables.pools)
+
+
+class TestAsyncDatabase(unittest.IsolatedAsyncioTestCase):
+    async def test_matches_sync(self):
+        db = AsyncDatabase(memory_database())
+        self.assertEqual((await db.exists(Variables, 'nosuchvariable')).getResult(), 'False')
+        # Now that the empty pool is loaded, this is answered without going to the db thread
+        self.assertIsNotNone(db.variables.peek('nosuchvariable'))
+        self.assertTrue((await db.get(Variables, 'nosuchvariable')).isError())
+        self.assertTrue((await db.getScript('nosuchcommand')).isError())
+        self.assertIsNotNone(db.commands.peek('nosuchcommand'))
+        db.close()
+
+
+class TestWrites(unittest.IsolatedAsyncioTestCase):
+    storage = 'sqlite'
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.directory.name, 'test.db'), storage=self.storage)
+        self.parser = Parser(self.db)
+
+
+    async def asyncTearDown(self):
+        self.parser.db.close()
+        self.directory.cleanup()
+
+
+    async def run_script(self, script):
+        message = Message(author='stylerun09', channel='jazzyeagle', command='test', text='!test')
+        return (await self.parser.process(None, message, script)).response
+
+
+    async def test_connection_settings(self):
+        settings = [('chatbot', 'log-level', 'INFO'), ('Twitch', 'botnick', 'tooby'), ('twitch', 'channel', 'jazzyeagle'),
+                    ('twitch', 'log-level', 'DEBUG'), ('discord', 'botnick', 'other')]
+        self.db.storage.load(write_snapshot(self.directory.name, {'ConnectionSettings': [
+            {'platform': platform, 'field': field, 'value': value} for platform, field, value in settings]}))
+        self.assertEqual(self.db.getConnectionSettings('twitch'),
+                         {'channels': ['jazzyeagle'], 'log-level': 'DEBUG', 'botnick': 'tooby'})
+        self.assertEqual(self.db.getConnectionSettings('chatbot'), {'channels': [], 'log-level': 'INFO'})
+        # Read once; later calls don't go back to the database
+        self.assertEqual(self.db.getConnectionSettings('discord')['botnick'], 'other')
+
+
+    async def test_variables_and_commands(self):
+        self.assertEqual(await self.run_script('{var set greeting Hi {sender}}'), 'Variables greeting successfully set.')
+        self.assertEqual(await self.run_script('{var add greeting Hi {sender}}'), 'Variables greeting successfully set.')
+        self.assertEqual(await self.run_script('{command add hello {var greeting}!}'), 'Commands hello successfully set.')
+        # Seen straight away, before anything has been written
+        self.assertEqual(len(self.db.writes), 3)
+        self.assertEqual(await self.run_script('{var greeting}'), 'Hi stylerun09')
+        self.assertEqual(self.db.getScript('hello').getResult(), '{var greeting}!')
+
+        await self.parser.db.flush()
+        self.assertEqual(len(self.db.writes), 0)
+        self.assertEqual(len(self.db.getAllResults(Variables, 'greeting').getResult()), 2)
+        self.db.commands.invalidate('hello')
+        self.assertEqual(self.db.getScript('hello').getResult(), '{var greeting}!')
+
+        self.assertEqual(await self.run_script('{var delete greeting}'), 'Variables greeting successfully deleted.')
+        self.assertEqual(await self.run_script('{var exists greeting}'), 'False')
+        self.assertTrue(self.db.getAllResults(Variables, 'greeting').isError())
+        self.assertEqual(await self.run_script('{var delete greeting}'), 'Error: Variables error:  greeting not found in db.')
+
+
+    async def test_budget(self):
+        self.db.set(Variables, 'loop', '{var loop}')
+        self.assertEqual(await self.run_script('{var loop}'), 'Error: Script stopped: values nested more than 10 deep')
+        # Values that only loop back through {if} or a variable name made by another block count too
+        self.db.set(Variables, 'loopif', '{if True | {var loopif} | x}')
+        self.assertEqual(await self.run_script('{var loopif}'), 'Error: Script stopped: values nested more than 10 deep')
+        self.db.set(Variables, 'loopname', '{var get {var loopname}}')
+        self.assertEqual(await self.run_script('{var loopname}'), 'Error: Script stopped: values nested more than 10 deep')
+        # Each level doubles the work.  {sender} keeps the output from being cached.
+        for level in range(9):
+            self.db.set(Variables, f'double{level}', f'{{var double{level+1}}}{{var double{level+1}}}')
+        self.db.set(Variables, 'double9', '{sender}')
+        self.parser.maxTime = 10
+        self.assertEqual(await self.run_script('{var double0}'), 'Error: Script stopped: more than 1000 steps')
+        self.db.set(Variables, 'big', 'x' * 3000)
+        self.assertEqual(await self.run_script('{var big}{var big}'),
+                         'Error: Script stopped: output longer than 4000 characters')
+        self.parser.maxTime = 0
+        self.assertEqual(await self.run_script('{sender}'), 'Error: Script stopped: took longer than 0 seconds')
+
+
+    async def test_concurrent_blocks(self):
+        events = []
+
+        async def slow(call, depth):
+            events.append(('start', call.words[1]))
+            await asyncio.sleep(0.01 if call.words[1] == 'a' else 0)
+            events.append(('end', call.words[1]))
+            return Result(ResultType.Ok, call.words[1].upper())
+
+        self.parser.builtinCommands['slow'] = slow
+        self.assertEqual(await self.run_script('{slow a}-{slow b}{var set x y}{slow c} {var x}{slow d}'),
+                         'A-BVariables x successfully set.C yD')
+        # a and b run together but come out in order; c and d only start once x is set
+        self.assertEqual(events, [('start', 'a'), ('start', 'b'), ('end', 'b'), ('end', 'a'),
+                                  ('start', 'c'), ('start', 'd'), ('end', 'c'), ('end', 'd')])
+        events.clear()
+        self.assertEqual(await self.run_script('{if True | {slow yes} | {slow no}}'), 'YES')
+        self.assertEqual(events, [('start', 'yes'), ('end', 'yes')])
+        self.assertEqual(await self.run_script('{slow a}{var missing}{slow b}'), 'Error: Variables missing not found!')
+
+
+    async def test_render_cache(self):
+        self.db.set(Variables, 'discord', 'https://discord.gg/example')
+        self.db.add(Variables, 'greeting', 'Hi')
+        self.db.add(Variables, 'greeting', 'Hello')
+        script = 'Join {var discord}, {sender}!  {var greeting}'
+        self.assertIn(await self.run_script(script), ['Join https://discord.gg/example, stylerun09!  Hi',
+                                                       'Join https://discord.gg/example, stylerun09!  Hello'])
+        # The whole script reads the message and picks at random, so only {var discord} is kept
+        self.assertIsNone(self.parser.rendered.get(('script', script)))
+        self.assertIsNotNone(self.parser.rendered.get(('call', 'var discord')))
+        self.assertEqual(await self.run_script('{var discord}'), 'https://discord.gg/example')
+        self.assertIsNotNone(self.parser.rendered.get(('script', '{var discord}')))
+
+        await self.run_script('{var set discord https://discord.gg/other}')
+        self.assertIsNone(self.parser.rendered.get(('call', 'var discord')))
+        self.assertIsNone(self.parser.rendered.get(('script', '{var discord}')))
+        self.assertEqual(await self.run_script('{var discord}'), 'https://discord.gg/other')
+        # A script of plain text is never mistaken for a { } block with the same source, or the other way round
+        self.assertEqual(await self.run_script('var discord'), 'var discord')
+        self.assertEqual(await self.run_script('{var discord}'), 'https://discord.gg/other')
+        self.assertEqual(await self.run_script('var discord'), 'var discord')
+
+
+    async def test_quotes(self):
+        self.assertEqual(await self.run_script('{quote add I never said that}'), 'Quote added.')
+        self.assertEqual(await self.run_script('{quote 1}'), 'I never said that')
+        await self.run_script('{quote edit 1 I did say that}')
+        self.assertEqual(await self.run_script('{quote get 1}'), 'I did say that')
+        await self.run_script('{quote delete 1}')
+        self.assertEqual(await self.run_script('{quote exists 1}'), 'False')
+        self.assertEqual(await self.run_script('{quote edit 99 hi}'), 'Error: Quote 99 not found in db.')
+        self.assertEqual(await self.run_script('{quote delete 99}'), 'Error: Quote 99 not found in db.')
+
+
+    async def test_prefetch_variables(self):
+        for number in range(10):
+            self.db.add(Variables, f'word{number}', f'w{number}')
+        self.db.flush()
+        self.db.variables.pools.clear()
+        queries = []
+        values = self.db.storage.values
+        self.db.storage.values = lambda names: queries.append(names) or values(names)
+        script = ' '.join(f'{{var word{number}}}' for number in range(8)) + \
+                 ' {if {var exists word8} | {var get Word9} | no}{var exists missing}'
+        self.assertEqual(await self.run_script(script), 'w0 w1 w2 w3 w4 w5 w6 w7 w9False')
+        # Ten variables, one that doesn't exist, and only the one query
+        self.assertEqual(len(queries), 1)
+
+
+    async def test_quote_search(self):
+        for quote in ('the cake is a lie', 'I like cake', 'no comment'):
+            await self.run_script(f'{{quote add {quote}}}')
+        await self.run_script('{quote edit 3 no cake for you}')
+        await self.run_script('{quote delete 2}')
+        self.assertEqual(await self.run_script('{quote #1}'), 'the cake is a lie')
+        self.assertIn(await self.run_script('{quote search CAKE}'), ('the cake is a lie', 'no cake for you'))
+        self.assertEqual(await self.run_script('{quote search cake lie}'), 'the cake is a lie')
+        self.assertEqual(await self.run_script('{quote search like}'), 'Error: No quotes found for like.')
+        self.assertEqual(await self.run_script('{quote search "OR}'), 'Error: No quotes found for "OR.')
+        self.assertIn(await self.run_script('{quote by @JazzyEagle}'), ('the cake is a lie', 'no cake for you'))
+        self.assertIn(await self.run_script('{quote}'), ('the cake is a lie', 'no cake for you'))
+        # The next quote is numbered after the highest one left
+        await self.run_script('{quote delete 3}')
+        await self.run_script('{quote add the last word}')
+        self.assertEqual(await self.run_script('{quote 2}'), 'the last word')
+
+
+    async def test_quote_index_rebuild(self):
+        await self.run_script('{quote add the cake is a lie}')
+        # Quotes added before the index existed are indexed when the schema is updated
+        with self.db.storage.engine.begin() as connection:
+            connection.execute(text("INSERT INTO QuotesSearch(QuotesSearch) VALUES ('delete-all')"))
+            connection.execute(text('PRAGMA user_version = 1'))
+        self.db.storage.createSchema()
+        self.assertEqual(await self.run_script('{quote search lie}'), 'the cake is a lie')
+
+
+    async def test_quote_add_invalidates(self):
+        self.assertEqual(await self.run_script('{quote exists 1}'), 'False')
+        self.assertEqual(await self.run_script('{if {quote exists 1} | yes | no}'), 'no')
+        await self.run_script('{quote add first quote}')
+        self.assertEqual(await self.run_script('{quote exists 1}'), 'True')
+        self.assertEqual(await self.run_script('{if {quote exists 1} | yes | no}'), 'yes')
+
+
+    async def test_values_stored_as_written(self):
+        self.assertEqual(await self.run_script('{var set a {var add b hi}}'), 'Variables a successfully set.')
+        self.assertEqual(await self.run_script('{command add hype {quote add spam}}'), 'Commands hype successfully set.')
+        self.assertEqual(await self.run_script('{var set g Hi {var later}}'), 'Variables g successfully set.')
+        self.assertEqual(await self.run_script('{var add c {1}}'), 'Variables c successfully set.')
+        # Nothing in the values ran when they were stored
+        self.assertEqual(await self.run_script('{var exists b}'), 'False')
+        self.assertEqual(await self.run_script('{quote exists 1}'), 'False')
+        self.assertEqual(self.db.getScript('hype').getResult(), '{quote add spam}')
+        self.assertEqual(self.db.read().values(['g'])['g'], ['Hi {var later}'])
+        # A name made by a block is still evaluated, and the value after it kept as written
+        await self.run_script('{var set who greeting}')
+        self.assertEqual(await self.run_script('{var set {var who} Hi {user}!}'), 'Variables greeting successfully set.')
+        self.assertEqual(await self.run_script('{var greeting}'), 'Hi stylerun09!')
+
+
+    async def test_values_cached_apart_from_commands(self):
+        for number in range(3):
+            await self.run_script(f'{{var set v{number} Hi {{user}} {number}}}')
+        for number in range(3):
+            self.assertEqual(await self.run_script(f'{{var v{number}}}'), f'Hi stylerun09 {number}')
+        # The expanded values have a cache of their own; the script cache only holds the scripts that were run
+        self.assertEqual(len(self.parser.values), 3)
+        self.assertNotIn(None, [key[0] for key in self.parser.scripts.scripts])
+
+
+    async def test_random_quote_gaps(self):
+        for said in ('one', 'two', 'three', 'four'):
+            await self.run_script(f'{{quote add {said}}}')
+        await self.run_script('{quote delete 2}')
+        await self.run_script('{quote delete 3}')
+        picks = iter([2, 3, 1, 3, 3, 3, 3, 3, 3])
+        original = storage.randint
+        storage.randint = lambda low, high: next(picks)
+        try:
+            # A number that lands in a gap is tried again
+            self.assertEqual(await self.run_script('{quote}'), 'one')
+            # After randomQuoteTries misses, the quote after the last number is taken
+            self.assertEqual(await self.run_script('{quote}'), 'four')
+        finally:
+            storage.randint = original
+
+
+    async def test_shared_database(self):
+        path = os.path.join(self.directory.name, 'test.db')
+        self.parser.db.close()
+        self.parser = Parser(Database(path, shared=True))
+        self.db = self.parser.db.sync
+        self.db.set(Variables, 'socials', 'twitter')
+        self.db.flush()
+        # This process's own writes are already in its caches
+        self.assertFalse(self.db.refresh())
+        self.assertEqual(await self.run_script('{var socials}'), 'twitter')
+        self.assertEqual(await self.run_script('{var exists news}'), 'False')
+        self.assertTrue(self.db.getScript('hello').isError())
+
+        # Another process changes the database
+        other = Database(path)
+        other.set(Variables, 'socials', 'mastodon')
+        other.add(Variables, 'news', 'none today')
+        other.set(Commands, 'hello', 'Hi!')
+        other.flush()
+        self.assertEqual(await self.run_script('{var socials}'), 'twitter')
+        self.assertTrue(self.db.refresh())
+        # The registry is reloaded in one go, rather than a command at a time
+        self.assertEqual(self.db.commands.peek('hello').getResult(), 'Hi!')
+        self.assertEqual(await self.run_script('{var socials}'), 'mastodon')
+        self.assertEqual(await self.run_script('{var exists news}'), 'True')
+        self.assertEqual(await self.run_script('{command hello}'), 'Hi!')
+
+        # In the bot, the check is made every checkInterval seconds on the database thread
+        watched  = self.parser.db
+        interval = db.checkInterval
+        db.checkInterval = 0.01
+        watching = asyncio.create_task(watched.watch())
+        try:
+            other.set(Commands, 'hello', 'Hello!')
+            other.flush()
+            for attempt in range(100):
+                if watched.generation == 2:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watching.cancel()
+            await asyncio.gather(watching, return_exceptions=True)
+            db.checkInterval = interval
+            other.close()
+        self.assertEqual(self.db.commands.peek('hello').getResult(), 'Hello!')
+        self.assertEqual(await self.run_script('{command hello}'), 'Hello!')
+
+
+    async def test_snapshot(self):
+        await self.run_script('{quote add the cake is a lie}')
+        await self.run_script('{quote add still alive}')
+        await self.run_script('{quote delete 1}')
+        self.db.add(Variables, 'greeting', 'Hi')
+        self.db.add(Variables, 'greeting', 'Hello')
+        await self.run_script('{command add hello {var greeting}!}')
+        path = os.path.join(self.directory.name, 'saved.json')
+        self.db.save(path)
+        # Either storage can load what the other saved
+        for storage in ('sqlite', 'memory'):
+            db = Database(os.path.join(self.directory.name, f'{storage}.db'), storage=storage, snapshot=path)
+            self.assertEqual(db.getQuote('2').getResult(), 'still alive')
+            self.assertTrue(db.getQuote('1').isError())
+            self.assertEqual(db.searchQuotes('alive').getResult(), 'still alive')
+            self.assertEqual(db.getScript('hello').getResult(), '{var greeting}!')
+            self.assertEqual(db.getAllResults(Variables, 'greeting').getResult(), ['Hi', 'Hello'])
+            db.add(db.getType('quotes').getResult(), 'jazzyeagle', 'a new one')
+            self.assertEqual(db.getQuote('3').getResult(), 'a new one')
+            db.close()
+
+
+# The same tests against the in-memory storage
+class TestMemoryWrites(TestWrites):
+    storage = 'memory'
+
+    @unittest.skip('SQLite only')
+    async def test_quote_index_rebuild(self):
+        pass
+
+    @unittest.skip('SQLite only')
+    async def test_shared_database(self):
+        pass
+
+    @unittest.skip('SQLite only')
+    async def test_random_quote_gaps(self):
+        pass
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    async def test_order_per_key(self):
+        handled = []
+        slow = asyncio.Event()
+
+        async def handler(item):
+            key, number = item
+            if key == 'slow':
+                await slow.wait()
+            handled.append(item)
+
+        scheduler = Scheduler(handler, workers=2)
+        scheduler.start()
+        await scheduler.submit('slow', ('slow', 0))
+        for number in range(3):
+            await scheduler.submit('fast', ('fast', number))
+        await asyncio.sleep(0.01)
+        # The slow channel does not hold up the fast one
+        self.assertEqual(handled, [('fast', 0), ('fast', 1), ('fast', 2)])
+        self.assertEqual(scheduler.stats()['pending'], 1)
+        slow.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(handled[-1], ('slow', 0))
+        self.assertEqual(sum(worker['processed'] for worker in scheduler.stats()['workers']), 4)
+        await scheduler.stop()
+
+
+    async def test_stop_releases_claims(self):
+        connection = twitch.TwitchIRCBot(SimpleNamespace(), {'botnick': 'tooby', 'oauth-token': 'oauth:x'})
+        connection.cooldowns = Cooldowns({})
+        stuck = asyncio.Event()
+        async def create_message(message):
+            await stuck.wait()
+        connection.create_message = create_message
+        connection.inbox = Scheduler(connection.process, workers=1)
+        connection.inbox.start()
+        lines = [irc.parse(b':a!a@a.tmi.twitch.tv PRIVMSG #jazzyeagle :!hype\r\n'),
+                 irc.parse(b':b!b@b.tmi.twitch.tv PRIVMSG #jazzyeagle :!discord\r\n')]
+        for message in lines:
+            self.assertTrue(connection.cooldowns.claim(connection.duplicate_key(message)))
+            await connection.inbox.submit(message.channel, message)
+        await asyncio.sleep(0.01)
+        # The first is being handled when the workers are cancelled; the second never started
+        dropped = await connection.inbox.stop()
+        self.assertEqual(dropped, lines[1:])
+        for message in dropped:
+            connection.release_duplicate(message)
+        self.assertEqual(connection.cooldowns.inFlight, set())
+        self.assertEqual(connection.inbox.stats()['pending'], 0)
+
+
+class TestOutbox(unittest.IsolatedAsyncioTestCase):
+    class Writer:
+        def __init__(self):
+            self.lines = []
+
+        def write(self, line):
+            self.lines.append(line)
+
+        async def drain(self):
+            pass
+
+
+    async def test_priority_and_channel_limit(self):
+        writer = self.Writer()
+        outbox = Outbox(writer, limit=20, period=30, channelPeriod=60, maxsize=3)
+        outbox.put(b'PRIVMSG #a :one', Priority.Chat, 'a')
+        outbox.put(b'PRIVMSG #a :two', Priority.Chat, 'a')
+        outbox.put(b'PRIVMSG #b :three', Priority.Chat, 'b')
+        self.assertFalse(outbox.put(b'PRIVMSG #b :four', Priority.Chat, 'b'))
+        outbox.put(b'PONG :tmi.twitch.tv', Priority.Server)
+        task = asyncio.create_task(outbox.run())
+        await asyncio.sleep(0.01)
+        # PONG goes first, and #a's second line waits for #a's bucket without holding up #b
+        self.assertEqual(writer.lines, [b'PONG :tmi.twitch.tv', b'PRIVMSG #a :one', b'PRIVMSG #b :three'])
+        self.assertEqual(outbox.stats()['dropped'], 1)
+        self.assertEqual(outbox.stats()['queued']['Chat'], 1)
+        task.cancel()
+
+
+class TestTwitchConnections(unittest.IsolatedAsyncioTestCase):
+    class Connection:
+        def __init__(self, bot, settings, name, **options):
+            self.name     = name
+            self.channels = set()
+            self.ready    = asyncio.Event()
+            self.started  = None
+            self.closed   = asyncio.Event()
+
+        async def run(self):
+            self.started = asyncio.get_running_loop().time() - 3600
+            self.ready.set()
+            await self.closed.wait()
+
+        async def join(self, channels):
+            self.channels.update(channels)
+
+        async def part(self, channel):
+            self.channels.discard(channel)
+
+
+    async def test_sharding_and_failover(self):
+        original = twitch.TwitchIRCBot
+        twitch.TwitchIRCBot = self.Connection
+        try:
+            connections = twitch.TwitchConnections(None, {'channels': 'a,b,c', 'channels-per-connection': 2})
+            task = asyncio.create_task(connections.run())
+            await asyncio.sleep(0.01)
+            self.assertEqual(sorted(len(connection.channels) for connection in connections.connections), [1, 2])
+
+            await connections.part_channels(['#b'])
+            await connections.join_channels(['d', 'e'])
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(connections.connections), 2)
+            self.assertEqual(sorted(connections.assignments), ['a', 'c', 'd', 'e'])
+
+            # The channels of a connection that drops are joined again elsewhere
+            lost = next(iter(connections.connections))
+            moved = set(lost.channels)
+            lost.closed.set()
+            await asyncio.sleep(0.01)
+            self.assertNotIn(lost, connections.connections)
+            self.assertEqual(sorted(connections.assignments), ['a', 'c', 'd', 'e'])
+            for channel in moved:
+                self.assertIn(channel, connections.assignments[channel].channels)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            twitch.TwitchIRCBot = original
+
+
+class TestCooldowns(unittest.TestCase):
+    def test_expiring_set(self):
+        recent = ExpiringSet(10, maxsize=2)
+        recent.add('a', 0)
+        recent.add('b', 5)
+        self.assertTrue(recent.contains('a', 9))
+        self.assertFalse(recent.contains('a', 10))
+        recent.add('c', 11)
+        self.assertEqual(list(recent.entries), ['b', 'c'])
+        recent.add('d', 12)
+        self.assertEqual(list(recent.entries), ['c', 'd'])
+
+
+    def test_scopes(self):
+        cooldowns = Cooldowns({'cooldown-user': '30', 'cooldown-command': '10'})
+        self.assertTrue(cooldowns.allow('jazzyeagle', 'a', 'hype', 0))
+        self.assertFalse(cooldowns.allow('jazzyeagle', 'b', 'hype', 5))
+        self.assertTrue(cooldowns.allow('otherchannel', 'b', 'hype', 5))
+        self.assertFalse(cooldowns.allow('jazzyeagle', 'a', 'discord', 20))
+        self.assertTrue(cooldowns.allow('jazzyeagle', 'b', 'hype', 20))
+        self.assertTrue(Cooldowns({}).allow('jazzyeagle', 'a', 'hype'))
+
+
+    def test_duplicates(self):
+        cooldowns = Cooldowns({})
+        self.assertTrue(cooldowns.claim(b'#jazzyeagle :!hype\r\n'))
+        self.assertFalse(cooldowns.claim(b'#jazzyeagle :!hype\r\n'))
+        cooldowns.release(b'#jazzyeagle :!hype\r\n')
+        self.assertTrue(cooldowns.claim(b'#jazzyeagle :!hype\r\n'))
+
+
+class TestReconnect(unittest.IsolatedAsyncioTestCase):
+    async def test_reconnect(self):
+        sessions = []
+        rejoined = asyncio.Event()
+
+        async def twitch_server(reader, writer):
+            lines = []
+            sessions.append(lines)
+            while not any(line.startswith(b'PRIVMSG') for line in lines) or len(sessions) > 1:
+                lines.append(await reader.readuntil(b'\r\n'))
+                if len(sessions) > 1 and lines[-1].startswith(b'JOIN'):
+                    rejoined.set()
+                    return
+            writer.write(b':tmi.twitch.tv 001 tooby :Welcome, GLHF!\r\n:tmi.twitch.tv RECONNECT\r\n')
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(twitch_server, '127.0.0.1', 0)
+        address = (twitch.twitch_irc_url, twitch.twitch_irc_port, twitch.twitch_irc_ssl)
+        twitch.twitch_irc_url, twitch.twitch_irc_port = server.sockets[0].getsockname()
+        twitch.twitch_irc_ssl = False
+        try:
+            connection = twitch.TwitchIRCBot(SimpleNamespace(), {'botnick': 'tooby', 'oauth-token': 'oauth:x'})
+            connection.channels = {'a', 'b'}
+            # Sent before there is a connection, so it waits in the outbox
+            await connection.send_to_channel(Message(channel='a', response='Hello'))
+            task = asyncio.create_task(connection.run())
+            await asyncio.wait_for(rejoined.wait(), 5)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            twitch.twitch_irc_url, twitch.twitch_irc_port, twitch.twitch_irc_ssl = address
+            server.close()
+
+        # Logged in and rejoined in one go, then the line that was waiting
+        self.assertEqual(sessions[0], [b'CAP REQ :twitch.tv/tags twitch.tv/commands\r\n', b'PASS oauth:x\r\n',
+                                       b'NICK tooby\r\n', b'JOIN #a,#b\r\n', b'PRIVMSG #a :Hello\r\n'])
+        self.assertEqual(sessions[1][-1], b'JOIN #a,#b\r\n')
+        self.assertEqual(connection.reconnects, 1)
+        self.assertIsNotNone(connection.time_to_ready)
+
+
+class TestSupervisor(unittest.IsolatedAsyncioTestCase):
+    class FlakyPlugin:
+        def __init__(self, failures):
+            self.failures = failures
+            self.runs = 0
+
+        async def run(self):
+            self.runs += 1
+            if self.runs <= self.failures:
+                raise ConnectionError('dropped')
+
+
+    async def test_restarts_failed_plugins(self):
+        bot = ChatBot.__new__(ChatBot)
+        bot.plugins = {'first': self.FlakyPlugin(2), 'second': self.FlakyPlugin(0)}
+        bot.modules  = []
+        bot.settings = {}
+        bot.reports  = None
+        delay = chatbot.restart_delay
+        chatbot.restart_delay = 0
+        try:
+            await asyncio.wait_for(bot.supervise(), 1)
+        finally:
+            chatbot.restart_delay = delay
+        self.assertEqual(bot.plugins['first'].runs, 3)
+        self.assertEqual(bot.plugins['second'].runs, 1)
+
+
+class TestMain(unittest.TestCase):
+    class Recorder:
+        started = []
+
+        def __init__(self, *arguments, **options):
+            self.started.append((arguments, options))
+
+        def run(self):
+            pass
+
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.snapshot  = write_snapshot(self.directory.name, dict(fixture, ConnectionSettings=[
+            {'platform': 'chatbot', 'field': 'processes', 'value': '2'},
+            {'platform': 'twitch',  'field': 'channel',   'value': 'jazzyeagle'}]))
+        self.cwd      = os.getcwd()
+        self.argv     = sys.argv
+        self.original = (chatbot.ChatBot, workers.Coordinator)
+        chatbot.ChatBot = workers.Coordinator = self.Recorder
+        self.Recorder.started.clear()
+        os.chdir(self.directory.name)
+
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.argv = self.argv
+        chatbot.ChatBot, workers.Coordinator = self.original
+        self.directory.cleanup()
+
+
+    def test_snapshot_loaded_once(self):
+        sys.argv = ['chatbot.py', '--snapshot', self.snapshot]
+        chatbot.main()
+        (count, channels, settings, database), options = self.Recorder.started[0]
+        self.assertEqual((count, channels), (2, ['jazzyeagle']))
+        # The workers share the database the snapshot was loaded into, and don't load it again
+        self.assertEqual(database, {'storage': 'sqlite'})
+        db = Database(preload=False, **database)
+        self.assertEqual(db.getScript('hello').getResult(), '{var greeting} {user}, {var howareyou}')
+        db.close()
+
+
+    def test_memory_storage_loads_its_own_copy(self):
+        sys.argv = ['chatbot.py', '--storage', 'memory', '--snapshot', self.snapshot, '--processes', '1']
+        chatbot.main()
+        self.assertEqual(self.Recorder.started, [((), {'database': {'storage': 'memory', 'snapshot': self.snapshot}})])
+
+
+class TestIRC(unittest.TestCase):
+    def test_privmsg_with_tags(self):
+        message = irc.parse(b'@color=#FF0000;display-name=Jazzy\\sEagle;mod=1 '
+                            b':jazzyeagle!jazzyeagle@jazzyeagle.tmi.twitch.tv PRIVMSG #jazzyeagle :!so #1 PRIVMSG #x\r\n')
+        self.assertEqual(message.command, 'PRIVMSG')
+        self.assertEqual(message.nick, 'jazzyeagle')
+        self.assertEqual(message.channel, 'jazzyeagle')
+        self.assertEqual(message.trailing, '!so #1 PRIVMSG #x')
+        self.assertEqual(message.tags, {'color': '#FF0000', 'display-name': 'Jazzy Eagle', 'mod': '1'})
+
+
+    def test_server_messages(self):
+        message = irc.parse(b'PING :tmi.twitch.tv\r\n')
+        self.assertEqual(message.command, 'PING')
+        self.assertEqual(message.params, ['tmi.twitch.tv'])
+        self.assertEqual(message.line, 'PING :tmi.twitch.tv')
+        self.assertEqual(message.channel, '')
+        message = irc.parse(b':nick!nick@nick.tmi.twitch.tv JOIN #jazzyeagle\r\n')
+        self.assertEqual((message.command, message.channel, message.trailing), ('JOIN', 'jazzyeagle', None))
+
+
+    def test_unusual_lines(self):
+        message = irc.parse(b':tmi.twitch.tv RECONNECT\r\n')
+        self.assertEqual((message.command, message.prefix, message.params), ('RECONNECT', 'tmi.twitch.tv', []))
+        message = irc.parse(b'@id=1 PRIVMSG #jazzyeagle :hi\r\n')
+        self.assertEqual((message.command, message.tags, message.nick, message.trailing),
+                         ('PRIVMSG', {'id': '1'}, '', 'hi'))
+        message = irc.parse(b'PRIVMSG #jazzyeagle\r\n')
+        self.assertEqual((message.command, message.channel, message.trailing), ('PRIVMSG', 'jazzyeagle', None))
+        self.assertIsNone(irc.parse(b'\r\n'))
+        self.assertIsNone(irc.parse(b''))
+
+
+    def test_dropped_lines(self):
+        parse = irc.parser({b'PRIVMSG', b'PING'}, lambda text: text.startswith(b'!'))
+        self.assertEqual(parse(b'PING :tmi.twitch.tv\r\n').command, 'PING')
+        self.assertIsNone(parse(b':nick!nick@nick.tmi.twitch.tv JOIN #jazzyeagle\r\n'))
+        self.assertIsNone(parse(b':nick!nick@nick.tmi.twitch.tv PRIVMSG #jazzyeagle :hello\r\n'))
+        message = parse(b':nick!nick@nick.tmi.twitch.tv PRIVMSG #jazzyeagle :!hype\r\n')
+        self.assertEqual((message.channel, message.nick, message.trailing), ('jazzyeagle', 'nick', '!hype'))
+
+
+class TestStats(unittest.TestCase):
+    def test_disabled_records_nothing(self):
+        stats = Stats()
+        start = stats.start()
+        stats.stop('parse', start)
+        stats.count('command', 'hello')
+        self.assertEqual((start, stats.histograms, stats.counters), (0, {}, {}))
+
+
+    def test_enabled(self):
+        stats = Stats()
+        stats.enabled = True
+        stats.stop('parse', stats.start())
+        stats.count('command', 'hello')
+        stats.register('inbox', lambda: {'pending': 0})
+        self.assertEqual(stats.histograms['parse'].count, 1)
+        report = stats.report()
+        self.assertIn('parse', report)
+        self.assertIn('hello', report)
+        self.assertIn("inbox: {'pending': 0}", report)
+
+
+    def test_histogram_percentile(self):
+        histogram = Histogram()
+        for microseconds in [1, 2, 3, 100, 5000]:
+            histogram.add(microseconds * 1000)
+        self.assertEqual(histogram.percentile(0.5), 4)
+        self.assertEqual(histogram.percentile(0.99), 8192)
+
+
+class TestWorkers(unittest.TestCase):
+    def test_assign_channels(self):
+        self.assertEqual(workers.assign_channels(['a', 'b', 'c', 'd', 'e'], 2), [['a', 'c', 'e'], ['b', 'd']])
+
+    def test_merge_stats(self):
+        first, second = Stats(), Stats()
+        for worker in (first, second):
+            worker.enabled = True
+            worker.stop('parse', worker.start())
+            worker.count('command', 'hello')
+            worker.register('inbox', lambda: {'pending': 1})
+
+        combined = Stats()
+        for number, worker in enumerate((first, second)):
+            combined.merge(pickle.loads(pickle.dumps(worker.snapshot())), f'worker-{number} ')
+        self.assertEqual(combined.histograms['parse'].count, 2)
+        self.assertEqual(combined.counters['command']['hello'], 2)
+        self.assertIn('worker-1 inbox: {\'pending\': 1}', combined.report())
+
+
+class TestLogs(unittest.TestCase):
+    def record(self, level):
+        return logging.LogRecord('test', level, __file__, 1, 'line %s', ('formatted later',), None)
+
+
+    def test_sampling(self):
+        sampler = SampleFilter(4)
+        passed = [sampler.filter(self.record(logging.DEBUG)) for _ in range(8)]
+        self.assertEqual(passed.count(True), 2)
+        self.assertTrue(sampler.filter(self.record(logging.WARNING)))
+
+
+    def test_formatting_left_to_listener(self):
+        record = BackgroundHandler(None).prepare(self.record(logging.DEBUG))
+        self.assertEqual((record.msg, record.args), ('line %s', ('formatted later',)))
+        self.assertEqual(record.getMessage(), 'line formatted later')
+
+
+class TestMessage(unittest.TestCase):
+    def test_timestamp_per_message(self):
+        first = Message()
+        second = Message()
+        self.assertLessEqual(first.received, second.received)
+        self.assertLessEqual(first.timestamp, second.timestamp)
+        self.assertLess(abs((datetime.now() - second.timestamp).total_seconds()), 5)
+        self.assertFalse(hasattr(first, '__dict__'))
+
+
+    def test_text_from_raw(self):
+        message = Message(message_type=MessageType.Server, raw=b'PING :tmi.twitch.tv\r\n')
+        self.assertIsNone(message._text)
+        self.assertEqual(message.text, 'PING :tmi.twitch.tv')
+        self.assertEqual(Message(text='hi', raw=b'ignored\r\n').text, 'hi')
+
+
+class TestCompiler(unittest.TestCase):
+    def test_nested(self):
+        script = compileScript('Hi {user}, {var {var pick}} }').getResult()
+        self.assertEqual([type(node) for node in script.nodes], [Literal, Call, Literal, Call, Literal])
+        outer = script.nodes[3]
+        self.assertEqual(outer.name, 'var')
+        self.assertEqual(outer.source, 'var {var pick}')
+        self.assertTrue(outer.dynamic)
+        self.assertEqual(outer.args[1].words, ['var', 'pick'])
+        self.assertEqual(script.nodes[4].text, ' }')
+
+
+    def test_brackets_do_not_match(self):
+        self.assertTrue(compileScript('Hi {user').isError())
+        self.assertTrue(compileScript('{' * 12 + '}' * 12).isError())
+
+
+    def test_if_branches(self):
+        call = compileScript('{if {var exists a} | {var a} | none}').getResult().nodes[0]
+        self.assertEqual(len(call.branches()), 3)
+        self.assertEqual(type(call.branches()[1][1]), Call)
+
+
+    def test_cache(self):
+        cache = ScriptCache()
+        first = cache.get('hello', '{var greeting}').getResult()
+        self.assertIs(cache.get('hello', '{var greeting}').getResult(), first)
+        self.assertIsNot(cache.get('hello', '{var greeting}!').getResult(), first)
+        cache.invalidate('hello')
+        self.assertEqual(len(cache), 0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+# workers.py:  Runs the bot as several processes so that parsing and script evaluation can use more than one
+#              CPU core.  Each worker process is a whole ChatBot, with its own event loop, connections and
+#              caches, looking after its share of the channels.  The coordinator process hands out the
+#              channels, restarts any worker that dies or stops reporting in, and combines their stats.
+#
+#              python chatbot.py --processes 4
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+from time import monotonic
+
+from chatbot import ChatBot, report_interval, restart_delay, restart_delay_max, restart_reset
+from logs    import setup_logging
+from stats   import Stats
+
+# How long the coordinator goes without a report from a worker before it restarts the worker.  Workers report
+#   every chatbot.report_interval seconds; one whose event loop is stuck stops reporting.
+heartbeat_timeout = 30
+
+# Seconds a worker is given to shut down cleanly before it is killed
+stop_timeout = 10
+
+
+# Deals the channels out to count workers in turn
+def assign_channels(channels, count):
+    assignments = [[] for _ in range(count)]
+    for number, channel in enumerate(channels):
+        assignments[number % count].append(channel)
+    return assignments
+
+
+# The entry point of each worker process
+def run_worker(number, channels, reports, database):
+    ChatBot(worker=number, channels=channels, reports=reports, database=database).run()
+
+
+class Coordinator:
+    # database = options for each worker's db.Database (see ChatBot)
+    def __init__(self, count, channels, settings, database=None):
+        self.count       = count
+        self.settings    = settings
+        self.database    = database
+        self.assignments = assign_channels(channels, count)
+        # spawn, so that no worker inherits the coordinator's sockets, threads or database connections
+        self.context     = multiprocessing.get_context('spawn')
+        self.reports     = self.context.Queue()
+        self.processes   = [None] * count
+        self.started     = [0.0] * count
+        self.heard       = [0.0] * count
+        self.restart_at  = [0.0] * count
+        self.delays      = [restart_delay] * count
+        self.restarts    = [0] * count
+        self.snapshots   = [None] * count
+        self.stats       = Stats()
+
+
+    def run(self):
+        self.log_listener, _ = setup_logging('coordinator.log')
+        print(f'Starting {self.count} worker processes...')
+        try:
+            asyncio.run(self.supervise())
+        except KeyboardInterrupt:
+            pass
+        self.stop_workers()
+        print('Coordinator shutting down.')
+        self.log_listener.stop()
+
+
+    def start_worker(self, number):
+        process = self.context.Process(target=run_worker, name=f'chatbot-worker-{number}',
+                                       args=(number, self.assignments[number], self.reports, self.database))
+        process.start()
+        logging.info('Worker %d started as pid %d with %d channels',
+                     number, process.pid, len(self.assignments[number]))
+        self.processes[number] = process
+        self.started[number]   = self.heard[number] = monotonic()
+
+
+    async def supervise(self):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stopping.set)
+                signals.append(signum)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        for number in range(self.count):
+            self.start_worker(number)
+        tasks = [asyncio.create_task(self.monitor(), name='monitor'),
+                 asyncio.create_task(self.receive(), name='receive')]
+        if self.settings.get('stats-port'):
+            tasks.append(asyncio.create_task(self.stats.serve(int(self.settings['stats-port'])), name='stats-serve'))
+        if self.settings.get('stats-interval'):
+            tasks.append(asyncio.create_task(self.stats.dump(float(self.settings['stats-interval'])),
+                                             name='stats-dump'))
+
+        await stopping.wait()
+        print('Stopping workers...')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+
+
+    # Asks every worker to stop (SIGTERM, which ChatBot handles as a clean shutdown) and waits for them
+    def stop_workers(self):
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            process.terminate()
+        deadline = monotonic() + stop_timeout
+        for process in processes:
+            process.join(max(deadline - monotonic(), 0))
+            if process.is_alive():
+                logging.warning('Worker %s did not stop in time; killing it', process.name)
+                process.kill()
+                process.join()
+
+
+    # Collects the reports the workers send every report_interval.  Runs until cancelled.
+    async def receive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                number, snapshot = await loop.run_in_executor(None, self.reports.get, True, report_interval)
+            except queue.Empty:
+                continue
+            self.heard[number]     = monotonic()
+            self.snapshots[number] = snapshot
+            self.combine()
+
+
+    # Restarts, with the same backoff as plugins get, any worker that has died or gone quiet.
+    #   A worker that exits cleanly has finished and is left alone.  Runs until cancelled.
+    async def monitor(self):
+        while True:
+            await asyncio.sleep(1)
+            now = monotonic()
+            for number, process in enumerate(self.processes):
+                if process is None:
+                    if self.restart_at[number] and now >= self.restart_at[number]:
+                        self.restart_at[number] = 0.0
+                        self.start_worker(number)
+                    continue
+                if process.is_alive():
+                    if now - self.heard[number] < heartbeat_timeout:
+                        continue
+                    logging.warning('Worker %d has not reported in %d seconds; restarting it',
+                                    number, now - self.heard[number])
+                    process.kill()
+                process.join()
+                self.processes[number] = None
+                if process.exitcode == 0:
+                    logging.info('Worker %d finished', number)
+                    continue
+
+                if now - self.started[number] > restart_reset:
+                    self.delays[number] = restart_delay
+                delay = self.delays[number]
+                print(f'Worker {number} stopped (exit code {process.exitcode}).  Restarting in {delay} seconds.')
+                self.restart_at[number] = now + delay
+                self.delays[number]     = min(delay * 2, restart_delay_max)
+                self.restarts[number]  += 1
+
+
+    # Rebuilds the combined stats from the latest report of every worker
+    def combine(self):
+        self.stats.reset()
+        self.stats.sources = {'workers': self.worker_stats}
+        for number, snapshot in enumerate(self.snapshots):
+            if snapshot is not None:
+                self.stats.merge(snapshot, f'worker-{number} ')
+
+
+    def worker_stats(self):
+        now = monotonic()
+        return [{'pid':       process.pid if process is not None else None,
+                 'alive':     process is not None and process.is_alive(),
+                 'channels':  len(self.assignments[number]),
+                 'restarts':  self.restarts[number],
+                 'last seen': round(now - self.heard[number], 1)}
+                for number, process in enumerate(self.processes)]